@@ -0,0 +1,220 @@
+""" Benchmarks for delivery_merge's parsing and scanning hot paths.
+
+All inputs are synthetic and generated in a temporary directory, so the
+suite runs offline. Results are written as JSON to allow comparisons
+between commits:
+
+    $ python benchmarks/bench.py --output before.json
+    $ git checkout <other commit>
+    $ python benchmarks/bench.py --output after.json --compare before.json
+"""
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from delivery_merge import merge, utils  # noqa: E402
+
+
+# Input sizes: (full, quick)
+SIZES = dict(
+    dmfile_lines=(10000, 200),
+    comment_lines=(10000, 200),
+    env_vars=(20000, 200),
+    pkgs=(5000, 100),
+    yaml_deps=(5000, 100),
+)
+
+
+def package_name(i):
+    """ Generate a unique package name without digits, since trailing
+    digits are parsed as a version by the dmfile format
+    """
+    name = ''
+    while True:
+        i, rem = divmod(i, 26)
+        name = 'abcdefghijklmnopqrstuvwxyz'[rem] + name
+        if not i:
+            return f'pkg-{name}'
+
+
+def make_dmfile(path, lines):
+    with open(path, 'w') as fp:
+        fp.write('; generated dmfile\n')
+        for i in range(lines):
+            fp.write(f'{package_name(i)}>=1.{i}.0  # comment {i}\n')
+    return path
+
+
+def make_env_dump(lines):
+    return '\n'.join([f'VARIABLE_{i}=value={i}:/some/path/{i}'
+                      for i in range(lines)]) + '\n'
+
+
+def make_pkgs(prefix, count):
+    pkgdir = os.path.join(prefix, 'pkgs')
+    names = []
+    for i in range(count):
+        name = package_name(i)
+        root = os.path.join(pkgdir, f'{name}-1.0.{i}-py_0')
+        recipe = os.path.join(root, 'info', 'recipe')
+        os.makedirs(recipe)
+        with open(os.path.join(root, 'info', 'index.json'), 'w') as fp:
+            json.dump(dict(name=name, version=f'1.0.{i}', build='py_0'), fp)
+        with open(os.path.join(recipe, 'meta.yaml'), 'w') as fp:
+            fp.write(f'package:\n  name: {name}\nsource:\n'
+                     f'  git_url: https://example/{name}.git\n')
+        with open(os.path.join(root, 'info', 'git'), 'w') as fp:
+            fp.write(f'==> git log -n1 <==\ncommit {i:040x}\n')
+        names.append((name, f'1.0.{i}'))
+    return names
+
+
+def make_yaml(path, deps):
+    with open(path, 'w') as fp:
+        fp.write('name: bench\nchannels:\n  - defaults\ndependencies:\n')
+        for i in range(deps):
+            fp.write(f'  - package{i}=1.0.{i}=py37_{i % 7}\n')
+        fp.write('prefix: /tmp/bench\n\n')
+    return path
+
+
+def measure(func, repeat, setup=None):
+    """ Time `func` `repeat` times
+    :returns: dict: timing statistics (seconds)
+    """
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+
+    return dict(min=min(samples),
+                median=statistics.median(samples),
+                mean=statistics.mean(samples),
+                repeat=repeat)
+
+
+def run(workdir, quick=False, repeat=5):
+    """ Execute all benchmarks
+    :returns: dict: benchmark name -> timing statistics
+    """
+    size = {k: v[1] if quick else v[0] for k, v in SIZES.items()}
+    results = dict()
+
+    dmfile = make_dmfile(os.path.join(workdir, 'bench.dm'),
+                         size['dmfile_lines'])
+    results['dmfile'] = measure(lambda: merge.dmfile(dmfile), repeat)
+
+    lines = [f'data_{i} ; comment # other' if i % 2 else f'data_{i} # note'
+             for i in range(size['comment_lines'])]
+    results['comment_find'] = measure(
+        lambda: [utils.comment_find(x) for x in lines], repeat)
+
+    dump = make_env_dump(size['env_vars'])
+    results['getenv'] = measure(lambda: utils.getenv(dump), repeat)
+
+    prefix = os.path.join(workdir, 'prefix')
+    names = make_pkgs(prefix, size['pkgs'])
+    pkg_dm = os.path.join(workdir, 'pkgs.dm')
+    with open(pkg_dm, 'w') as fp:
+        for name, version in names[::10]:
+            fp.write(f'{name}={version}\n')
+
+    cache = os.path.join(workdir, 'cache')
+
+    def clear_cache():
+        shutil.rmtree(cache, ignore_errors=True)
+
+    os.environ['DELIVERY_MERGE_CACHE'] = cache
+    scan = lambda: list(merge.testable_packages(pkg_dm, prefix))  # noqa
+    results['testable_packages_cold'] = measure(scan, repeat,
+                                                setup=clear_cache)
+    results['testable_packages_warm'] = measure(scan, repeat)
+
+    yamlfile = os.path.join(workdir, 'bench.yml')
+    channels = ['http://ssb.stsci.edu/astroconda', 'defaults']
+    results['force_yaml_channels'] = measure(
+        lambda: merge.force_yaml_channels(yamlfile, channels), repeat,
+        setup=lambda: make_yaml(yamlfile, size['yaml_deps']))
+
+    return results
+
+
+def git_commit():
+    proc = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    return proc.stdout.decode().strip() or None
+
+
+def compare(current, baseline):
+    """ Print the relative change of each benchmark's median
+    """
+    print(f"{'Benchmark':<26s} {'Baseline':>10s} {'Current':>10s} "
+          f"{'Change':>8s}")
+    for name, data in current['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if old is None:
+            print(f"{name:<26s} {'-':>10s} {data['median']:>10.4f}")
+            continue
+        change = (data['median'] - old['median']) / old['median'] * 100
+        print(f"{name:<26s} {old['median']:>10.4f} {data['median']:>10.4f} "
+              f"{change:>+7.1f}%")
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='delivery_merge benchmarks')
+    parser.add_argument('--output', help='write results to JSON file')
+    parser.add_argument('--compare', help='baseline JSON results file')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='iterations per benchmark')
+    parser.add_argument('--quick', action='store_true',
+                        help='use small inputs (smoke test)')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='delivery_merge_bench_')
+    cache = os.environ.get('DELIVERY_MERGE_CACHE')
+    try:
+        benchmarks = run(workdir, quick=args.quick, repeat=args.repeat)
+    finally:
+        if cache is None:
+            os.environ.pop('DELIVERY_MERGE_CACHE', None)
+        else:
+            os.environ['DELIVERY_MERGE_CACHE'] = cache
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = dict(commit=git_commit(),
+                  python=platform.python_version(),
+                  platform=platform.platform(),
+                  timestamp=time.time(),
+                  quick=args.quick,
+                  benchmarks=benchmarks)
+
+    for name, data in benchmarks.items():
+        print(f"{name:<26s} median {data['median']:.4f}s "
+              f"min {data['min']:.4f}s")
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(result, fp, indent=2)
+            fp.write('\n')
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(result, json.load(fp))
+
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,74 @@
 import os
 import pytest
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """ Serve static files with support for single HTTP Range requests
+    """
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        byte_range = self.headers.get('Range')
+        self.server.requests.append((self.path, byte_range))
+
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as fp:
+            data = fp.read()
+
+        start = 0
+        if byte_range:
+            start = int(byte_range.split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             f'bytes {start}-{len(data) - 1}/{len(data)}')
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
 
 
 @pytest.fixture(scope="session", autouse=True)
 def _jail(tmp_path_factory):
     cwd = os.path.abspath('.')
     tmp = tmp_path_factory.mktemp("condatest")
+    cache = os.environ.get('DELIVERY_MERGE_CACHE')
+    os.environ['DELIVERY_MERGE_CACHE'] = str(tmp / 'cache')
     os.chdir(tmp)
     yield
     os.chdir(cwd)
+    if cache is None:
+        del os.environ['DELIVERY_MERGE_CACHE']
+    else:
+        os.environ['DELIVERY_MERGE_CACHE'] = cache
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """ Local HTTP server stand-in. Files written to `server.root` are
+    served from `server.url`. Requests are recorded in `server.requests`.
+    """
+    root = tmp_path / 'www'
+    root.mkdir()
+    handler = partial(RangeRequestHandler, directory=str(root))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.requests = []
+    server.root = str(root)
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,97 @@
+import json
+import os
+import threading
+import time
+from .utils import file_lock
+
+
+def index_load(filename):
+    """ Read a cache index
+    :param filename: str: path to index file
+    :returns: dict: cache records (empty when the index does not exist)
+    """
+    if not os.path.exists(filename):
+        return dict()
+
+    with open(filename) as fp:
+        try:
+            return json.load(fp)
+        except ValueError:
+            return dict()
+
+
+def index_save(filename, data):
+    """ Write a cache index atomically
+    :param filename: str: path to index file
+    :param data: dict: cache records
+    """
+    tmp = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(data, fp, indent=2, sort_keys=True)
+    os.replace(tmp, filename)
+
+
+def lru_touch(filename, key, **info):
+    """ Mark a cache record as recently used. The index is locked while it
+    is updated (see `utils.file_lock`).
+
+    :param filename: str: path to index file
+    :param key: str: record name
+    :param info: dict: additional data to store with the record
+    :returns: dict: updated record
+    """
+    with file_lock(filename + '.lock'):
+        data = index_load(filename)
+        record = data.get(key, dict())
+        record.update(info)
+        record['atime'] = time.time()
+        data[key] = record
+        index_save(filename, data)
+    return record
+
+
+def lru_evict(filename, max_entries=None, max_age=None, max_size=None,
+              protect=[]):
+    """ Remove least recently used records from a cache index.
+    The caller is responsible for deleting the data the records refer to.
+    The index is locked while it is updated (see `utils.file_lock`).
+
+    :param filename: str: path to index file
+    :param max_entries: int: number of records to keep
+    :param max_age: float: seconds since last use before a record expires
+    :param max_size: int: upper limit of the sum of each record's `size`
+    :param protect: list: record names that must not be evicted
+    :returns: list: of (key, record) tuples removed from the index
+    """
+    with file_lock(filename + '.lock'):
+        data = index_load(filename)
+        now = time.time()
+        ordered = sorted(data.items(), key=lambda x: x[1].get('atime', 0))
+        evicted = []
+
+        for key, record in ordered:
+            if key in protect:
+                continue
+            if max_age is not None and now - record.get('atime', 0) > max_age:
+                evicted.append((key, record))
+
+        for key, _ in evicted:
+            del data[key]
+
+        ordered = [x for x in ordered if x[0] in data and x[0] not in protect]
+        total = sum([x.get('size', 0) for x in data.values()])
+
+        while ordered:
+            too_many = max_entries is not None and len(data) > max_entries
+            too_big = max_size is not None and total > max_size
+            if not too_many and not too_big:
+                break
+
+            key, record = ordered.pop(0)
+            total -= record.get('size', 0)
+            del data[key]
+            evicted.append((key, record))
+
+        if evicted:
+            index_save(filename, data)
+    return evicted
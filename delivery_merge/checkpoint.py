@@ -0,0 +1,91 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+from .cache import index_load, index_save
+
+
+CHECKPOINT_FILE = 'checkpoint.json'
+
+
+def checkpoint_key(*inputs):
+    """ Hash the inputs of a stage. Inputs must be JSON serializable.
+    Pass file digests (see `utils.file_hash`) rather than paths when the
+    content of a file matters.
+
+    :param inputs: values the stage's outcome depends on
+    :returns: str: hex digest
+    """
+    data = json.dumps(inputs, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class Checkpoint:
+    """ Record of completed stages, stored as JSON. A stage is complete when
+    it was marked with the same key it is queried with, so a change to any
+    of its inputs causes it to run again.
+
+    Every execution of a stage receives a new token. Including the token of
+    a stage in the keys of the stages that follow it causes them to run
+    again whenever that stage is executed, even with unchanged inputs.
+
+    >>> checkpoint = Checkpoint('checkpoint.json')
+    >>> key = checkpoint_key(create_token, dmfile_digest)
+    >>> if checkpoint.done('merge', key):
+    >>>     merge_token = checkpoint.token('merge')
+    >>> else:
+    >>>     merge()
+    >>>     merge_token = checkpoint.mark('merge', key)
+
+    :param filename: str: path to checkpoint file
+    :param reset: bool: discard previously recorded stages
+    """
+    def __init__(self, filename, reset=False):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.records = dict() if reset else index_load(filename)
+
+    def done(self, name, key):
+        """ Determine whether a stage completed with the given inputs
+        :param name: str: stage name
+        :param key: str: value returned by `checkpoint_key`
+        :returns: bool
+        """
+        with self.lock:
+            record = self.records.get(name)
+        return record is not None and record.get('key') == key
+
+    def get(self, name):
+        """ Retrieve the data recorded for a stage
+        :param name: str: stage name
+        :returns: dict: record, or None
+        """
+        with self.lock:
+            return self.records.get(name)
+
+    def token(self, name):
+        """ Identify the most recent execution of a stage
+        :param name: str: stage name
+        :returns: str: hex digest, or None when the stage never completed
+        """
+        with self.lock:
+            record = self.records.get(name)
+        if record is None:
+            return None
+        return checkpoint_key(record['key'], record.get('run'))
+
+    def mark(self, name, key, **info):
+        """ Record a completed stage. The checkpoint file is updated
+        immediately.
+
+        :param name: str: stage name
+        :param key: str: value returned by `checkpoint_key`
+        :param info: dict: additional data to store with the record
+        :returns: str: token of this execution (see `token`)
+        """
+        with self.lock:
+            self.records[name] = dict(info, key=key, time=time.time(),
+                                      run=uuid.uuid4().hex)
+            index_save(self.filename, self.records)
+        return self.token(name)
@@ -0,0 +1,271 @@
+import os
+import sys
+import time
+import traceback
+from . import merge as cli_merge
+from ..conda import TEMPLATE_MAX, conda_init_path, conda_installer, ei_touch
+from ..timing import timings_table, timings_write
+from ..trace import TRACE_ENV, trace_enable, trace_to_chrome
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stderr, redirect_stdout
+from ruamel.yaml import YAML
+
+
+MANIFEST_KEYS = ['env_name', 'base_spec', 'dmfile']
+
+
+class InvalidManifest(Exception):
+    pass
+
+
+def manifest_read(filename):
+    """ Read a batch manifest (YAML):
+
+        jobs:
+          - env_name: delivery_py37
+            base_spec: py37.txt
+            dmfile: release.dm
+            channels:          # optional
+              - defaults
+
+    Relative paths are resolved against the directory of the manifest.
+
+    :param filename: str: path to manifest
+    :returns: list: of dicts (env_name, base_spec, dmfile, channels)
+    :raises InvalidManifest: when a job is incomplete or duplicated
+    """
+    with open(filename) as fp:
+        data = YAML(typ='safe').load(fp)
+
+    root = os.path.dirname(os.path.abspath(filename))
+    entries = data.get('jobs') if isinstance(data, dict) else None
+    if not entries:
+        raise InvalidManifest(f'{filename}: no jobs defined')
+
+    jobs = []
+    for i, entry in enumerate(entries):
+        entry = entry if isinstance(entry, dict) else {}
+        missing = [x for x in MANIFEST_KEYS if not entry.get(x)]
+        if missing:
+            raise InvalidManifest(f'{filename}: job {i}: missing '
+                                  f'{", ".join(missing)}')
+
+        name = str(entry['env_name'])
+        if name in [x['env_name'] for x in jobs]:
+            raise InvalidManifest(f'{filename}: job {i}: duplicate env_name '
+                                  f'{name}')
+
+        channels = entry.get('channels') or []
+        if isinstance(channels, str):
+            channels = [channels]
+
+        jobs.append(dict(env_name=name,
+                         base_spec=os.path.join(root, entry['base_spec']),
+                         dmfile=os.path.join(root, entry['dmfile']),
+                         channels=[str(x) for x in channels]))
+    return jobs
+
+
+def job_argv(job, args, output_dir):
+    """ Translate a batch job into `delivery_merge` command line arguments
+    :param job: dict: record returned by `manifest_read`
+    :param args: argparse.Namespace: parsed batch arguments
+    :param output_dir: str: output directory of the job
+    :returns: list
+    """
+    argv = ['--env-name', job['env_name'],
+            '--output-dir', output_dir,
+            '--src-dir', os.path.join(output_dir, 'src'),
+            '--installer-version', args.installer_version,
+            '--dmfile', job['dmfile'],
+            '--jobs', str(args.test_jobs),
+            '--shards', str(args.shards),
+            '--max-templates', str(args.max_templates),
+            # Tracing is managed by the batch. Jobs append to its trace.
+            '--trace=']
+    if args.installer_sha256:
+        argv += ['--installer-sha256', args.installer_sha256]
+    if args.run_tests:
+        argv.append('--run-tests')
+    if args.force_solve:
+        argv.append('--force-solve')
+    if not args.validate:
+        argv.append('--no-validate')
+    if args.restart:
+        argv.append('--restart')
+    if not args.test_cache:
+        argv.append('--no-test-cache')
+    if args.test_timeout:
+        argv += ['--test-timeout', str(args.test_timeout)]
+    if args.test_max_rss:
+        argv += ['--test-max-rss', str(args.test_max_rss)]
+    for channel in job['channels']:
+        argv += ['--channel', channel]
+    argv.append(job['base_spec'])
+    return argv
+
+
+def _batch_worker(argv, logfile):
+    """ Build one delivery inside a worker process. Output is written to
+    `logfile`.
+
+    :param argv: list: `delivery_merge` command line arguments
+    :param logfile: str: path to log file
+    :returns: tuple: (exit status, error message or None, elapsed seconds)
+    """
+    start = time.monotonic()
+    with open(logfile, 'w+') as log:
+        with redirect_stdout(log), redirect_stderr(log):
+            try:
+                args = cli_merge.arg_parser().parse_args(argv)
+                return cli_merge.run(args), None, time.monotonic() - start
+            except Exception as e:
+                traceback.print_exc()
+                return 1, f'{type(e).__name__}: {e}', \
+                    time.monotonic() - start
+
+
+def batch_run(jobs, args):
+    """ Build deliveries concurrently. Every job shares the same miniconda
+    installation, package cache and template environments. Each job writes
+    to its own directory below `args.output_dir`.
+
+    :param jobs: list: records returned by `manifest_read`
+    :param args: argparse.Namespace: parsed batch arguments
+    :returns: list: of status dicts, in manifest order
+    """
+    # The installer is shared, so it is installed once before any job starts
+    prefix = conda_installer(args.installer_version,
+                             sha256=args.installer_sha256)
+    conda_init_path(prefix)
+    ei_touch()
+
+    status = dict()
+    workers = max(1, min(args.jobs, len(jobs)))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = dict()
+        for job in jobs:
+            output_dir = os.path.abspath(os.path.join(args.output_dir,
+                                                      job['env_name']))
+            os.makedirs(output_dir, exist_ok=True)
+            logfile = os.path.join(output_dir, 'output.log')
+            future = pool.submit(_batch_worker,
+                                 job_argv(job, args, output_dir), logfile)
+            futures[future] = (job, output_dir, logfile)
+
+        for future in as_completed(futures):
+            job, output_dir, logfile = futures[future]
+            try:
+                returncode, error, elapsed = future.result()
+            except Exception as e:
+                returncode, error, elapsed = 1, f'{type(e).__name__}: {e}', 0
+
+            if error is not None:
+                result = 'error'
+            elif returncode:
+                result = 'failed'
+            else:
+                result = 'ok'
+
+            status[job['env_name']] = dict(env_name=job['env_name'],
+                                           status=result,
+                                           returncode=returncode,
+                                           error=error,
+                                           wall=round(elapsed, 3),
+                                           output_dir=output_dir,
+                                           log=logfile)
+            print(f"{job['env_name']}: {result} ({elapsed:.2f}s)",
+                  file=sys.stderr if result != 'ok' else sys.stdout)
+
+    return [status[x['env_name']] for x in jobs]
+
+
+def main():
+    parser = ArgumentParser(description='Build several deliveries sharing '
+                                        'one miniconda installation')
+    parser.add_argument('--output-dir',
+                        default=os.path.normpath('./delivery'),
+                        help='path to store delivery data (one directory '
+                             'per job)')
+    parser.add_argument('--installer-version',
+                        required=True,
+                        help='miniconda3 installer version')
+    parser.add_argument('--installer-sha256',
+                        help='expected sha256 digest of miniconda3 installer')
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=2,
+                        help='number of deliveries to build concurrently')
+    parser.add_argument('--run-tests',
+                        action='store_true',
+                        help='scan packages in base_spec for tests to execute')
+    parser.add_argument('--test-jobs',
+                        type=int,
+                        default=1,
+                        help='number of packages to test concurrently per '
+                             'delivery')
+    parser.add_argument('--shards',
+                        type=int,
+                        default=1,
+                        help='split each package\'s tests across SHARDS '
+                             'pytest processes')
+    parser.add_argument('--test-timeout',
+                        type=float,
+                        help='seconds a package\'s tests may run')
+    parser.add_argument('--test-max-rss',
+                        type=int,
+                        help='megabytes of memory a package\'s tests may '
+                             'use')
+    parser.add_argument('--no-test-cache',
+                        dest='test_cache',
+                        action='store_false',
+                        help='run tests even when results are cached')
+    parser.add_argument('--max-templates',
+                        type=int,
+                        default=TEMPLATE_MAX,
+                        help='number of cached base_spec environments to '
+                             'retain (0 disables)')
+    parser.add_argument('--force-solve',
+                        action='store_true',
+                        help='ignore cached dependency solutions')
+    parser.add_argument('--no-validate',
+                        dest='validate',
+                        action='store_false',
+                        help='do not check dmfile packages against the '
+                             'channels\' repodata before solving')
+    parser.add_argument('--restart',
+                        action='store_true',
+                        help='ignore checkpoints of previous runs')
+    parser.add_argument('--trace',
+                        default=os.environ.get(TRACE_ENV),
+                        help='append a JSONL record of every subprocess to '
+                             f'TRACE (also: ${TRACE_ENV})')
+    parser.add_argument('manifest',
+                        help='YAML file listing the deliveries to build')
+    args = parser.parse_args()
+
+    jobs = manifest_read(args.manifest)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    if args.trace:
+        trace_enable(args.trace)
+
+    start = time.monotonic()
+    try:
+        status = batch_run(jobs, args)
+    finally:
+        if args.trace and os.path.exists(args.trace):
+            chrome = os.path.splitext(args.trace)[0] + '.trace.json'
+            trace_to_chrome(args.trace, chrome)
+            print(f"Trace: {args.trace} (Chrome trace-event: {chrome})")
+
+    report = dict(jobs=status, wall=round(time.monotonic() - start, 3))
+    timings_write(os.path.join(args.output_dir, 'batch.json'), report)
+    print(timings_table([(x['env_name'], x) for x in status]))
+
+    failed = [x for x in status if x['status'] != 'ok']
+    for job in failed:
+        print(f"FAILED: {job['env_name']} (log: {job['log']})",
+              file=sys.stderr)
+    return 1 if failed else 0
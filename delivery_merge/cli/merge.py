@@ -1,15 +1,52 @@
 import os
-from ..conda import conda, conda_installer, conda_init_path, ei_touch
+import sys
+import traceback
+from ..checkpoint import CHECKPOINT_FILE, Checkpoint, checkpoint_key
+from ..conda import (
+    INSTALLER_PREFIX,
+    TEMPLATE_MAX,
+    conda,
+    conda_env_create,
+    conda_installer,
+    conda_init_path,
+    ei_touch
+)
 from ..merge import (
-    env_combine,
+    UnsatisfiablePackageSpec,
+    dmfile as dmfile_read,
+    dmfile_diff,
+    dmfile_validate,
+    env_combine_cached,
     testable_packages,
     integration_test,
-    force_yaml_channels
+    integration_test_pool,
+    integration_test_root,
+    integration_test_tools,
+    prefetch_sources,
+    result_cache_key,
+    result_cache_restore,
+    result_cache_store
 )
+from ..junit import JunitReport
+from ..limits import ResourceLimitExceeded, resource_limits
+from ..meta import conda_meta, conda_subdir, export
+from ..pipeline import Pipeline
+from ..profiling import PROFILE_TOP, profile_call
+from ..timing import timings_table, timings_write, usage_collect
+from ..trace import TRACE_ENV, trace_enable, trace_to_chrome
+from ..utils import file_hash
 from argparse import ArgumentParser
 
 
-def main():
+CHANNELS = ['http://ssb.stsci.edu/astroconda',
+            'defaults',
+            'http://ssb.stsci.edu/astroconda-dev']
+
+
+def arg_parser():
+    """ Command line interface of delivery_merge
+    :returns: argparse.ArgumentParser
+    """
     parser = ArgumentParser()
     parser.add_argument('--env-name', default='delivery',
                         help='name of conda environment')
@@ -19,58 +56,343 @@ def main():
     parser.add_argument('--installer-version',
                         required=True,
                         help='miniconda3 installer version')
+    parser.add_argument('--installer-sha256',
+                        help='expected sha256 digest of miniconda3 installer')
     parser.add_argument('--run-tests',
                         action='store_true',
                         help='scan packages in base_spec for tests to execute')
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=1,
+                        help='number of packages to test concurrently')
+    parser.add_argument('--shards',
+                        type=int,
+                        default=1,
+                        help='split each package\'s tests across SHARDS '
+                             'pytest processes')
+    parser.add_argument('--test-timeout',
+                        type=float,
+                        help='seconds a package\'s tests may run before '
+                             'they are killed and reported as failed')
+    parser.add_argument('--test-max-rss',
+                        type=int,
+                        help='megabytes of memory a package\'s tests may '
+                             'use before they are killed and reported as '
+                             'failed')
+    parser.add_argument('--no-test-cache',
+                        dest='test_cache',
+                        action='store_false',
+                        help='run tests even when results for the same '
+                             'commit and environment are cached')
+    parser.add_argument('--max-templates',
+                        type=int,
+                        default=TEMPLATE_MAX,
+                        help='number of cached base_spec environments to '
+                             'retain (0 disables)')
     parser.add_argument('--dmfile',
                         required=True,
                         help='file with list providing packages to merge')
+    parser.add_argument('--channel',
+                        dest='channels',
+                        action='append',
+                        help='conda channel URL (repeatable, in order of '
+                             'priority; default: ' + ', '.join(CHANNELS) + ')')
+    parser.add_argument('--src-dir',
+                        default='src',
+                        help='path to check out test sources')
+    parser.add_argument('--force-solve',
+                        action='store_true',
+                        help='ignore cached dependency solutions')
+    parser.add_argument('--no-validate',
+                        dest='validate',
+                        action='store_false',
+                        help='do not check dmfile packages against the '
+                             'channels\' repodata before solving')
+    parser.add_argument('--restart',
+                        action='store_true',
+                        help='ignore the checkpoint of a previous run and '
+                             'execute every stage')
+    parser.add_argument('--dry-run',
+                        action='store_true',
+                        help='report which dmfile packages require '
+                             'installation and exit')
+    parser.add_argument('--trace',
+                        default=os.environ.get(TRACE_ENV),
+                        help='append a JSONL record of every subprocess to '
+                             f'TRACE (also: ${TRACE_ENV}). A Chrome '
+                             'trace-event file is written alongside it')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='profile delivery_merge itself and write '
+                             'profile.pstats and profile.txt to the output '
+                             'directory')
+    parser.add_argument('--profile-top',
+                        type=int,
+                        default=PROFILE_TOP,
+                        help='number of functions listed in profile.txt')
     parser.add_argument('base_spec',
                         help='@EXPLICIT dump file')
-    args = parser.parse_args()
+    return parser
+
 
+def main():
+    args = arg_parser().parse_args()
+
+    if args.profile:
+        return profile_call(lambda: run(args), args.output_dir,
+                            top=args.profile_top)
+    return run(args)
+
+
+def run(args):
+    """ Build a delivery
+    :param args: argparse.Namespace: parsed command line arguments
+    :returns: int: exit status
+    """
     name = args.env_name
     base_spec = args.base_spec
     dmfile = args.dmfile
-    channels = ['http://ssb.stsci.edu/astroconda',
-                'defaults',
-                'http://ssb.stsci.edu/astroconda-dev']
+    channels = args.channels or CHANNELS
     delivery_root = args.output_dir
     yamlfile = os.path.join(delivery_root, name + '.yml')
     specfile = os.path.join(delivery_root, name + '.txt')
 
+    if args.dry_run:
+        env_prefix = os.path.join(os.path.abspath(INSTALLER_PREFIX),
+                                  'envs', name)
+        satisfied, unsatisfied = dmfile_diff(dmfile_read(dmfile), env_prefix)
+        print(f"Packages requiring installation in {name}:")
+        for record, version in unsatisfied:
+            print(f"  {record['fullspec']} (installed: {version})")
+        print(f"Packages already satisfied in {name}:")
+        for record, version in satisfied:
+            print(f"  {record['fullspec']} (installed: {version})")
+
+        if args.validate and unsatisfied:
+            installed = dict()
+            if os.path.isdir(env_prefix):
+                installed = conda_meta(env_prefix)
+            try:
+                dmfile_validate([x[0] for x in unsatisfied], channels,
+                                conda_subdir(installed))
+            except UnsatisfiablePackageSpec as e:
+                print(f"Packages unavailable in the channels:\n{e}",
+                      file=sys.stderr)
+                return 1
+        return 0
+
     if not os.path.exists(delivery_root):
         os.mkdir(delivery_root, 0o755)
 
-    prefix = conda_installer(args.installer_version)
-    conda_init_path(prefix)
-    ei_touch()
+    if args.trace:
+        trace_enable(args.trace)
+
+    # Stages record a hash of their inputs when they complete. Each key
+    # includes the token of the stage before it, so a rerun resumes at the
+    # first stage whose inputs changed, and every stage following one that
+    # was executed runs again.
+    checkpoint = Checkpoint(os.path.join(delivery_root, CHECKPOINT_FILE),
+                            reset=args.restart)
+
+    def stage_installer():
+        prefix = conda_installer(args.installer_version,
+                                 sha256=args.installer_sha256)
+        conda_init_path(prefix)
+        ei_touch()
+        return prefix
+
+    def stage_create(prefix):
+        key = checkpoint_key(args.installer_version, args.installer_sha256,
+                             file_hash(base_spec))
+        exists = os.path.exists(os.path.join(prefix, 'envs', name))
+        if exists and checkpoint.done('create', key):
+            print(f"Resuming: environment {name} is up to date")
+            return checkpoint.token('create')
+
+        if exists:
+            print(f"Removing stale environment {name}...")
+            conda('remove', '-q', '-y', '--all', '-n', name) \
+                .check_returncode()
 
-    if not os.path.exists(os.path.join(prefix, 'envs', name)):
         print(f"Creating environment {name}...")
-        proc = conda('create', '-q', '-y', '-n',  name, '--file', base_spec)
-        if proc.stderr:
-            print(proc.stderr.decode())
-        proc.check_returncode()
+        conda_env_create(name, base_spec, max_templates=args.max_templates)
+        return checkpoint.mark('create', key)
 
-    print(f"Merging requested packages into environment: {name}")
-    env_combine(dmfile, name, channels)
+    def stage_prefetch(prefix):
+        # Sources are fetched again on demand, so a failure must not prevent
+        # the tests stage from running
+        print("Prefetching test sources...")
+        try:
+            return prefetch_sources(dmfile, prefix)
+        except Exception as e:
+            print(f"Prefetch failed: {e}", file=sys.stderr)
+            return []
 
-    print("Exporting yaml configuration...")
-    conda('env', 'export', '-n', name, '--file', yamlfile)
+    def stage_merge(prefix, create_token):
+        key = checkpoint_key(create_token, file_hash(dmfile), channels)
+        if not args.force_solve and checkpoint.done('merge', key):
+            print(f"Resuming: packages already merged into {name}")
+            return checkpoint.token('merge')
 
-    print("Fix up yaml channel order...")
-    force_yaml_channels(yamlfile, channels)
+        print(f"Merging requested packages into environment: {name}")
+        env_combine_cached(dmfile, name, channels, base_spec,
+                           force_solve=args.force_solve,
+                           validate=args.validate)
+        return checkpoint.mark('merge', key)
 
-    print("Exporting explicit dump...")
-    with open(specfile, 'w+') as spec:
-        proc = conda('list', '--explicit', '-n', name)
-        spec.write(proc.stdout.decode())
+    def stage_export(prefix, merge_token):
+        key = checkpoint_key(merge_token, yamlfile, specfile)
+        if checkpoint.done('export', key) \
+                and all([os.path.exists(x) for x in [yamlfile, specfile]]):
+            print("Resuming: delivery already exported")
+            return checkpoint.token('export')
 
-    if args.run_tests:
+        print("Exporting yaml configuration and explicit dump...")
+        export(os.path.join(prefix, 'envs', name), name, channels,
+               yamlfile=yamlfile, specfile=specfile)
+        return checkpoint.mark('export', key)
+
+    def stage_tests(prefix, export_token, _):
+        max_rss = None
+        if args.test_max_rss:
+            max_rss = args.test_max_rss << 20
+        failed = []
         results = os.path.join(delivery_root, 'results')
-        for package in testable_packages(args.dmfile, prefix):
-            print(f"Running tests: {package}")
-            integration_test(package, name, results_root=results)
+        spec_digest = file_hash(specfile)
+        # Updated as each package finishes
+        report = JunitReport(os.path.join(results, 'results.xml'),
+                             os.path.join(results, 'summary.json'))
+
+        def reported(package, status=None):
+            repo_root = os.path.basename(package['repo']).replace('.git', '')
+            report.add(repo_root, os.path.join(
+                integration_test_root(package, results), 'result.xml'),
+                status=status)
+
+        keys = dict()
+        packages = []
+        for package in testable_packages(dmfile, prefix):
+            key = checkpoint_key(export_token, package['repo'],
+                                 package['commit'])
+            record = checkpoint.get('tests:' + package['repo'])
+            if checkpoint.done('tests:' + package['repo'], key) \
+                    and os.path.exists(record['result']):
+                print(f"Resuming: tests already completed: {package}")
+                package_usage[package['repo']] = dict(status='resumed')
+                reported(package, 'resumed')
+                continue
+            keys[package['repo']] = key
+
+            cached = None
+            if args.test_cache:
+                cached = result_cache_restore(
+                    result_cache_key(package, spec_digest), package, results)
+            if cached is not None:
+                result, summary = cached
+                print(f"Tests cached: {package['repo']} {summary}")
+                package_usage[package['repo']] = dict(status='cached',
+                                                      summary=summary)
+                checkpoint.mark('tests:' + package['repo'], key,
+                                result=result)
+                reported(package, 'cached')
+                continue
+            packages.append(package)
+
+        def passed(package, result):
+            if args.test_cache and os.path.exists(result):
+                result_cache_store(result_cache_key(package, spec_digest),
+                                   package, result)
+            checkpoint.mark('tests:' + package['repo'],
+                            keys[package['repo']], result=result)
+
+        def completed(package, result, error, usage):
+            package_usage[package['repo']] = usage or dict(status='failed')
+            if error is not None:
+                failed.append(package)
+                reported(package, package_usage[package['repo']]['status'])
+                return
+            passed(package, result)
+            reported(package)
+
+        if args.jobs > 1:
+            integration_test_pool(packages, name, results, args.jobs,
+                                  args.src_dir, callback=completed,
+                                  shards=args.shards,
+                                  timeout=args.test_timeout, max_rss=max_rss)
+        elif packages:
+            print("Installing test tools...")
+            integration_test_tools(name, os.path.join(results,
+                                                      'pip-tools.log'))
+            for package in packages:
+                print(f"Running tests: {package}")
+                result, error = '', None
+                try:
+                    with usage_collect() as usage, \
+                            resource_limits(args.test_timeout, max_rss):
+                        result = integration_test(package, name,
+                                                  results_root=results,
+                                                  src_root=args.src_dir,
+                                                  install_tools=False,
+                                                  shards=args.shards)
+                except Exception as e:
+                    # Failures are recorded as in the pool (see `completed`)
+                    # and testing continues with the next package
+                    if not isinstance(e, ResourceLimitExceeded):
+                        traceback.print_exc()
+                    print(f"Tests failed: {package['repo']}: {e}",
+                          file=sys.stderr)
+                    error = e
+                usage = usage.as_dict()
+                if isinstance(error, ResourceLimitExceeded):
+                    usage['status'] = error.reason
+                completed(package, result, error, usage)
+        if report.packages:
+            totals = report.totals()
+            print(f"Test summary: {report.summary} ({totals['passed']} "
+                  f"passed, {totals['failures']} failed, {totals['errors']} "
+                  f"errors, {totals['skipped']} skipped)")
+        return failed
+
+    # Test sources are fetched while the environment is being built
+    pipeline = Pipeline()
+    pipeline.add('installer', stage_installer)
+    pipeline.add('create', stage_create, deps=['installer'])
+    pipeline.add('merge', stage_merge, deps=['installer', 'create'])
+    pipeline.add('export', stage_export, deps=['installer', 'merge'])
+    if args.run_tests:
+        pipeline.add('prefetch', stage_prefetch, deps=['installer'])
+        pipeline.add('tests', stage_tests,
+                     deps=['installer', 'export', 'prefetch'])
+
+    package_usage = dict()
+    try:
+        result = pipeline.run()
+    finally:
+        report = pipeline.report()
+        timings = dict(stages=report['usage'],
+                       packages=package_usage,
+                       wall=round(report['wall'], 3),
+                       serial=round(report['serial'], 3),
+                       saved=round(report['saved'], 3))
+        timings_write(os.path.join(delivery_root, 'timings.json'), timings)
+
+        rows = list(report['usage'].items())
+        rows += [(f'tests: {os.path.basename(x)}', y)
+                 for x, y in package_usage.items()]
+        print(timings_table(rows))
+        print(f"Pipeline: {report['wall']:.2f}s elapsed, "
+              f"{report['saved']:.2f}s saved by overlapping stages")
+
+        if args.trace and os.path.exists(args.trace):
+            chrome = os.path.splitext(args.trace)[0] + '.trace.json'
+            trace_to_chrome(args.trace, chrome)
+            print(f"Trace: {args.trace} (Chrome trace-event: {chrome})")
+
+    failed = result.get('tests') or []
+    if failed:
+        for package in failed:
+            print(f"FAILED: {package['repo']}", file=sys.stderr)
+        return 1
 
     print("Done!")
+    return 0
@@ -1,40 +1,313 @@
+import hashlib
+import json
 import os
 import requests
+import shutil
 import sys
-from .utils import getenv, sh
+import tempfile
+import threading
+from .cache import index_load, lru_evict, lru_touch
+from .meta import explicit_filename, explicit_read
+from .utils import (
+    cache_dir,
+    download,
+    file_hash,
+    file_lock,
+    getenv,
+    runtime_env,
+    sh,
+    sh_stream
+)
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from contextlib import contextmanager
+from glob import glob
+from requests.adapters import HTTPAdapter
 from subprocess import run
 
 
 ENV_ORIG = os.environ.copy()
 
+# Paths, relative to an environment prefix, that influence activation
+ENV_FINGERPRINT_PATHS = [
+    'conda-meta',
+    os.path.join('etc', 'conda', 'activate.d'),
+    os.path.join('etc', 'conda', 'deactivate.d'),
+]
+
+# Default miniconda installation prefix
+INSTALLER_PREFIX = './miniconda3'
+
+# Cloneable environments created from base specs
+TEMPLATE_PREFIX = 'dm_template_'
+TEMPLATE_MAX = 3
+
+# Concurrent package downloads performed before `conda create`
+PREFETCH_JOBS = 8
+
+# Memoized per-environment data: (kind, prefix) -> (key, value)
+_ENV_CACHE = {}
+_ENV_CACHE_LOCK = threading.Lock()
+
 
 class BadPlatform(Exception):
     pass
 
 
-def ei_touch():
-    py_version = sh('python', '--version').stdout.decode().strip().split()[1]
+class CondaEnv:
+    """ Handle to an activated conda environment
+
+    The activated runtime environment is stored on the object instead of
+    replacing `os.environ`, so any number of environments may be driven
+    concurrently. Pass the handle to `sh`, `git`, `conda`, `ei_touch` or
+    `integration_test` via their `env` argument.
+
+    >>> env = CondaEnv('some_env')
+    >>> conda('list', env=env)
+
+    :param name: str: conda environment name
+    :param environ: dict: pre-activated runtime environment (optional)
+    :raises subprocess.CalledProcessError: via `conda_activate`
+    """
+    def __init__(self, name, environ=None):
+        self.name = name
+        if environ is None:
+            environ = conda_activate(name)
+        self.environ = environ
+
+    @property
+    def prefix(self):
+        """ Absolute path to the environment
+        """
+        return self.environ.get('CONDA_PREFIX', '')
+
+    def sh(self, prog, *args, cwd=None):
+        """ Execute a program inside of this environment
+        See `delivery_merge.utils.sh`
+        """
+        return sh(prog, *args, env=self, cwd=cwd)
+
+    def sh_stream(self, prog, *args, **kwargs):
+        """ Execute a program inside of this environment, streaming output
+        See `delivery_merge.utils.sh_stream`
+        """
+        return sh_stream(prog, *args, env=self, **kwargs)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name!r})'
+
+
+def conda_env_handle(conda_env):
+    """ Return an environment handle for `conda_env`
+
+    :param conda_env: str or CondaEnv: conda environment name or handle
+    :returns: CondaEnv
+    """
+    if isinstance(conda_env, CondaEnv):
+        return conda_env
+    return CondaEnv(conda_env)
+
+
+def conda_env_fingerprint(prefix):
+    """ Summarize the state of a conda environment. The fingerprint changes
+    whenever packages are (un)installed or activation scripts are modified.
+
+    :param prefix: str: path to conda environment
+    :returns: str: hex digest
+    """
+    digest = hashlib.sha1()
+    for path in ENV_FINGERPRINT_PATHS:
+        path = os.path.join(prefix, path)
+        if not os.path.isdir(path):
+            continue
+
+        for entry in sorted(os.scandir(path), key=lambda x: x.name):
+            st = entry.stat()
+            digest.update(f'{path}/{entry.name}:{st.st_mtime_ns}:'
+                          f'{st.st_size}\n'.encode())
+
+    return digest.hexdigest()
+
+
+def _conda_env_cached(kind, prefix, key, func):
+    """ Return the memoized result of `func` for a conda environment.
+    Results are discarded automatically when the environment changes.
+
+    :param kind: str: category of cached data
+    :param prefix: str: path to conda environment
+    :param key: hashable: additional data the result depends on
+    :param func: callable: computes the value on a cache miss
+    :returns: value produced by `func`
+    """
+    key = (conda_env_fingerprint(prefix), key)
+    with _ENV_CACHE_LOCK:
+        entry = _ENV_CACHE.get((kind, prefix))
+    if entry is not None and entry[0] == key:
+        return entry[1]
+
+    value = func()
+    with _ENV_CACHE_LOCK:
+        _ENV_CACHE[(kind, prefix)] = (key, value)
+    return value
+
+
+def conda_env_cache_clear():
+    """ Discard all memoized environment data
+    """
+    with _ENV_CACHE_LOCK:
+        _ENV_CACHE.clear()
+
+
+def conda_prefix(env_name, environ=None):
+    """ Determine the installation prefix of a conda environment
+
+    Assume: `conda_init_path` as been called beforehand
+
+    :param env_name: str: conda environment name or path
+    :param environ: dict: runtime environment (default: `os.environ`)
+    :returns: str: path to environment, or None if conda cannot be found
+    """
+    if os.path.sep in env_name:
+        return os.path.abspath(env_name)
+
+    conda_exe = shutil.which('conda', path=runtime_env(environ).get('PATH'))
+    if conda_exe is None:
+        return None
+
+    root = os.path.dirname(os.path.dirname(conda_exe))
+    if env_name in ['base', 'root']:
+        return root
+    return os.path.join(root, 'envs', env_name)
+
+
+def conda_python_prefix(env=None):
+    """ Determine the prefix of the conda environment providing `python`
+
+    :param env: dict or environment handle (see `utils.runtime_env`)
+    :returns: str: path to environment, or None when python is not
+              managed by conda
+    """
+    python = shutil.which('python', path=runtime_env(env).get('PATH'))
+    if python is None:
+        return None
+
+    prefix = os.path.dirname(os.path.dirname(python))
+    if not os.path.isdir(os.path.join(prefix, 'conda-meta')):
+        return None
+    return prefix
+
+
+def _site_packages_from_meta(prefix):
+    """ Derive the site-packages path from the installed python package record
+
+    :param prefix: str: path to conda environment
+    :returns: str: path to site-packages, or None if python is not installed
+    """
+    for filename in glob(os.path.join(prefix, 'conda-meta', 'python-*.json')):
+        with open(filename) as fp:
+            record = json.load(fp)
+
+        if record.get('name') != 'python':
+            continue
+
+        py_version = '.'.join(record['version'].split('.')[:2])
+        return os.path.join(prefix, 'lib', f'python{py_version}',
+                            'site-packages')
+    return None
+
+
+def conda_site_packages(env=None):
+    """ Retrieve the site-packages path of the environment providing `python`.
+    Conda environments are inspected directly and the result is memoized.
+
+    :param env: dict or environment handle (see `utils.runtime_env`)
+    :returns: str: path to site-packages
+    """
+    prefix = conda_python_prefix(env)
+    if prefix is not None:
+        site_packages = _conda_env_cached(
+            'site-packages', prefix, None,
+            lambda: _site_packages_from_meta(prefix))
+        if site_packages is not None:
+            return site_packages
+
+    py_version = sh('python', '--version',
+                    env=env).stdout.decode().strip().split()[1]
     py_version = '.'.join(py_version.split('.')[:2])
     root = run("python -c 'import sys; print(sys.prefix)'",
                capture_output=True,
                shell=True,
-               env=os.environ).stdout.decode().strip()
+               env=runtime_env(env)).stdout.decode().strip()
     libsp = ['lib', f'python{py_version}', 'site-packages']
-    site_packages = os.path.join(root, *libsp)
+    return os.path.join(root, *libsp)
+
+
+def ei_touch(env=None):
+    """ Create an empty easy-install.pth in the environment's site-packages
+
+    :param env: dict or environment handle (see `utils.runtime_env`)
+    """
+    site_packages = conda_site_packages(env)
     pthfile = os.path.join(site_packages, 'easy-install.pth')
 
     if not os.path.exists(pthfile):
         open(pthfile, 'w+').write('')
 
 
-def conda_installer(ver, prefix='./miniconda3'):
+def installer_fetch(url, sha256=None, cache_root=None):
+    """ Retrieve an installer from the shared installer cache, downloading
+    it when necessary. Cached installers are stored as
+    `{cache_root}/{sha256}/{installer}` and the digest of the most recent
+    verified download is recorded in `{cache_root}/{installer}.sha256`.
+    The installer is always verified before its path is returned.
+
+    :param url: str: URL of installer
+    :param sha256: str: expected digest of installer (optional)
+    :param cache_root: str: path to installer cache
+                       (default: `utils.cache_dir('installers')`)
+    :returns: str: absolute path to verified installer
+    :raises delivery_merge.utils.ChecksumMismatch: when verification fails
+    """
+    cache_root = cache_root or cache_dir('installers')
+    os.makedirs(cache_root, exist_ok=True)
+    installer = os.path.basename(url)
+    index = os.path.join(cache_root, installer + '.sha256')
+
+    with file_lock(os.path.join(cache_root, installer + '.lock')):
+        digest = sha256
+        if digest is None and os.path.exists(index):
+            digest = open(index).read().strip()
+
+        if digest:
+            cached = os.path.join(cache_root, digest, installer)
+            if os.path.exists(cached) and file_hash(cached) == digest:
+                return cached
+
+        # Interrupted downloads are resumed from `{installer}.part`
+        staging = os.path.join(cache_root, installer)
+        download(url, staging, digest=sha256)
+        digest = sha256 or file_hash(staging)
+
+        cached = os.path.join(cache_root, digest, installer)
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        os.chmod(staging, 0o755)
+        os.replace(staging, cached)
+
+        with open(index + '.tmp', 'w') as fp:
+            fp.write(digest + '\n')
+        os.replace(index + '.tmp', index)
+
+    return cached
+
+
+def conda_installer(ver, prefix=INSTALLER_PREFIX, sha256=None):
     """ Install miniconda into a user-defined prefix and return its path
 
     :param ver: str: miniconda version (not conda version)
     :param prefix: str: path to install miniconda into
+    :param sha256: str: expected digest of the installer (optional)
     :returns: str: absolute path to installation prefix
     :raises delivery_merge.conda.BadPlatform: when platform check fails
+    :raises delivery_merge.utils.ChecksumMismatch: when verification fails
     :raises subprocess.CalledProcessError: via check_returncode method
     """
     assert isinstance(ver, str)
@@ -63,15 +336,10 @@ def conda_installer(ver, prefix='./miniconda3'):
     url_root = 'https://repo.continuum.io/miniconda'
     installer = f'{name}-{version}-{platform}-{arch}.sh'
     url = f'{url_root}/{installer}'
-    install_command = f'./{installer} -b -p {prefix}'.split()
 
-    # Download installer
-    if not os.path.exists(installer):
-        with requests.get(url, stream=True) as data:
-            with open(installer, 'wb') as fd:
-                for chunk in data.iter_content(chunk_size=16384):
-                    fd.write(chunk)
-        os.chmod(installer, 0o755)
+    # Download installer (or reuse a verified copy)
+    installer = installer_fetch(url, sha256)
+    install_command = [installer, '-b', '-p', prefix]
 
     # Perform installation
     run(install_command, env=os.environ).check_returncode()
@@ -93,33 +361,62 @@ def conda_init_path(prefix):
                                    os.environ['PATH']])
 
 
-def conda_site():
+def conda_site(env=None):
     """ Retrieve current environment's site-packages path
+
+    :param env: dict or environment handle (see `utils.runtime_env`)
     """
     result = run("python -c 'import site; print(site.getsitepackages()[-1])'",
                  capture_output=True,
                  shell=True,
-                 env=os.environ)
+                 env=runtime_env(env))
     result.check_returncode()
     return result.stdout.decode().strip()
 
 
-def conda_activate(env_name):
-    """ Activate a conda environment
+def _conda_activate_shell(env_name, environ=None):
+    """ Activate a conda environment using a shell
 
-    Assume: `conda_init_path` as been called beforehand
     Warning: Arbitrary code execution is possible here due to `shell` usage.
 
     :param env_name: str: conda environment to activate
+    :param environ: dict: runtime environment to activate from
     :returns: dict: new runtime environment
     :raises subprocess.CalledProcessError: via check_returncode method
     """
     proc = run(f". activate {env_name} && env",
                capture_output=True,
                shell=True,
-               env=os.environ)
+               env=runtime_env(environ))
     proc.check_returncode()
-    return getenv(proc.stdout.decode()).copy()
+    return getenv(proc.stdout.decode())
+
+
+def conda_activate(env_name, environ=None):
+    """ Activate a conda environment
+
+    The result is memoized per environment prefix and calling environment.
+    It is recomputed automatically when the environment's packages or
+    activation scripts change (see `conda_env_fingerprint`).
+
+    Assume: `conda_init_path` as been called beforehand
+    Warning: Arbitrary code execution is possible here due to `shell` usage.
+
+    :param env_name: str: conda environment to activate
+    :param environ: dict: runtime environment to activate from
+                    (default: `os.environ`)
+    :returns: dict: new runtime environment
+    :raises subprocess.CalledProcessError: via check_returncode method
+    """
+    prefix = conda_prefix(env_name, environ)
+    if prefix is None or not os.path.isdir(prefix):
+        return _conda_activate_shell(env_name, environ).copy()
+
+    origin = frozenset(runtime_env(environ).items())
+    result = _conda_env_cached(
+        'activate', prefix, (env_name, origin),
+        lambda: _conda_activate_shell(env_name, environ))
+    return result.copy()
 
 
 @contextmanager
@@ -127,26 +424,32 @@ def conda_env_load(env_name):
     """ A simple wrapper for `conda_activate`
     The current runtime environment is replaced and restored
 
-    >>> with conda_env_load('some_env') as _:
+    Note: This modifies process-wide state. Prefer passing a `CondaEnv`
+    handle to functions accepting an `env` argument.
+
+    >>> with conda_env_load('some_env') as env:
     >>>     # do something
 
-    :param env_name: str: conda environment to activate
-    :returns: None
+    :param env_name: str or CondaEnv: conda environment to activate
+    :returns: CondaEnv
     """
+    handle = conda_env_handle(env_name)
     last = os.environ.copy()
-    os.environ = conda_activate(env_name)
+    os.environ = handle.environ.copy()
     try:
-        yield
+        yield handle
     finally:
         os.environ = last.copy()
 
 
-def conda(*args):
+def conda(*args, env=None, cwd=None):
     """ Execute conda shell commands
 
+    :param env: dict or environment handle (see `utils.runtime_env`)
+    :param cwd: str: working directory
     :returns: subprocess.CompletedProcess object
     """
-    return sh('conda', *args)
+    return sh('conda', *args, env=env, cwd=cwd)
 
 
 def conda_cmd_channels(conda_channels, override=True):
@@ -160,3 +463,301 @@ def conda_cmd_channels(conda_channels, override=True):
         channels_result += f'-c {channel} '
 
     return channels_result
+
+
+@contextmanager
+def conda_pkgs_lock():
+    """ Serialize writes to the package cache (pkgs/) shared by every
+    environment of a conda installation. Applies to threads and processes.
+
+    Assume: `conda_init_path` as been called beforehand
+    """
+    pkgs = os.path.join(conda_prefix('base'), 'pkgs')
+    os.makedirs(pkgs, exist_ok=True)
+    with file_lock(os.path.join(pkgs, '.dm_lock')):
+        yield
+
+
+def _explicit_digest(url):
+    """ Extract the checksum carried by an explicit URL's fragment
+    (`#<md5>` or `#sha256:<sha256>`)
+
+    :param url: str: package URL
+    :returns: tuple: (hex digest, hashlib algorithm name), or (None, None)
+    """
+    if '#' not in url:
+        return None, None
+
+    fragment = url.split('#', 1)[1]
+    if fragment.startswith('sha256:'):
+        return fragment[7:], 'sha256'
+    if len(fragment) == 32:
+        return fragment, 'md5'
+    return None, None
+
+
+def conda_pkgs_prefetch(base_spec, pkgs_dir=None, jobs=PREFETCH_JOBS,
+                        session=None):
+    """ Download the packages listed in an @EXPLICIT spec file into the
+    package cache, so `conda create --file` only has to extract and link
+    them. Packages already cached (as a verified tarball or an extracted
+    directory) are skipped. Downloads share a pool of `jobs` connections.
+    Failures are reported, not raised, since conda downloads whatever is
+    missing itself.
+
+    Assume: `conda_init_path` as been called beforehand (unless `pkgs_dir`
+    is given), and `conda_pkgs_lock` is held
+
+    :param base_spec: str: path to spec file (i.e. @EXPLICIT dump)
+    :param pkgs_dir: str: path to package cache
+                     (default: `pkgs` in the base environment)
+    :param jobs: int: number of concurrent downloads
+    :param session: requests.Session: connection pool to use (optional)
+    :returns: list: file names downloaded successfully
+    """
+    pkgs_dir = pkgs_dir or os.path.join(conda_prefix('base'), 'pkgs')
+    os.makedirs(pkgs_dir, exist_ok=True)
+    jobs = max(1, jobs)
+
+    pending = []
+    for url in explicit_read(base_spec):
+        if not url.startswith(('http://', 'https://')):
+            continue
+
+        filename = explicit_filename(url)
+        dest = os.path.join(pkgs_dir, filename)
+        stem = filename
+        for ext in ['.tar.bz2', '.conda']:
+            if stem.endswith(ext):
+                stem = stem[:-len(ext)]
+        extracted = os.path.join(pkgs_dir, stem, 'info', 'index.json')
+        digest, algo = _explicit_digest(url)
+        if os.path.exists(extracted):
+            continue
+        if os.path.exists(dest) \
+                and (digest is None or file_hash(dest, algo) == digest):
+            continue
+        pending.append((url.split('#', 1)[0], dest, digest, algo))
+
+    if not pending:
+        return []
+
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+    print(f"Prefetching {len(pending)} package(s)...")
+    result = []
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(download, url, dest, digest=digest,
+                               algo=algo or 'md5', session=session): url
+                   for url, dest, digest, algo in pending}
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                future.result()
+                result.append(explicit_filename(url))
+            except Exception as e:
+                print(f"Prefetch failed: {url}: {e}", file=sys.stderr)
+
+    # conda associates cached tarballs with their source via urls.txt
+    if result:
+        with open(os.path.join(pkgs_dir, 'urls.txt'), 'a') as fp:
+            for url, _, _, _ in pending:
+                if explicit_filename(url) in result:
+                    fp.write(url + '\n')
+
+    return sorted(result)
+
+
+def _solution_urls(actions, pkgs_dir):
+    """ Determine the URL of each package a transaction links. conda only
+    reports the URL of packages it must download (FETCH); the others are
+    read from their extracted directory in the package cache.
+
+    :param actions: dict: `actions` reported by `conda install --json`
+    :param pkgs_dir: str: path to package cache
+    :returns: list: package URLs (with an #md5 fragment when known)
+    """
+    fetch = {(x['name'], x['version'], x['build']): x
+             for x in actions.get('FETCH', [])}
+
+    result = []
+    for record in actions.get('LINK', []):
+        dist = record['dist_name']
+        data = fetch.get((record['name'], record['version'],
+                          record['build_string']))
+        if data is None:
+            data = index_load(os.path.join(pkgs_dir, dist, 'info',
+                                           'repodata_record.json'))
+        url = data.get('url') or \
+            f"{record['base_url']}/{record['platform']}/{dist}.tar.bz2"
+        if data.get('md5'):
+            url += '#' + data['md5']
+        result.append(url)
+    return result
+
+
+def conda_install_solved(env_name, *args, env=None, pkgs_dir=None):
+    """ Execute `conda install`, invoking the solver only once. The solution
+    is computed with `--dry-run`. Its packages are downloaded while holding
+    `conda_pkgs_lock` (see `conda_pkgs_prefetch`), and then installed from
+    an @EXPLICIT spec, which conda links without solving again. Concurrent
+    builds therefore only take turns while downloading.
+
+    Assume: `conda_init_path` as been called beforehand (unless `pkgs_dir`
+    is given)
+
+    :param env_name: str: conda environment name
+    :param args: arguments passed to `conda install` (channels, packages)
+    :param env: dict or environment handle (see `utils.runtime_env`)
+    :param pkgs_dir: str: path to package cache
+                     (default: `pkgs` in the base environment)
+    :returns: subprocess.CompletedProcess object of the step that failed,
+              or of the last step
+    """
+    pkgs_dir = pkgs_dir or os.path.join(conda_prefix('base'), 'pkgs')
+    proc = conda('install', '-q', '--dry-run', '--json', '-n', env_name,
+                 *args, env=env)
+    try:
+        actions = json.loads(proc.stdout.decode()).get('actions')
+    except ValueError:
+        actions = None
+    if proc.returncode or not actions:
+        # Errors are reported as JSON on stdout
+        if proc.returncode:
+            print(proc.stdout.decode(), file=sys.stderr)
+        return proc
+
+    linked = set([x['name'] for x in actions.get('LINK', [])])
+    removed = sorted(set([x['name'] for x in actions.get('UNLINK', [])])
+                     - linked)
+    fd, spec = tempfile.mkstemp(prefix='dm_solution_', suffix='.txt')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('@EXPLICIT\n')
+            for url in _solution_urls(actions, pkgs_dir):
+                fp.write(url + '\n')
+
+        with conda_pkgs_lock():
+            conda_pkgs_prefetch(spec, pkgs_dir=pkgs_dir)
+
+        # Packages replaced by another build are unlinked by the explicit
+        # install. Those removed outright are not.
+        if removed:
+            proc = conda('remove', '-q', '-y', '--force', '--offline',
+                         '-n', env_name, ' '.join(removed), env=env)
+            if proc.returncode:
+                return proc
+
+        if linked:
+            proc = conda('install', '-q', '-y', '-n', env_name,
+                         '--file', spec, env=env)
+    finally:
+        os.remove(spec)
+    return proc
+
+
+def template_key(base_spec, channels=None):
+    """ Compute the template cache key of a base specification
+
+    :param base_spec: str: path to spec file (i.e. @EXPLICIT dump)
+    :param channels: list: channel URLs
+    :returns: str: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(base_spec, 'rb') as fp:
+        digest.update(fp.read())
+    for channel in channels or []:
+        digest.update(f'\n{channel}'.encode())
+    return digest.hexdigest()
+
+
+def conda_env_create(env_name, base_spec, channels=None,
+                     max_templates=TEMPLATE_MAX, prefetch_jobs=PREFETCH_JOBS):
+    """ Create a conda environment from a spec file.
+
+    The first time a spec file (and channel list) is seen, a template
+    environment is created from it. The requested environment is then
+    cloned from the template, which hard-links packages rather than
+    extracting and linking them again. At most `max_templates` templates
+    are retained. The least recently used templates are removed first.
+    Packages are downloaded concurrently (see `conda_pkgs_prefetch`) before
+    conda is executed. Only the downloads are serialized: builds sharing a
+    template clone it at the same time, and builds using different
+    templates create them at the same time.
+
+    Assume: `conda_init_path` as been called beforehand
+
+    :param env_name: str: conda environment name
+    :param base_spec: str: path to spec file (i.e. @EXPLICIT dump)
+    :param channels: list: channel URLs
+    :param max_templates: int: templates to retain (0 disables templates)
+    :param prefetch_jobs: int: number of concurrent package downloads
+    :returns: None
+    :raises subprocess.CalledProcessError: via check_returncode method
+    """
+    channel_args = conda_cmd_channels(channels) if channels else ''
+
+    if max_templates < 1:
+        with conda_pkgs_lock():
+            conda_pkgs_prefetch(base_spec, jobs=prefetch_jobs)
+        proc = conda('create', '-q', '-y', '-n', env_name, channel_args,
+                     '--file', base_spec)
+        if proc.stderr:
+            print(proc.stderr.decode())
+        proc.check_returncode()
+        return
+
+    envs = os.path.join(conda_prefix('base'), 'envs')
+    os.makedirs(envs, exist_ok=True)
+    index = os.path.join(envs, '.dm_templates.json')
+    template = TEMPLATE_PREFIX + template_key(base_spec, channels)[:16]
+
+    # The index is locked by each update. Each template has a lock of its
+    # own: exclusive to create or remove the template, shared to clone it.
+    lru_touch(index, template, base_spec=os.path.abspath(base_spec))
+    stale = [x for x, _ in lru_evict(index, max_entries=max_templates,
+                                     protect=[template])]
+
+    # A template is complete once its marker exists. conda writes
+    # conda-meta before linking anything, so a failed or interrupted create
+    # must not be mistaken for a usable template.
+    for name in stale:
+        with file_lock(os.path.join(envs, f'.{name}.lock')):
+            print(f"Removing stale template environment {name}...")
+            ready = os.path.join(envs, f'.{name}.ready')
+            if os.path.exists(ready):
+                os.remove(ready)
+            conda('remove', '-q', '-y', '--all', '-n', name)
+
+    template_lock = os.path.join(envs, f'.{template}.lock')
+    template_ready = os.path.join(envs, f'.{template}.ready')
+    template_prefix = os.path.join(envs, template)
+    while True:
+        with file_lock(template_lock, shared=True):
+            if os.path.exists(template_ready):
+                proc = conda('create', '-q', '-y', '--offline',
+                             '-n', env_name, '--clone', template)
+                break
+
+        with file_lock(template_lock):
+            if not os.path.exists(template_ready):
+                print(f"Creating template environment {template}...")
+                shutil.rmtree(template_prefix, ignore_errors=True)
+                with conda_pkgs_lock():
+                    conda_pkgs_prefetch(base_spec, jobs=prefetch_jobs)
+                proc = conda('create', '-q', '-y', '-n', template,
+                             channel_args, '--file', base_spec)
+                if proc.stderr:
+                    print(proc.stderr.decode())
+                if proc.returncode:
+                    shutil.rmtree(template_prefix, ignore_errors=True)
+                proc.check_returncode()
+                open(template_ready, 'w').close()
+
+    if proc.stderr:
+        print(proc.stderr.decode())
+    proc.check_returncode()
@@ -0,0 +1,276 @@
+import heapq
+import os
+import shutil
+import threading
+from xml.etree import ElementTree
+from xml.sax.saxutils import quoteattr
+from .cache import index_save
+
+
+JUNIT_COUNTS = ['tests', 'failures', 'errors', 'skipped']
+# Number of slowest test cases listed by the delivery test summary
+JUNIT_SLOWEST = 20
+
+
+def junit_iter(filename):
+    """ Read a junit XML report incrementally. Each <testcase> is discarded
+    once it has been consumed, so memory use does not grow with the size of
+    the report.
+
+    :param filename: str: path to XML report
+    :returns: generator: of ('testsuite', attributes dict) and
+              ('testcase', ElementTree.Element) tuples, in document order
+    :raises xml.etree.ElementTree.ParseError: when the report is malformed
+    """
+    parents = []
+    for event, elem in ElementTree.iterparse(filename,
+                                             events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'testsuite':
+                yield 'testsuite', dict(elem.attrib)
+            parents.append(elem)
+            continue
+
+        parents.pop()
+        if elem.tag == 'testcase':
+            yield 'testcase', elem
+            if parents:
+                parents[-1].remove(elem)
+
+
+def junit_outcome(case):
+    """ Determine the outcome of a test case
+    :param case: ElementTree.Element: <testcase>
+    :returns: str: "passed", "failed", "error" or "skipped"
+    """
+    for tag, outcome in [('error', 'error'), ('failure', 'failed'),
+                         ('skipped', 'skipped')]:
+        if case.find(tag) is not None:
+            return outcome
+    return 'passed'
+
+
+def junit_summary(filename):
+    """ Summarize a junit XML report. Reports with a <testsuites> root are
+    summed over each <testsuite>.
+
+    :param filename: str: path to XML report
+    :returns: dict: tests, failures, errors, skipped (int) and time (float)
+    """
+    result = {x: 0 for x in JUNIT_COUNTS}
+    result['time'] = 0.0
+    for kind, data in junit_iter(filename):
+        if kind != 'testsuite':
+            continue
+        for count in JUNIT_COUNTS:
+            result[count] += int(data.get(count, 0))
+        result['time'] += float(data.get('time', 0))
+
+    result['time'] = round(result['time'], 3)
+    return result
+
+
+def junit_times(filename):
+    """ Total the durations of the test cases in a junit XML report by
+    class name (i.e. the dotted module path, plus any test class)
+
+    :param filename: str: path to XML report
+    :returns: dict: class name -> seconds
+    """
+    result = dict()
+    for kind, case in junit_iter(filename):
+        if kind != 'testcase':
+            continue
+        classname = case.get('classname', '')
+        result[classname] = result.get(classname, 0.0) \
+            + float(case.get('time', 0))
+    return result
+
+
+def _testsuite_open(name, totals, **attrs):
+    """ Format the start tag of a <testsuite>
+    :param name: str: suite name
+    :param totals: dict: counts and time
+    :param attrs: additional attributes
+    :returns: str
+    """
+    attrs = dict(attrs, name=name)
+    attrs.update({x: totals[x] for x in JUNIT_COUNTS + ['time']})
+    return '<testsuite {}>\n'.format(
+        ' '.join(f'{k}={quoteattr(str(v))}' for k, v in sorted(attrs.items())))
+
+
+def junit_merge(filenames, output, name='pytest'):
+    """ Combine junit XML reports into a single <testsuite>. Counts and
+    times are summed. Missing reports are ignored. Reports are read
+    incrementally (see `junit_iter`).
+
+    :param filenames: list: paths to XML reports
+    :param output: str: path to combined XML report
+    :param name: str: name of the combined test suite
+    :returns: dict: summary of the combined report (see `junit_summary`)
+    """
+    totals = {x: 0 for x in JUNIT_COUNTS}
+    totals['time'] = 0.0
+    attrs = dict()
+
+    # Totals are only known at the end, so test cases are staged separately
+    body = f'{output}.{os.getpid()}.tmp'
+    with open(body, 'wb') as fp:
+        for filename in filenames:
+            if not os.path.exists(filename):
+                continue
+            for kind, data in junit_iter(filename):
+                if kind == 'testcase':
+                    fp.write(ElementTree.tostring(data))
+                    continue
+                for count in JUNIT_COUNTS:
+                    totals[count] += int(data.get(count, 0))
+                totals['time'] += float(data.get('time', 0))
+                for key in ['hostname', 'timestamp']:
+                    if data.get(key) and key not in attrs:
+                        attrs[key] = data[key]
+
+    totals['time'] = round(totals['time'], 3)
+    try:
+        with open(output, 'wb') as fp:
+            fp.write(b"<?xml version='1.0' encoding='utf-8'?>\n<testsuites>")
+            fp.write(_testsuite_open(name, totals, **attrs).encode())
+            with open(body, 'rb') as data:
+                shutil.copyfileobj(data, fp)
+            fp.write(b'</testsuite></testsuites>\n')
+    finally:
+        os.remove(body)
+    return totals
+
+
+class JunitReport:
+    """ Aggregate the junit XML reports of many packages into one xunit2
+    report (a <testsuite> per package) and a JSON summary. Both files are
+    rewritten each time a package is added, so they are usable while
+    testing is still in progress. Reports are read incrementally (see
+    `junit_iter`); only the totals and the slowest test cases are kept in
+    memory.
+
+    >>> report = JunitReport('results.xml', 'results.json')
+    >>> report.add('relic', 'results/relic/result.xml')
+
+    :param output: str: path to merged XML report
+    :param summary: str: path to JSON summary
+    :param slowest: int: number of slowest test cases to list
+    """
+    def __init__(self, output, summary, slowest=JUNIT_SLOWEST):
+        self.output = output
+        self.summary = summary
+        self.slowest = slowest
+        # Test cases of each package, as XML fragments
+        self.fragments = f'{output}.d'
+        self.packages = dict()
+        self.cases = []
+        self.lock = threading.Lock()
+
+    def _scan(self, package, filename, fp):
+        """ Copy the test cases of a report to `fp`, counting outcomes.
+        A truncated report (e.g. pytest was killed) contributes the test
+        cases preceding the damage.
+        :returns: dict: counts and time
+        """
+        totals = dict(tests=0, passed=0, failures=0, errors=0, skipped=0,
+                      time=0.0)
+        outcomes = dict(failed='failures', error='errors',
+                        skipped='skipped', passed='passed')
+        try:
+            for kind, case in junit_iter(filename):
+                if kind != 'testcase':
+                    continue
+                seconds = float(case.get('time', 0))
+                totals['tests'] += 1
+                totals[outcomes[junit_outcome(case)]] += 1
+                totals['time'] += seconds
+
+                test = '::'.join(x for x in [case.get('classname'),
+                                             case.get('name')] if x)
+                entry = (seconds, package, test)
+                if len(self.cases) < self.slowest:
+                    heapq.heappush(self.cases, entry)
+                elif entry > self.cases[0]:
+                    heapq.heapreplace(self.cases, entry)
+
+                case.tail = '\n'
+                fp.write(ElementTree.tostring(case))
+        except ElementTree.ParseError as e:
+            print(f"Incomplete junit report: {filename}: {e}")
+
+        totals['time'] = round(totals['time'], 3)
+        return totals
+
+    def add(self, package, filename=None, status=None):
+        """ Add (or replace) the results of a package, and rewrite the
+        merged report and summary
+
+        :param package: str: package name
+        :param filename: str: path to the package's XML report (None or a
+                         missing file: no test cases)
+        :param status: str: outcome to record (default: "passed" when no
+                       test failed, otherwise "failed")
+        :returns: dict: the package's summary
+        """
+        with self.lock:
+            os.makedirs(self.fragments, exist_ok=True)
+            fragment = os.path.join(self.fragments, f'{package}.xml')
+            self.cases = [x for x in self.cases if x[1] != package]
+            heapq.heapify(self.cases)
+
+            totals = dict(tests=0, passed=0, failures=0, errors=0, skipped=0,
+                          time=0.0)
+            with open(fragment + '.tmp', 'wb') as fp:
+                if filename and os.path.exists(filename):
+                    totals = self._scan(package, filename, fp)
+            os.replace(fragment + '.tmp', fragment)
+
+            if status is None:
+                status = 'failed' if totals['failures'] \
+                    or totals['errors'] else 'passed'
+            totals['status'] = status
+            self.packages[package] = totals
+            self.write()
+            return totals
+
+    def totals(self):
+        """ :returns: dict: counts and time summed over all packages
+        """
+        result = dict(packages=len(self.packages), tests=0, passed=0,
+                      failures=0, errors=0, skipped=0, time=0.0)
+        for totals in self.packages.values():
+            for key in result:
+                if key in totals:
+                    result[key] += totals[key]
+        result['time'] = round(result['time'], 3)
+        return result
+
+    def write(self):
+        """ Rewrite the merged XML report and JSON summary from the packages
+        added so far
+        """
+        totals = self.totals()
+        tmp = f'{self.output}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+            fp.write('<testsuites {}>\n'.format(' '.join(
+                f'{x}={quoteattr(str(totals[x]))}'
+                for x in JUNIT_COUNTS + ['time'])).encode())
+            for package in sorted(self.packages):
+                fp.write(_testsuite_open(package,
+                                         self.packages[package]).encode())
+                with open(os.path.join(self.fragments, f'{package}.xml'),
+                          'rb') as data:
+                    shutil.copyfileobj(data, fp)
+                fp.write(b'</testsuite>\n')
+            fp.write(b'</testsuites>\n')
+        os.replace(tmp, self.output)
+
+        slowest = [dict(package=package, test=test, time=seconds)
+                   for seconds, package, test in sorted(self.cases,
+                                                        reverse=True)]
+        index_save(self.summary, dict(totals=totals, packages=self.packages,
+                                      slowest=slowest))
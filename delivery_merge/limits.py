@@ -0,0 +1,230 @@
+import os
+import resource
+import signal
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# Limits applied to subprocesses started in the current context
+_LIMITS = ContextVar('delivery_merge_limits', default=None)
+
+# Seconds between resource checks of running subprocesses
+LIMITS_INTERVAL = 0.5
+# Seconds between SIGTERM and SIGKILL when a limit is exceeded
+LIMITS_GRACE = 5.0
+
+
+class ResourceLimitExceeded(Exception):
+    """ A unit of work exceeded its time or memory allowance
+
+    :param reason: str: "timeout" or "memory"
+    :param message: str: description
+    """
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+class Limits:
+    """ Time and memory allowance shared by every subprocess started within
+    `resource_limits`
+
+    :param timeout: float: seconds until subprocesses are killed
+    :param max_rss: int: bytes of resident memory the subprocesses may use
+                    (combined)
+    """
+    def __init__(self, timeout=None, max_rss=None):
+        self.timeout = timeout
+        self.deadline = None
+        if timeout:
+            self.deadline = time.monotonic() + timeout
+        self.max_rss = max_rss
+        self.peak_rss = 0
+        self.exceeded = None
+        self.pgids = set()
+        self.lock = threading.Lock()
+
+    def check(self):
+        """ :raises ResourceLimitExceeded: when a limit was exceeded
+        """
+        if self.exceeded is None and self.deadline is not None \
+                and time.monotonic() > self.deadline:
+            self.exceeded = 'timeout'
+
+        if self.exceeded == 'timeout':
+            raise ResourceLimitExceeded(
+                'timeout', f'exceeded time limit of {self.timeout}s')
+        if self.exceeded == 'memory':
+            raise ResourceLimitExceeded(
+                'memory', f'exceeded memory limit of '
+                          f'{self.max_rss // (1 << 20)}MB')
+
+    def violation(self):
+        """ Sample the running subprocesses
+        :returns: str: "timeout" or "memory" when a limit is exceeded
+        """
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            return 'timeout'
+
+        if self.max_rss is not None:
+            with self.lock:
+                pgids = set(self.pgids)
+            rss = process_group_rss(pgids)
+            self.peak_rss = max(self.peak_rss, rss)
+            if rss > self.max_rss:
+                return 'memory'
+        return None
+
+    def kill(self, reason):
+        """ Terminate every running subprocess
+        :param reason: str: limit that was exceeded
+        """
+        with self.lock:
+            if self.exceeded is None:
+                self.exceeded = reason
+            pgids = set(self.pgids)
+
+        _killpg(pgids, signal.SIGTERM)
+        deadline = time.monotonic() + LIMITS_GRACE
+        while pgids and time.monotonic() < deadline:
+            time.sleep(0.1)
+            pgids = _killpg(pgids, 0)
+        _killpg(pgids, signal.SIGKILL)
+
+
+def _killpg(pgids, sig):
+    """ Signal process groups
+    :returns: set: process groups that still exist
+    """
+    result = set()
+    for pgid in pgids:
+        try:
+            os.killpg(pgid, sig)
+            result.add(pgid)
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            result.add(pgid)
+    return result
+
+
+@contextmanager
+def resource_limits(timeout=None, max_rss=None):
+    """ Limit the wall time and resident memory of subprocesses started
+    (via `utils.sh` or `utils.sh_stream`) within the block. Each subprocess
+    runs in its own process group, so children it spawns are terminated with
+    it. Commands started after a limit was exceeded are not executed.
+
+    >>> with resource_limits(timeout=3600, max_rss=4 << 30):
+    >>>     sh_stream('python', '-m pytest')
+
+    :param timeout: float: seconds (None: unlimited)
+    :param max_rss: int: bytes (None: unlimited)
+    :returns: Limits
+    """
+    limits = Limits(timeout, max_rss)
+    token = _LIMITS.set(limits)
+    try:
+        yield limits
+    finally:
+        _LIMITS.reset(token)
+
+
+def limits_current():
+    """ :returns: Limits: active limits, or None
+    """
+    return _LIMITS.get()
+
+
+def limits_watch(pid, limits, done):
+    """ Enforce `limits` until `done` is set. The process must lead its own
+    process group (i.e. started with `start_new_session=True`).
+
+    :param pid: int: process ID
+    :param limits: Limits
+    :param done: threading.Event: set once the process has been reaped
+    :returns: threading.Thread: watchdog
+    """
+    with limits.lock:
+        limits.pgids.add(pid)
+
+    if hasattr(resource, 'prlimit'):
+        # Processes killed for exceeding a limit must not dump core
+        try:
+            resource.prlimit(pid, resource.RLIMIT_CORE, (0, 0))
+        except OSError:
+            pass
+
+    def watch():
+        while not done.wait(LIMITS_INTERVAL):
+            reason = limits.violation()
+            if reason is not None:
+                limits.kill(reason)
+                break
+
+        with limits.lock:
+            limits.pgids.discard(pid)
+
+    thread = threading.Thread(target=watch, daemon=True)
+    thread.start()
+    return thread
+
+
+def process_group_rss(pgids):
+    """ Sum the resident memory of every process in the given process groups
+    (Linux only. Returns 0 elsewhere.)
+
+    :param pgids: set: process group IDs
+    :returns: int: bytes
+    """
+    if not pgids or not os.path.isdir('/proc'):
+        return 0
+
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f'/proc/{pid}/stat') as fp:
+                # Fields following the command name, which may contain spaces
+                fields = fp.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        # fields[2]: process group, fields[21]: resident pages
+        if int(fields[2]) in pgids:
+            total += int(fields[21]) * page_size
+    return total
+
+
+def memory_available():
+    """ Memory available to new processes without swapping (Linux only)
+    :returns: int: bytes, or None when unknown
+    """
+    try:
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def limits_admit(running, cpus=1, memory=0):
+    """ Decide whether another unit of work may start, given the CPUs and
+    memory available. Work is always admitted when nothing is running.
+
+    :param running: int: units of work in progress
+    :param cpus: int: CPUs occupied by each unit
+    :param memory: int: bytes the new unit is expected to need
+    :returns: bool
+    """
+    if not running:
+        return True
+    if (running + 1) * cpus > (os.cpu_count() or 1):
+        return False
+    available = memory_available()
+    return available is None or available >= memory
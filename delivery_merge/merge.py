@@ -1,18 +1,71 @@
+import hashlib
+import multiprocessing
 import os
 import re
+import shutil
 import sys
-from .conda import conda, conda_env_load, conda_cmd_channels, ei_touch
-from .utils import comment_find, git, pushd, sh
+import traceback
+from .conda import (
+    conda,
+    conda_cmd_channels,
+    conda_env_handle,
+    conda_install_solved,
+    conda_pkgs_lock,
+    conda_pkgs_prefetch,
+    ei_touch
+)
+from .cache import index_load, lru_evict, lru_touch
+from .meta import (
+    conda_meta,
+    conda_subdir,
+    explicit_filename,
+    explicit_read,
+    export_explicit,
+    version_match
+)
+from .junit import junit_merge, junit_summary
+from .limits import ResourceLimitExceeded, limits_admit, resource_limits
+from .mirror import mirror_checkout, mirror_update
+from .pkgs import pkg_git_info, pkgs_index, pkgs_index_save, pkgs_lookup
+from .repodata import repodata_index, repodata_unsatisfiable
+from .shard import (
+    PYTEST_OK,
+    shard_balance,
+    shard_collect,
+    shard_durations,
+    shard_history_file,
+    shard_history_update
+)
+from .timing import usage_collect
+from .utils import cache_dir, comment_find
+from .wheelhouse import TEST_TOOLS, wheelhouse_install, wheelhouse_key
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait
+)
 from configparser import ConfigParser
-from glob import glob
+from contextlib import redirect_stderr, redirect_stdout
+from contextvars import copy_context
 from ruamel.yaml import YAML
 
 
-DMFILE_RE = re.compile(r'^(?P<name>[A-z\-_l]+)(?:[=<>\!]+)?(?P<version>[A-z0-9. ]+)?')   # noqa
+DMFILE_RE = re.compile(r'^(?P<name>[A-z\-_l]+)(?P<operator>[=<>\!]+)?(?P<version>[A-z0-9. ]+)?')   # noqa
 DMFILE_INVALID_VERSION_RE = re.compile(r'[\ \!\@\#\$\%\^\&\*\(\)\-_]+')
 DELIVERY_NAME_RE = re.compile(r'(?P<name>.*)[-_](?P<version>.*)[-_]py(?P<python_version>\d+)[-_.](?P<iteration>\d+)[-_.](?P<ext>.*)')  # noqa
 
 
+SOLUTION_MAX = 100
+RESULT_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+RESULT_CACHE_MAX_SIZE = 1 << 30
+# Memory assumed to be needed by a package's tests when no limit is given
+TEST_MEMORY_RESERVE = 1 << 30
+# Seconds between admissions of package test runs
+TEST_SCHEDULE_INTERVAL = 1.0
+
+
 class EmptyPackageSpec(Exception):
     pass
 
@@ -21,6 +74,10 @@ class InvalidPackageSpec(Exception):
     pass
 
 
+class UnsatisfiablePackageSpec(Exception):
+    pass
+
+
 def dmfile(filename):
     """ Return the contents of a file without comments
 
@@ -58,35 +115,206 @@ def dmfile(filename):
     return result
 
 
-def env_combine(filename, conda_env, conda_channels=[]):
+def dmfile_diff(records, prefix):
+    """ Compare `dmfile` records against the packages installed in a conda
+    environment. Records that cannot be evaluated locally (i.e. those
+    carrying a build string) are always reported as unsatisfied.
+
+    :param records: list: data returned by `dmfile` method
+    :param prefix: str: path to conda environment
+    :returns: tuple: (satisfied, unsatisfied) lists of
+              (record, installed version or None) tuples
+    """
+    installed = conda_meta(prefix) if os.path.isdir(prefix) else dict()
+    satisfied = []
+    unsatisfied = []
+
+    for record in records:
+        pkg = installed.get(record['name'])
+        version = pkg['version'] if pkg else None
+        simple = ''.join([record['name'],
+                          record['operator'] or '',
+                          record['version'] or '']).replace(' ', '')
+        evaluable = simple == record['fullspec'].replace(' ', '')
+
+        if (pkg is not None and evaluable
+                and version_match(version, record['operator'],
+                                  record['version'])):
+            satisfied.append((record, version))
+        else:
+            unsatisfied.append((record, version))
+
+    return satisfied, unsatisfied
+
+
+def dmfile_validate(records, conda_channels, subdir, cache_root=None):
+    """ Check `dmfile` records against the repodata of `conda_channels`
+    without invoking the conda solver. `defaults` and channel names are
+    resolved using conda's configuration. Validation is skipped when a
+    channel cannot be resolved or its repodata is unavailable, since that
+    channel may provide the packages.
+
+    :param records: list: data returned by `dmfile` method
+    :param conda_channels: list: channel URLs
+    :param subdir: str: platform subdirectory (i.e. `linux-64`)
+    :param cache_root: str: path to repodata index cache
+                       (default: `utils.cache_dir('repodata')`)
+    :returns: bool: True when the records were validated
+    :raises UnsatisfiablePackageSpec: listing every record no channel
+                                      can satisfy
+    """
+    if not conda_channels:
+        return False
+
+    index, missing = repodata_index(conda_channels, subdir,
+                                    cache_root=cache_root)
+    if missing:
+        print("Skipping validation: repodata unavailable", file=sys.stderr)
+        return False
+
+    unsatisfiable = repodata_unsatisfiable(records, index)
+    if unsatisfiable:
+        raise UnsatisfiablePackageSpec('\n'.join(
+            [f"'{record['fullspec']}': {reason}"
+             for record, reason in unsatisfiable]))
+    return True
+
+
+def env_combine(filename, conda_env, conda_channels=[], validate=True):
     """ Install packages listed in `filename` inside `conda_env`.
     Packages are quote-escaped to prevent spurious file redirection.
+    Conda is not executed when the environment already satisfies every
+    package. Otherwise every package is passed to conda, so that the solver
+    keeps the satisfied packages' constraints while updating dependencies.
 
     :param filename: str: path to file
-    :param conda_env: str: conda environment name
+    :param conda_env: str or CondaEnv: conda environment name or handle
     :param conda_channels: list: channel URLs
+    :param validate: bool: check the packages against the channels' repodata
+                     before solving (see `dmfile_validate`)
     :returns: None
+    :raises UnsatisfiablePackageSpec: when validation fails
     :raises subprocess.CalledProcessError: via check_returncode method
     """
     packages = []
+    records = dmfile(filename)
+    unsatisfied = records
+
+    env = conda_env_handle(conda_env)
+    if env.prefix:
+        _, unsatisfied = dmfile_diff(records, env.prefix)
+        unsatisfied = [x[0] for x in unsatisfied]
 
-    for record in dmfile(filename):
+    if not unsatisfied:
+        print(f"{env.name}: all requested packages are installed")
+        return
+
+    if validate:
+        subdir = conda_subdir(conda_meta(env.prefix) if env.prefix
+                              else dict())
+        dmfile_validate(unsatisfied, conda_channels, subdir)
+
+    for record in records:
         packages.append(f"'{record['fullspec']}'")
 
     packages_result = ' '.join([x for x in packages])
 
-    with conda_env_load(conda_env):
-        ei_touch()
-        # Perform package installation
-        proc = conda('install', '-q', '-y',
-                     '-n', conda_env,
-                     conda_cmd_channels(conda_channels),
-                     packages_result)
+    ei_touch(env)
+    # Perform package installation
+    proc = conda_install_solved(env.name,
+                                conda_cmd_channels(conda_channels),
+                                packages_result,
+                                env=env)
 
-        if proc.stderr:
-            print(proc.stderr.decode())
+    if proc.stderr:
+        print(proc.stderr.decode())
 
-        proc.check_returncode()
+    proc.check_returncode()
+
+
+def solution_key(base_spec, filename, conda_channels=[]):
+    """ Compute the solution cache key of a merge
+
+    :param base_spec: str: path to spec file the environment was created from
+    :param filename: str: path to dmfile
+    :param conda_channels: list: channel URLs
+    :returns: str: hex digest
+    """
+    digest = hashlib.sha256()
+    for path in [base_spec, filename]:
+        with open(path, 'rb') as fp:
+            digest.update(hashlib.sha256(fp.read()).digest())
+    for channel in conda_channels:
+        digest.update(f'\n{channel}'.encode())
+    return digest.hexdigest()
+
+
+def env_combine_cached(filename, conda_env, conda_channels=[],
+                       base_spec=None, force_solve=False, cache_root=None,
+                       validate=True):
+    """ Install packages listed in `filename` inside `conda_env`, replaying a
+    previously cached solution when one exists for the same base_spec,
+    dmfile and channel list. Replaying an explicit solution does not invoke
+    the conda solver. The solution is (re)cached after a successful solve.
+
+    :param filename: str: path to dmfile
+    :param conda_env: str or CondaEnv: conda environment name or handle
+    :param conda_channels: list: channel URLs
+    :param base_spec: str: path to spec file the environment was created from
+    :param force_solve: bool: ignore any cached solution
+    :param cache_root: str: path to solution cache
+                       (default: `utils.cache_dir('solutions')`)
+    :param validate: bool: check the packages against the channels' repodata
+                     before solving (see `dmfile_validate`)
+    :returns: bool: True when a cached solution was replayed
+    :raises subprocess.CalledProcessError: via check_returncode method
+    """
+    env = conda_env_handle(conda_env)
+    if base_spec is None:
+        env_combine(filename, env, conda_channels, validate)
+        return False
+
+    cache_root = cache_root or cache_dir('solutions')
+    os.makedirs(cache_root, exist_ok=True)
+    index = os.path.join(cache_root, 'index.json')
+    key = solution_key(base_spec, filename, conda_channels)
+    solution = os.path.join(cache_root, key + '.txt')
+
+    if not force_solve and os.path.exists(solution):
+        lru_touch(index, key)
+        installed = set([x.get('fn') for x in conda_meta(env.prefix).values()])
+        wanted = set([explicit_filename(x) for x in explicit_read(solution)])
+
+        if wanted <= installed:
+            print(f"{env.name}: cached solution {key[:12]} already installed")
+            return True
+
+        print(f"{env.name}: replaying cached solution {key[:12]}")
+        with conda_pkgs_lock():
+            conda_pkgs_prefetch(solution)
+        proc = conda('install', '-q', '-y', '-n', env.name,
+                     '--file', solution, env=env)
+        if not proc.returncode:
+            return True
+
+        print(proc.stderr.decode(), file=sys.stderr)
+        print(f"{env.name}: replay failed. Solving...", file=sys.stderr)
+
+    env_combine(filename, env, conda_channels, validate)
+
+    with open(solution + '.tmp', 'w') as fp:
+        export_explicit(conda_meta(env.prefix), fp)
+    os.replace(solution + '.tmp', solution)
+
+    lru_touch(index, key, base_spec=os.path.abspath(base_spec),
+              dmfile=os.path.abspath(filename))
+    for stale, _ in lru_evict(index, max_entries=SOLUTION_MAX,
+                              protect=[key]):
+        stale = os.path.join(cache_root, stale + '.txt')
+        if os.path.exists(stale):
+            os.remove(stale)
+
+    return False
 
 
 def testable_packages(filename, prefix):
@@ -97,102 +325,443 @@ def testable_packages(filename, prefix):
     :param prefix: str: path to conda root directory (aka prefix)
     :returns: dict: git commit hash and repository URL information
     """
-    pkgdir = os.path.join(prefix, 'pkgs')
-    paths = []
-    yaml = YAML(typ='safe')
+    index = pkgs_index(os.path.join(prefix, 'pkgs'))
+
+    try:
+        for record in dmfile(filename):
+            path = pkgs_lookup(index, record['name'], record['operator'],
+                               record['version'])
+            if path is None:
+                continue
+
+            info = pkg_git_info(index, path)
+            if info is None:
+                continue
+
+            yield dict(info)
+    finally:
+        pkgs_index_save(index)
+
+
+def prefetch_sources(filename, prefix, jobs=4):
+    """ Populate the git mirror cache with the repositories of packages
+    `testable_packages` can resolve. Failures are reported, not raised,
+    since the sources are fetched again on demand.
+
+    :param filename: str: path to dmfile
+    :param prefix: str: path to conda root directory (aka prefix)
+    :param jobs: int: number of concurrent fetches
+    :returns: list: repository URLs fetched successfully
+    """
+    repos = []
+    for pkg in testable_packages(filename, prefix):
+        if pkg['repo'] not in repos:
+            repos.append(pkg['repo'])
 
-    for record in dmfile(filename):
-        # Reconstruct ${package}-${version} format (when possible)
-        pattern = f"{record['name']}-"
-        if record['version']:
-            pattern += record['version']
-        pattern += '*'
+    result = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        # Subprocess usage is attributed to the caller's collectors
+        futures = {pool.submit(copy_context().run, mirror_update, x): x
+                   for x in repos}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                result.append(futures[future])
+            except Exception as e:
+                print(f"Prefetch failed: {futures[future]}: {e}",
+                      file=sys.stderr)
 
-        # Record path to extracted package
-        path = ''.join([x for x in glob(os.path.join(pkgdir, pattern))
-                        if os.path.isdir(x)])
-        paths.append(path)
+    return result
 
-    for root in paths:
-        info_d = os.path.join(root, 'info')
-        recipe_d = os.path.join(info_d, 'recipe')
-        git_log = os.path.join(info_d, 'git')
 
-        if not os.path.exists(git_log):
-            continue
+def integration_test_root(pkg_data, results_root='.'):
+    """ Determine where `integration_test` stores a package's XML report
+    and logs
 
-        git_log_data = open(git_log).readlines()
+    :param pkg_data: dict: data returned by `testable_packages` method
+    :param results_root: str: path to store XML reports
+    :returns: str: absolute path
+    """
+    repo_root = os.path.basename(pkg_data['repo']).replace('.git', '')
+    return os.path.abspath(os.path.join(results_root, 'results', repo_root))
 
-        if not git_log_data:
-            continue
 
-        with open(os.path.join(recipe_d, 'meta.yaml')) as yaml_data:
-            source = yaml.load(yaml_data)['source']
+def integration_test_tools(conda_env, logfile=None):
+    """ Install the tools shared by every package's tests (`TEST_TOOLS`)
+    from the wheelhouse
 
-        if not isinstance(source, dict):
-            continue
+    :param conda_env: str or CondaEnv: conda environment name or handle
+    :param logfile: str: write pip's output to this file
+    :returns: subprocess.CompletedProcess
+    """
+    proc = wheelhouse_install(TEST_TOOLS, conda_env, args='--upgrade',
+                              logfile=logfile)
+    if proc.returncode:
+        print(proc.stdout.decode())
+        print(proc.stderr.decode())
+    return proc
+
+
+def integration_test_shards(env, repo, repo_path, results, shards, logs):
+    """ Execute a project's tests in `shards` concurrent pytest processes.
+    Test modules are balanced across shards using the durations recorded by
+    previous runs. The shards' reports are merged into `results`.
+
+    :param env: CondaEnv: environment handle
+    :param repo: str: repository URL
+    :param repo_path: str: path to project
+    :param results: str: path to XML report
+    :param shards: int: number of pytest processes
+    :param logs: str: path to store logs and per-shard XML reports
+    :returns: list: of subprocess.CompletedProcess, or None when collection
+              failed or found no tests (run pytest unsharded instead, so
+              collection errors are reported)
+    :raises subprocess.CalledProcessError: when a shard did not complete
+    """
+    modules = shard_collect(env, repo_path,
+                            logfile=os.path.join(logs, 'pytest-collect.log'))
+    if not modules:
+        return None
+
+    history = index_load(shard_history_file(repo))
+    groups = shard_balance(modules, shard_durations(modules, history), shards)
+
+    def run_shard(i, group):
+        return env.sh_stream(
+            "python", "-m pytest",
+            f"-v --basetemp=.tmp-shard{i} "
+            f"--junitxml={os.path.join(logs, f'shard{i}.xml')}",
+            ' '.join(group),
+            cwd=repo_path, echo=False,
+            logfile=os.path.join(logs, f'pytest-shard{i}.log'))
+
+    with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+        futures = [pool.submit(copy_context().run, run_shard, i, group)
+                   for i, group in enumerate(groups)]
+        procs = [x.result() for x in futures]
+
+    # A shard that did not complete would silently drop its tests
+    for proc in procs:
+        if proc.returncode not in PYTEST_OK:
+            print(proc.stdout.decode())
+            print(proc.stderr.decode())
+            proc.check_returncode()
 
-        repository = source['git_url']
-        head = git_log_data[1].split()[1]
-        yield dict(repo=repository, commit=head)
+    junit_merge([os.path.join(logs, f'shard{i}.xml')
+                 for i in range(len(groups))], results)
 
+    # Combined log, as produced by an unsharded run
+    with open(os.path.join(logs, 'pytest.log'), 'wb') as log:
+        for i in range(len(groups)):
+            with open(os.path.join(logs, f'pytest-shard{i}.log'), 'rb') as fp:
+                shutil.copyfileobj(fp, log)
+    return procs
 
-def integration_test(pkg_data, conda_env, results_root='.'):
+
+def integration_test(pkg_data, conda_env, results_root='.', src_root='src',
+                     install_tools=True, shards=1):
     """
     :param pkg_data: dict: data returned by `testable_packages` method
-    :param conda_env: str: conda environment name
+    :param conda_env: str or CondaEnv: conda environment name or handle
     :param results_root: str: path to store XML reports
+    :param src_root: str: path to check out package sources
+    :param install_tools: bool: install `TEST_TOOLS` first. Pass False when
+                          `integration_test_tools` was called for `conda_env`
+    :param shards: int: split the tests across this many pytest processes
     :returns: str: path to XML report
     :raises subprocess.CalledProcessError: via check_returncode method
     """
-    results = ''
-    results_root = os.path.abspath(os.path.join(results_root, 'results'))
-    src_root = os.path.abspath('src')
+    src_root = os.path.abspath(src_root)
+
+    os.makedirs(src_root, 0o755, exist_ok=True)
+
+    repo_root = os.path.basename(pkg_data['repo']).replace('.git', '')
+    repo_path = os.path.join(src_root, repo_root)
+
+    mirror_checkout(pkg_data['repo'], pkg_data['commit'], repo_path)
+    force_xunit2(repo_path)
+
+    env = conda_env_handle(conda_env)
+    ei_touch(env)
+    results = os.path.join(integration_test_root(pkg_data, results_root),
+                           'result.xml')
+
+    conda("uninstall", "-y", repo_root, env=env, cwd=repo_path)
+
+    # Output is streamed to log files. Only the tail is kept in memory.
+    logs = os.path.join(os.path.dirname(results), 'logs')
+
+    if install_tools:
+        integration_test_tools(env, os.path.join(logs, 'pip-tools.log'))
+
+    # Dependencies of the package's test extras are kept in the wheelhouse.
+    # They are downloaded again only when the commit changes.
+    requirements = ['.[test]']
+    proc_pip = wheelhouse_install(
+        requirements, env, cwd=repo_path, args='-v',
+        key=wheelhouse_key(requirements, env, pkg_data['repo'],
+                           pkg_data['commit']),
+        logfile=os.path.join(logs, 'pip-install.log'))
+    proc_pip_stderr = proc_pip.stderr.decode()
+    if proc_pip.returncode:
+        print(proc_pip.stdout.decode())
+        print(proc_pip.stderr.decode())
+
+    if 'consider upgrading' not in proc_pip_stderr:
+        proc_pip.check_returncode()
+
+    proc_egg = env.sh_stream(
+        "python", "setup.py egg_info",
+        cwd=repo_path, echo=False,
+        logfile=os.path.join(logs, 'egg-info.log'))
+    if proc_egg.returncode:
+        print(proc_egg.stdout.decode())
+        print(proc_egg.stderr.decode())
+
+    if shards < 2 or integration_test_shards(env, pkg_data['repo'], repo_path,
+                                             results, shards, logs) is None:
+        env.sh_stream(
+            "python", "-m pytest", f"-v --basetemp=.tmp --junitxml={results}",
+            cwd=repo_path,
+            logfile=os.path.join(logs, 'pytest.log'))
+
+    # Test durations are recorded to balance future sharded runs
+    if os.path.exists(results):
+        shard_history_update(pkg_data['repo'], results)
 
-    if not os.path.exists(src_root):
-        os.mkdir(src_root, 0o755)
+    return results
 
-    with pushd(src_root) as _:
-        repo_root = os.path.basename(pkg_data['repo']).replace('.git', '')
 
-        if not os.path.exists(repo_root):
-            git(f"clone --recursive {pkg_data['repo']} {repo_root}")
+def result_cache_key(pkg_data, spec_digest):
+    """ Compute the result cache key of a package's tests
 
-        with pushd(repo_root) as _:
-            git(f"checkout {pkg_data['commit']}")
-            force_xunit2()
+    :param pkg_data: dict: data returned by `testable_packages` method
+    :param spec_digest: str: digest of the environment's @EXPLICIT spec
+    :returns: str: hex digest
+    """
+    data = '\n'.join([pkg_data['repo'], pkg_data['commit'], spec_digest])
+    return hashlib.sha256(data.encode()).hexdigest()
 
-            with conda_env_load(conda_env):
-                ei_touch()
-                results = os.path.abspath(os.path.join(results_root,
-                                                       repo_root,
-                                                       'result.xml'))
 
-                conda("uninstall", "-y", repo_root)
+def result_cache_restore(key, pkg_data, results_root='.', cache_root=None):
+    """ Copy cached test results into place, as if `integration_test` had
+    been executed. Only results without failures or errors are used (see
+    `result_cache_store`).
 
-                proc_pip_install = sh("python", "-m pip install --upgrade pip pytest ci-watson")
-                if proc_pip_install.returncode:
-                    print(proc_pip_install.stdout.decode())
-                    print(proc_pip_install.stderr.decode())
+    :param key: str: value returned by `result_cache_key`
+    :param pkg_data: dict: data returned by `testable_packages` method
+    :param results_root: str: path to store XML reports
+    :param cache_root: str: path to result cache
+                       (default: `utils.cache_dir('results')`)
+    :returns: tuple: (XML report path, summary dict), or None on a miss
+    """
+    cache_root = cache_root or cache_dir('results')
+    index = os.path.join(cache_root, 'index.json')
+    record = index_load(index).get(key)
+    source = os.path.join(cache_root, key)
+    if record is None or not os.path.exists(os.path.join(source,
+                                                         'result.xml')):
+        return None
+    if record['summary']['failures'] or record['summary']['errors']:
+        return None
+
+    dest = integration_test_root(pkg_data, results_root)
+    os.makedirs(os.path.join(dest, 'logs'), exist_ok=True)
+    shutil.copy2(os.path.join(source, 'result.xml'), dest)
+    if os.path.exists(os.path.join(source, 'pytest.log')):
+        shutil.copy2(os.path.join(source, 'pytest.log'),
+                     os.path.join(dest, 'logs'))
+
+    lru_touch(index, key)
+    return os.path.join(dest, 'result.xml'), record['summary']
+
+
+def result_cache_store(key, pkg_data, result, cache_root=None,
+                       max_age=RESULT_CACHE_MAX_AGE,
+                       max_size=RESULT_CACHE_MAX_SIZE):
+    """ Store the XML report (and pytest log) produced by `integration_test`.
+    Reports with failures or errors are not stored, so that a flaky test
+    or an infrastructure problem is not replayed until the commit changes.
+    Least recently used results are evicted when they are older than
+    `max_age` or the cache exceeds `max_size`.
+
+    :param key: str: value returned by `result_cache_key`
+    :param pkg_data: dict: data returned by `testable_packages` method
+    :param result: str: path to XML report
+    :param cache_root: str: path to result cache
+                       (default: `utils.cache_dir('results')`)
+    :param max_age: float: seconds since last use before a result expires
+    :param max_size: int: upper limit of the cache size (bytes)
+    :returns: dict: summary of the XML report
+    """
+    cache_root = cache_root or cache_dir('results')
+    index = os.path.join(cache_root, 'index.json')
+    summary = junit_summary(result)
+    if summary['failures'] or summary['errors']:
+        return summary
+
+    dest = os.path.join(cache_root, key)
+    tmp = f'{dest}.{os.getpid()}.tmp'
+    os.makedirs(tmp, exist_ok=True)
+    shutil.copy2(result, tmp)
+    log = os.path.join(os.path.dirname(result), 'logs', 'pytest.log')
+    if os.path.exists(log):
+        shutil.copy2(log, tmp)
+    size = sum([os.path.getsize(os.path.join(tmp, x))
+                for x in os.listdir(tmp)])
+
+    shutil.rmtree(dest, ignore_errors=True)
+    os.replace(tmp, dest)
+
+    lru_touch(index, key, repo=pkg_data['repo'], commit=pkg_data['commit'],
+              summary=summary, size=size)
+    for stale, _ in lru_evict(index, max_age=max_age, max_size=max_size,
+                              protect=[key]):
+        shutil.rmtree(os.path.join(cache_root, stale), ignore_errors=True)
+
+    return summary
+
+
+# Conda environment assigned to the current integration test worker process
+_WORKER_ENV = None
+# Whether TEST_TOOLS were installed in the worker's environment
+_WORKER_TOOLS = False
+
+
+def _integration_test_worker_init(queue):
+    """ Claim a private conda environment for the lifetime of a worker
 
-                proc_pip = sh("python", "-m pip install -v .[test]")
-                proc_pip_stderr = proc_pip.stderr.decode()
-                if proc_pip.returncode:
-                    print(proc_pip.stdout.decode())
-                    print(proc_pip.stderr.decode())
+    :param queue: multiprocessing.Queue: conda environment names
+    """
+    global _WORKER_ENV
+    _WORKER_ENV = queue.get()
 
-                if 'consider upgrading' not in proc_pip_stderr:
-                    proc_pip.check_returncode()
 
-                proc_egg = sh("python", "setup.py egg_info")
-                if proc_egg.returncode:
-                    print(proc_egg.stdout.decode())
-                    print(proc_egg.stderr.decode())
+def _integration_test_worker(pkg_data, results_root, src_root, shards,
+                             timeout, max_rss):
+    """ Run `integration_test` inside a worker process.
+    Output is written to a log file alongside the package's XML report.
 
-                proc_pytest = sh("python", "-m pytest", f"-v --basetemp=.tmp --junitxml={results}")
-                print(proc_pytest.stdout.decode())
-                if proc_pytest.returncode:
-                    print(proc_pytest.stderr.decode())
+    :param pkg_data: dict: data returned by `testable_packages` method
+    :param results_root: str: path to store XML reports and logs
+    :param src_root: str: path to check out package sources
+    :param shards: int: pytest processes per package
+    :param timeout: float: seconds the package's tests may take
+    :param max_rss: int: bytes of memory the package's tests may use
+    :returns: tuple: (XML report path, resource usage dict, exception)
+    """
+    global _WORKER_TOOLS
+    logdir = integration_test_root(pkg_data, results_root)
+    os.makedirs(logdir, exist_ok=True)
+
+    with open(os.path.join(logdir, 'output.log'), 'w+') as log:
+        with redirect_stdout(log), redirect_stderr(log):
+            try:
+                with usage_collect() as usage:
+                    if not _WORKER_TOOLS:
+                        integration_test_tools(_WORKER_ENV, os.path.join(
+                            logdir, 'logs', 'pip-tools.log'))
+                        _WORKER_TOOLS = True
+                    with resource_limits(timeout, max_rss):
+                        result = integration_test(pkg_data, _WORKER_ENV,
+                                                  results_root, src_root,
+                                                  install_tools=False,
+                                                  shards=shards)
+                return result, usage.as_dict(), None
+            except Exception as e:
+                traceback.print_exc()
+                usage = usage.as_dict()
+                if isinstance(e, ResourceLimitExceeded):
+                    usage['status'] = e.reason
+                return '', usage, e
+
+
+def integration_test_pool(packages, conda_env, results_root='.', jobs=1,
+                          src_root='src', callback=None, shards=1,
+                          timeout=None, max_rss=None):
+    """ Execute `integration_test` for each package using a pool of worker
+    processes. Every worker receives its own clone of `conda_env` so package
+    (un)installation cannot interfere with other workers.
+
+    Packages are started while CPUs (`shards` per package) and memory
+    (`max_rss`, or `TEST_MEMORY_RESERVE`, per package) are available. A
+    package exceeding `timeout` or `max_rss` is killed and reported as
+    failed (see `limits.ResourceLimitExceeded`).
+
+    :param packages: iterable: data returned by `testable_packages` method
+    :param conda_env: str: conda environment name
+    :param results_root: str: path to store XML reports and logs
+    :param jobs: int: number of worker processes
+    :param src_root: str: path to check out package sources
+    :param callback: callable: receives each (pkg_data, XML report path,
+                     exception, resource usage dict) as soon as it completes
+    :param shards: int: pytest processes per package
+    :param timeout: float: seconds each package's tests may take
+    :param max_rss: int: bytes of memory each package's tests may use
+    :returns: list: of (pkg_data, XML report path, exception, resource usage
+              dict) tuples
+    :raises subprocess.CalledProcessError: via check_returncode method
+    """
+    packages = list(packages)
+    jobs = max(1, min(jobs, len(packages)))
+    results = []
+
+    if not packages:
+        return results
+
+    # Every package is already cached, so cloning does not touch pkgs/
+    worker_envs = []
+    for i in range(jobs):
+        worker_env = f'{conda_env}_worker{i}'
+        proc = conda('create', '-q', '-y', '--offline', '-n', worker_env,
+                     '--clone', conda_env)
+        if proc.stderr:
+            print(proc.stderr.decode())
+        proc.check_returncode()
+        worker_envs.append(worker_env)
+
+    queue = multiprocessing.Queue()
+    for worker_env in worker_envs:
+        queue.put(worker_env)
+
+    try:
+        with ProcessPoolExecutor(max_workers=jobs,
+                                 initializer=_integration_test_worker_init,
+                                 initargs=(queue,)) as pool:
+            pending = list(packages)
+            running = dict()
+            while pending or running:
+                # Admit at most one package per interval, so the memory it
+                # consumes is visible before the next admission
+                if pending and len(running) < jobs \
+                        and limits_admit(len(running), shards,
+                                         max_rss or TEST_MEMORY_RESERVE):
+                    pkg = pending.pop(0)
+                    future = pool.submit(_integration_test_worker,
+                                         pkg, results_root, src_root,
+                                         shards, timeout, max_rss)
+                    running[future] = pkg
+
+                done, _ = wait(running, timeout=TEST_SCHEDULE_INTERVAL,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    pkg = running.pop(future)
+                    try:
+                        result, usage, error = future.result()
+                    except Exception as e:
+                        result, usage, error = '', None, e
+
+                    results.append((pkg, result, error, usage))
+                    if callback is not None:
+                        callback(pkg, result, error, usage)
+                    if error is None:
+                        print(f"Tests completed: {pkg['repo']}")
+                    else:
+                        print(f"Tests failed: {pkg['repo']}: {error}",
+                              file=sys.stderr)
+    finally:
+        for worker_env in worker_envs:
+            conda('remove', '-q', '-y', '--all', '-n', worker_env)
 
     return results
 
@@ -217,7 +786,7 @@ def force_xunit2(project='.'):
             break
     else:
         data = """[pytest]\njunit_family = xunit2\n"""
-        with open('pytest.ini', 'w+') as cfg:
+        with open(os.path.join(project, 'pytest.ini'), 'w+') as cfg:
             cfg.write(data)
         return
 
@@ -0,0 +1,388 @@
+import json
+import os
+import re
+import sys
+from functools import cmp_to_key
+from glob import glob
+from ruamel.yaml import YAML
+from ruamel.yaml.comments import CommentedMap
+
+
+EXPLICIT_HEADER = """# This file may be used to create an environment using:
+# $ conda create --name <env> --file <this file>
+# platform: {subdir}
+@EXPLICIT
+"""
+VERSION_SPLIT_RE = re.compile(r'[._\-]')
+VERSION_TOKEN_RE = re.compile(r'\d+|[a-z]+')
+
+
+def conda_meta(prefix):
+    """ Read the package records of a conda environment
+
+    :param prefix: str: path to conda environment
+    :returns: dict: package name -> record (contents of conda-meta/*.json)
+    """
+    result = dict()
+    for filename in glob(os.path.join(prefix, 'conda-meta', '*.json')):
+        with open(filename) as fp:
+            record = json.load(fp)
+
+        if 'name' not in record:
+            continue
+        result[record['name']] = record
+
+    return result
+
+
+def explicit_read(filename):
+    """ Read the package URLs listed in an @EXPLICIT spec file
+
+    :param filename: str: path to spec file
+    :returns: list: package URLs (including any #md5 fragment)
+    """
+    result = []
+    with open(filename) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line or line.startswith('#') or line.startswith('@'):
+                continue
+            result.append(line)
+    return result
+
+
+def explicit_filename(url):
+    """ Return the package file name referenced by an explicit URL
+
+    :param url: str: package URL
+    :returns: str: file name (i.e. `name-version-build.tar.bz2`)
+    """
+    return os.path.basename(url.split('#', 1)[0])
+
+
+def _version_parse(version):
+    """ Split a version string the way conda's VersionOrder does: an
+    optional epoch (`1!`), dot-separated components of numbers and strings,
+    and an optional local version (`+local`). A component starting with a
+    string is prefixed with 0 (`1.0rc1` is `1.0.0rc1`). "post" sorts after
+    any number and "dev" before any other string.
+
+    :param version: str: version string
+    :returns: tuple: (epoch, components, local components)
+    """
+    version = version.strip().lower()
+    epoch = 0
+    if '!' in version:
+        epoch, version = version.split('!', 1)
+        epoch = int(epoch) if epoch.isdigit() else 0
+    version, _, local = version.partition('+')
+
+    def components(value):
+        result = []
+        for part in VERSION_SPLIT_RE.split(value):
+            tokens = []
+            for token in VERSION_TOKEN_RE.findall(part):
+                if token.isdigit():
+                    tokens.append(int(token))
+                elif token == 'post':
+                    tokens.append(float('inf'))
+                elif token == 'dev':
+                    tokens.append('DEV')
+                else:
+                    tokens.append(token)
+            if not tokens or not isinstance(tokens[0], int):
+                tokens.insert(0, 0)
+            result.append(tokens)
+        return result
+
+    return epoch, components(version), components(local) if local else []
+
+
+def _version_token_compare(a, b):
+    """ Compare two version tokens. Strings order before numbers.
+    :returns: int: negative, zero, or positive
+    """
+    if isinstance(a, str) != isinstance(b, str):
+        return -1 if isinstance(a, str) else 1
+    return (a > b) - (a < b)
+
+
+def _version_components_compare(a, b):
+    """ Compare two lists of version components. Missing components and
+    tokens count as 0.
+    :returns: int: negative, zero, or positive
+    """
+    for i in range(max(len(a), len(b))):
+        x = a[i] if i < len(a) else [0]
+        y = b[i] if i < len(b) else [0]
+        for j in range(max(len(x), len(y))):
+            result = _version_token_compare(x[j] if j < len(x) else 0,
+                                            y[j] if j < len(y) else 0)
+            if result:
+                return result
+    return 0
+
+
+def version_compare(a, b):
+    """ Compare two version strings, as conda orders them (i.e.
+    `1.0rc1` < `1.0` < `1.0.post1` < `1.1`)
+
+    :param a: str: version
+    :param b: str: version
+    :returns: int: negative, zero, or positive when `a` is less than,
+              equal to, or greater than `b`
+    """
+    a = _version_parse(a)
+    b = _version_parse(b)
+    if a[0] != b[0]:
+        return (a[0] > b[0]) - (a[0] < b[0])
+    return _version_components_compare(a[1], b[1]) \
+        or _version_components_compare(a[2], b[2])
+
+
+def version_key(version):
+    """ Return a sort key ordering versions as `version_compare` does
+
+    :param version: str: version string
+    :returns: object: sort key
+    """
+    return cmp_to_key(version_compare)(version)
+
+
+def _version_components_startswith(a, b):
+    """ Determine whether the components `a` begin with the components `b`
+    (see conda's VersionOrder.startswith)
+    """
+    if not b:
+        return True
+    if len(a) < len(b):
+        a = a + [[0]] * (len(b) - len(a))
+    if _version_components_compare(a[:len(b) - 1], b[:-1]):
+        return False
+    x, y = a[len(b) - 1], b[-1]
+    if len(x) < len(y):
+        x = x + [0] * (len(y) - len(x))
+    if x[:len(y) - 1] != y[:-1]:
+        return False
+    x, y = x[len(y) - 1], y[-1]
+    if isinstance(y, str):
+        return isinstance(x, str) and x.startswith(y)
+    return x == y
+
+
+def version_startswith(installed, version):
+    """ Determine whether `installed` is `version` or one of its
+    sub-releases, as conda's `=version` does (i.e. `1.1` matches `1.1`,
+    `1.1.3`, `1.1rc1` and `1.1.post1`, but not `1.10`)
+
+    :param installed: str: installed version
+    :param version: str: requested version
+    :returns: bool
+    """
+    a = _version_parse(installed)
+    b = _version_parse(version)
+    if a[0] != b[0]:
+        return False
+    if b[2]:
+        return not _version_components_compare(a[1], b[1]) \
+            and _version_components_startswith(a[2], b[2])
+    return _version_components_startswith(a[1], b[1])
+
+
+def version_match(installed, operator, version):
+    """ Determine whether an installed version satisfies a constraint.
+    `=` (or no operator) matches the version and any of its sub-releases,
+    as it does in conda (see `version_startswith`).
+
+    :param installed: str: installed version
+    :param operator: str: one of =, ==, !=, <, <=, >, >=, or None
+    :param version: str: requested version, or None for any version
+    :returns: bool: True when satisfied. Unknown operators never match.
+    """
+    if not version:
+        return True
+
+    version = version.strip().rstrip('*').rstrip('.')
+    if operator in [None, '=']:
+        return version_startswith(installed, version)
+
+    result = version_compare(installed, version)
+    checks = {
+        '==': result == 0,
+        '!=': result != 0,
+        '<': result < 0,
+        '<=': result <= 0,
+        '>': result > 0,
+        '>=': result >= 0,
+    }
+    return checks.get(operator, False)
+
+
+def conda_subdir(records):
+    """ Determine the platform subdirectory of installed packages
+
+    :param records: dict: data returned by `conda_meta` method
+    :returns: str: subdir (i.e. `linux-64`)
+    """
+    for record in records.values():
+        subdir = record.get('subdir')
+        if subdir and subdir != 'noarch':
+            return subdir
+
+    platform = 'osx' if sys.platform == 'darwin' else sys.platform
+    return f'{platform}-64'
+
+
+def pip_packages(prefix, records):
+    """ Find packages in site-packages that were not installed by conda
+
+    :param prefix: str: path to conda environment
+    :param records: dict: data returned by `conda_meta` method
+    :returns: list: of (name, version) tuples sorted by name
+    """
+    owned = set()
+    for record in records.values():
+        for path in record.get('files', []):
+            parts = path.split('/')
+            if len(parts) > 3 and parts[2] == 'site-packages':
+                owned.add(parts[3])
+
+    result = []
+    for site_packages in glob(os.path.join(prefix, 'lib', 'python*',
+                                           'site-packages')):
+        for entry in sorted(os.listdir(site_packages)):
+            if entry in owned:
+                continue
+
+            path = os.path.join(site_packages, entry)
+            if entry.endswith('.dist-info'):
+                path = os.path.join(path, 'METADATA')
+            elif entry.endswith('.egg-info'):
+                if os.path.isdir(path):
+                    path = os.path.join(path, 'PKG-INFO')
+            else:
+                continue
+
+            if not os.path.isfile(path):
+                continue
+
+            headers = dict()
+            with open(path, errors='replace') as fp:
+                for line in fp:
+                    if not line.strip():
+                        break
+                    key, _, value = line.partition(':')
+                    headers.setdefault(key.strip(), value.strip())
+
+            if headers.get('Name') and headers.get('Version'):
+                result.append((headers['Name'], headers['Version']))
+
+    return sorted(set(result), key=lambda x: x[0].lower())
+
+
+def dependency_order(records):
+    """ Order package records the way conda lists a prefix: packages
+    nothing depends on (and that depend on nothing) first, then each
+    package after its dependencies. Packages ready at the same time are
+    ordered by name. Cycles are broken at the package with the fewest
+    unresolved dependencies.
+
+    :param records: dict: data returned by `conda_meta` method
+    :returns: list: package names
+    """
+    graph = dict()
+    for name, record in records.items():
+        depends = set([x.split()[0] for x in record.get('depends', [])])
+        depends &= set(records)
+        depends.discard(name)
+        if name == 'python':
+            # conda ignores the python <-> pip cycle
+            depends.discard('pip')
+        graph[name] = depends
+
+    parents = set().union(*graph.values()) if graph else set()
+    result = sorted([x for x, y in graph.items()
+                     if not y and x not in parents])
+    seen = set(result)
+
+    while graph:
+        ready = sorted([x for x, y in graph.items() if not y])
+        if not ready:
+            ready = [min(graph, key=lambda x: (len(graph[x]), x))]
+        for name in ready:
+            del graph[name]
+            if name not in seen:
+                seen.add(name)
+                result.append(name)
+        for depends in graph.values():
+            depends.difference_update(ready)
+
+    return result
+
+
+def export_explicit(records, fp):
+    """ Write an @EXPLICIT spec equivalent to `conda list --explicit`
+
+    :param records: dict: data returned by `conda_meta` method
+    :param fp: file: output stream
+    """
+    fp.write(EXPLICIT_HEADER.format(subdir=conda_subdir(records)))
+    for name in dependency_order(records):
+        record = records[name]
+        url = record.get('url')
+        if not url or url.startswith('<unknown>'):
+            fp.write(f"# no URL for: {record.get('fn', name)}\n")
+            continue
+        fp.write(url + '\n')
+
+
+def export_yaml(records, name, channels, prefix, fp):
+    """ Write an environment file equivalent to `conda env export`
+    with its channel list replaced by `channels`
+
+    :param records: dict: data returned by `conda_meta` method
+    :param name: str: conda environment name
+    :param channels: list: channel URLs
+    :param prefix: str: path to conda environment
+    :param fp: file: output stream
+    """
+    yaml = YAML()
+    yaml.default_flow_style = False
+    yaml.indent(offset=2)
+
+    dependencies = ['='.join([x, records[x]['version'], records[x]['build']])
+                    for x in sorted(records)]
+    pip = [f'{x}=={y}' for x, y in pip_packages(prefix, records)]
+    if pip:
+        dependencies.append(CommentedMap(pip=pip))
+
+    data = CommentedMap()
+    data['name'] = name
+    data['channels'] = list(channels)
+    data['dependencies'] = dependencies
+    data['prefix'] = prefix
+    yaml.dump(data, fp)
+
+
+def export(prefix, name, channels, yamlfile=None, specfile=None):
+    """ Export a conda environment's YAML configuration and explicit spec
+    directly from conda-meta, without running conda
+
+    :param prefix: str: path to conda environment
+    :param name: str: conda environment name
+    :param channels: list: channel URLs (written in this order)
+    :param yamlfile: str: path to YAML output file (optional)
+    :param specfile: str: path to explicit spec output file (optional)
+    :returns: dict: data returned by `conda_meta` method
+    """
+    records = conda_meta(prefix)
+
+    if yamlfile:
+        with open(yamlfile, 'w+') as fp:
+            export_yaml(records, name, channels, prefix, fp)
+
+    if specfile:
+        with open(specfile, 'w+') as fp:
+            export_explicit(records, fp)
+
+    return records
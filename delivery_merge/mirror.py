@@ -0,0 +1,146 @@
+import hashlib
+import os
+from .utils import cache_dir, file_lock, git
+
+
+def mirror_path(url, cache_root=None):
+    """ Return the location of a repository's bare mirror
+
+    :param url: str: repository URL
+    :param cache_root: str: path to mirror cache
+                       (default: `utils.cache_dir('git')`)
+    :returns: str: path to mirror
+    """
+    cache_root = cache_root or cache_dir('git')
+    name = os.path.basename(url.rstrip('/'))
+    if not name.endswith('.git'):
+        name += '.git'
+    key = hashlib.sha1(url.encode()).hexdigest()[:16]
+    return os.path.join(os.path.abspath(cache_root), f'{key}-{name}')
+
+
+def mirror_has_commit(mirror, commit):
+    """ Determine whether a mirror contains a commit
+
+    :param mirror: str: path to mirror
+    :param commit: str: commit hash (or any revision)
+    :returns: bool
+    """
+    proc = git(f'--git-dir={mirror}', 'cat-file', '-e', f'{commit}^{{commit}}')
+    return not proc.returncode
+
+
+def mirror_update(url, commit=None, cache_root=None):
+    """ Create or incrementally update the bare mirror of a repository.
+    An existing mirror is not fetched when it already contains `commit`.
+
+    :param url: str: repository URL
+    :param commit: str: commit required by the caller (optional)
+    :param cache_root: str: path to mirror cache
+    :returns: str: path to mirror
+    :raises subprocess.CalledProcessError: via check_returncode method
+    """
+    mirror = mirror_path(url, cache_root)
+    os.makedirs(os.path.dirname(mirror), exist_ok=True)
+
+    with file_lock(mirror + '.lock'):
+        if not os.path.exists(mirror):
+            proc = git('clone', '--mirror', url, mirror)
+        elif commit is None or not mirror_has_commit(mirror, commit):
+            proc = git(f'--git-dir={mirror}', 'remote', 'update', '--prune')
+        else:
+            return mirror
+
+        if proc.returncode:
+            print(proc.stderr.decode())
+        proc.check_returncode()
+
+    return mirror
+
+
+def _resolve_url(base, url):
+    """ Resolve a relative submodule URL against its superproject's URL
+
+    :param base: str: superproject URL
+    :param url: str: submodule URL
+    :returns: str: absolute submodule URL
+    """
+    if not url.startswith('./') and not url.startswith('../'):
+        return url
+
+    base = base.rstrip('/')
+    for part in url.split('/'):
+        if part == '..':
+            base = base.rsplit('/', 1)[0]
+        elif part != '.':
+            base = f'{base}/{part}'
+    return base
+
+
+def submodules_update(path, url, cache_root=None):
+    """ Check out a work tree's submodules (recursively) from their mirrors
+
+    :param path: str: path to work tree
+    :param url: str: URL of the work tree's repository
+    :param cache_root: str: path to mirror cache
+    :raises subprocess.CalledProcessError: via check_returncode method
+    """
+    if not os.path.exists(os.path.join(path, '.gitmodules')):
+        return
+
+    proc = git('config', '-f', '.gitmodules', '--get-regexp',
+               r'^submodule\..*\.path$', cwd=path)
+
+    for line in proc.stdout.decode().splitlines():
+        key, sub_path = line.split(None, 1)
+        name = key[len('submodule.'):-len('.path')]
+        sub_url = git('config', '-f', '.gitmodules', f'submodule.{name}.url',
+                      cwd=path).stdout.decode().strip()
+        sub_url = _resolve_url(url, sub_url)
+        mirror = mirror_update(sub_url, cache_root=cache_root)
+
+        git('submodule', 'init', '--', sub_path, cwd=path).check_returncode()
+        git('config', f'submodule.{name}.url', mirror,
+            cwd=path).check_returncode()
+        proc_update = git('-c', 'protocol.file.allow=always',
+                          'submodule', 'update', '--', sub_path, cwd=path)
+        if proc_update.returncode:
+            print(proc_update.stderr.decode())
+        proc_update.check_returncode()
+
+        submodules_update(os.path.join(path, sub_path), sub_url, cache_root)
+
+
+def mirror_checkout(url, commit, dest, cache_root=None):
+    """ Check out a commit from a repository's mirror into a lightweight
+    worktree, including submodules. An existing checkout at `dest` is moved
+    to `commit` instead. Local modifications and untracked files (i.e. left
+    behind by a previous test run) are discarded.
+
+    :param url: str: repository URL
+    :param commit: str: commit hash (or any revision)
+    :param dest: str: path to work tree
+    :param cache_root: str: path to mirror cache
+    :returns: str: absolute path to work tree
+    :raises subprocess.CalledProcessError: via check_returncode method
+    """
+    dest = os.path.abspath(dest)
+    mirror = mirror_update(url, commit, cache_root)
+
+    if os.path.exists(dest):
+        proc = git('checkout', '--force', '--detach', commit, cwd=dest)
+        if not proc.returncode:
+            proc = git('clean', '-fdx', cwd=dest)
+    else:
+        with file_lock(mirror + '.lock'):
+            # Forget worktrees belonging to deleted workspaces
+            git(f'--git-dir={mirror}', 'worktree', 'prune')
+            proc = git(f'--git-dir={mirror}', 'worktree', 'add', '--detach',
+                       dest, commit)
+
+    if proc.returncode:
+        print(proc.stderr.decode())
+    proc.check_returncode()
+
+    submodules_update(dest, url, cache_root)
+    return dest
@@ -0,0 +1,143 @@
+import sys
+import time
+from .timing import Usage, usage_collect
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class StageError(Exception):
+    pass
+
+
+class Stage:
+    """ A unit of work executed by `Pipeline`
+
+    :param name: str: unique stage name
+    :param func: callable: receives the results of `deps` (in order)
+    :param deps: list: names of stages that must complete first
+    """
+    def __init__(self, name, func, deps=[]):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.result = None
+        self.error = None
+        self.start = None
+        self.end = None
+        self.skipped = False
+        self.usage = Usage()
+
+    @property
+    def elapsed(self):
+        """ Wall time spent executing the stage (seconds)
+        """
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+
+class Pipeline:
+    """ Execute stages concurrently as soon as their dependencies complete
+
+    >>> pipeline = Pipeline()
+    >>> pipeline.add('a', lambda: 1)
+    >>> pipeline.add('b', lambda a: a + 1, deps=['a'])
+    >>> pipeline.run()['b']
+    2
+
+    :param workers: int: maximum number of stages executing at once
+    """
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.stages = dict()
+        self.start = None
+        self.end = None
+
+    def add(self, name, func, deps=[]):
+        """ Register a stage
+        :param name: str: unique stage name
+        :param func: callable: receives the results of `deps` (in order)
+        :param deps: list: names of stages that must complete first
+        :returns: Stage
+        """
+        if name in self.stages:
+            raise StageError(f'{name}: stage already defined')
+        for dep in deps:
+            if dep not in self.stages:
+                raise StageError(f'{name}: unknown dependency {dep}')
+
+        stage = Stage(name, func, deps)
+        self.stages[name] = stage
+        return stage
+
+    def _execute(self, stage):
+        stage.start = time.monotonic()
+        try:
+            with usage_collect() as stage.usage:
+                args = [self.stages[x].result for x in stage.deps]
+                stage.result = stage.func(*args)
+        finally:
+            stage.end = time.monotonic()
+        return stage.result
+
+    def run(self):
+        """ Execute all stages. Stages depending on a failed stage are
+        skipped. Independent stages still run to completion.
+
+        :returns: dict: stage name -> result
+        :raises Exception: the first error raised by a stage
+        """
+        pending = dict(self.stages)
+        running = dict()
+        errors = []
+        self.start = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    deps = [self.stages[x] for x in stage.deps]
+                    if any([x.error or x.skipped for x in deps]):
+                        stage.skipped = True
+                        stage.usage.status = 'skipped'
+                        del pending[name]
+                    elif all([x.end is not None and x.name not in running
+                              for x in deps]):
+                        running[name] = pool.submit(self._execute, stage)
+                        del pending[name]
+
+                if not running:
+                    continue
+
+                done, _ = wait(running.values(), return_when=FIRST_COMPLETED)
+                for name, future in list(running.items()):
+                    if future not in done:
+                        continue
+                    del running[name]
+                    stage = self.stages[name]
+                    stage.error = future.exception()
+                    if stage.error is not None:
+                        print(f'Stage {name} failed: {stage.error}',
+                              file=sys.stderr)
+                        errors.append(stage.error)
+
+        self.end = time.monotonic()
+
+        if errors:
+            raise errors[0]
+        return {x.name: x.result for x in self.stages.values()}
+
+    def report(self):
+        """ Summarize stage execution times
+
+        :returns: dict: `stages` (name -> seconds), `usage` (name -> dict
+                  returned by `timing.Usage.as_dict`), `serial` (sum of
+                  stage times), `wall` (elapsed time), and `saved` (time
+                  gained by executing stages concurrently)
+        """
+        stages = {x.name: x.elapsed for x in self.stages.values()}
+        usage = {x.name: x.usage.as_dict() for x in self.stages.values()}
+        serial = sum(stages.values())
+        wall = 0.0
+        if self.start is not None and self.end is not None:
+            wall = self.end - self.start
+        return dict(stages=stages, usage=usage, serial=serial, wall=wall,
+                    saved=max(0.0, serial - wall))
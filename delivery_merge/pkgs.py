@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+from .cache import index_load, index_save
+from .meta import version_compare, version_match
+from .utils import cache_dir
+from ruamel.yaml import YAML
+
+
+def pkgs_index(pkgdir, cache_file=None):
+    """ Index the extracted packages in a conda package cache.
+
+    Package metadata is read from each package's `info/index.json`. The
+    results are persisted to `cache_file` and reused while the modification
+    time of `info/index.json` has not changed, so subsequent scans only stat
+    each package's index.json.
+
+    :param pkgdir: str: path to package cache (i.e. `{prefix}/pkgs`)
+    :param cache_file: str: path to persistent index
+                       (default: `utils.cache_dir('pkgs')/{hash}.json`)
+    :returns: dict: `packages` maps name -> version -> list of package
+              paths. `records` holds the persisted per-directory data.
+    """
+    pkgdir = os.path.abspath(pkgdir)
+    if cache_file is None:
+        key = hashlib.sha1(pkgdir.encode()).hexdigest()
+        cache_file = os.path.join(cache_dir('pkgs'), key + '.json')
+
+    cached = index_load(cache_file)
+    records = dict()
+    packages = dict()
+
+    if os.path.isdir(pkgdir):
+        for entry in os.scandir(pkgdir):
+            if not entry.is_dir():
+                continue
+
+            # Packages still being extracted have no index.json yet. They
+            # are not recorded, so they are read once conda is done.
+            index_json = os.path.join(entry.path, 'info', 'index.json')
+            try:
+                mtime = os.stat(index_json).st_mtime_ns
+            except OSError:
+                continue
+
+            record = cached.get(entry.name)
+            if record is None or record['mtime'] != mtime:
+                record = dict(mtime=mtime, name=None, version=None)
+                with open(index_json) as fp:
+                    data = json.load(fp)
+                record['name'] = data.get('name')
+                record['version'] = data.get('version')
+
+            records[entry.name] = record
+            if not record['name']:
+                continue
+
+            versions = packages.setdefault(record['name'], dict())
+            versions.setdefault(record['version'], []).append(entry.path)
+
+    if records != cached:
+        index_save(cache_file, records)
+
+    return dict(pkgdir=pkgdir, cache_file=cache_file, dirty=False,
+                packages=packages, records=records)
+
+
+def pkgs_index_save(index):
+    """ Persist data gathered after the index was built (see `pkg_git_info`)
+
+    :param index: dict: data returned by `pkgs_index` method
+    """
+    if index['dirty']:
+        index_save(index['cache_file'], index['records'])
+        index['dirty'] = False
+
+
+def pkgs_lookup(index, name, operator=None, version=None):
+    """ Find an extracted package in a package cache index.
+    An exact version match is preferred. Otherwise the newest version
+    satisfying the constraint is returned.
+
+    :param index: dict: data returned by `pkgs_index` method
+    :param name: str: package name
+    :param operator: str: version operator (see `meta.version_match`)
+    :param version: str: requested version (None for any)
+    :returns: str: path to extracted package, or None
+    """
+    versions = index['packages'].get(name)
+    if not versions:
+        return None
+
+    if version and version.strip() in versions:
+        candidates = versions[version.strip()]
+    else:
+        matches = [x for x in versions
+                   if x and version_match(x, operator, version)]
+        if not matches:
+            return None
+
+        newest = matches[0]
+        for x in matches[1:]:
+            if version_compare(x, newest) > 0:
+                newest = x
+        candidates = versions[newest]
+
+    # Multiple builds of the same version: prefer the most recent
+    return max(candidates, key=lambda x: os.stat(x).st_mtime_ns)
+
+
+def pkg_git_info(index, path):
+    """ Retrieve the git repository URL and commit an extracted package was
+    built from. Results are stored alongside the package's index record
+    and persisted by `pkgs_index_save`.
+
+    :param index: dict: data returned by `pkgs_index` method
+    :param path: str: path to extracted package
+    :returns: dict: repository URL and commit, or None
+    """
+    record = index['records'].get(os.path.basename(path))
+    if record is not None and 'git' in record:
+        return record['git']
+
+    result = None
+    info_d = os.path.join(path, 'info')
+    git_log = os.path.join(info_d, 'git')
+    meta_yaml = os.path.join(info_d, 'recipe', 'meta.yaml')
+
+    if os.path.exists(git_log) and os.path.exists(meta_yaml):
+        git_log_data = open(git_log).readlines()
+
+        if git_log_data:
+            with open(meta_yaml) as yaml_data:
+                source = YAML(typ='safe').load(yaml_data).get('source')
+
+            if isinstance(source, dict) and source.get('git_url'):
+                result = dict(repo=source['git_url'],
+                              commit=git_log_data[1].split()[1])
+
+    if record is not None:
+        record['git'] = result
+        index['dirty'] = True
+
+    return result
@@ -0,0 +1,72 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+
+
+PROFILE_TOP = 30
+# From Python 3.12 cProfile uses sys.monitoring, which observes every thread
+# and allows only one active profiler
+PROFILE_ALL_THREADS = sys.version_info >= (3, 12)
+
+
+def profile_call(func, output_dir, top=PROFILE_TOP, name='profile'):
+    """ Execute `func` under cProfile. Threads started while `func` runs
+    (i.e. pipeline stages) are profiled as well and their statistics are
+    merged with those of the calling thread.
+
+    Writes `{name}.pstats` (load with `pstats.Stats` or snakeviz) and a
+    `{name}.txt` summary of the `top` most expensive functions by
+    cumulative and internal time to `output_dir`.
+
+    :param func: callable: takes no arguments
+    :param output_dir: str: path to store profiling data
+    :param top: int: number of functions listed in the summary
+    :param name: str: output file name prefix
+    :returns: value returned by `func`
+    """
+    profiles = []
+    lock = threading.Lock()
+
+    def thread_hook(*_):
+        # Replaces itself with a per-thread profiler on the first event
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active (the thread is already observed)
+            sys.setprofile(None)
+            return
+        with lock:
+            profiles.append(profile)
+
+    main = cProfile.Profile()
+    if not PROFILE_ALL_THREADS:
+        threading.setprofile(thread_hook)
+    main.enable()
+    try:
+        return func()
+    finally:
+        main.disable()
+        if not PROFILE_ALL_THREADS:
+            threading.setprofile(None)
+
+        stats = pstats.Stats(main)
+        with lock:
+            for profile in profiles:
+                profile.disable()
+                stats.add(profile)
+
+        os.makedirs(output_dir, exist_ok=True)
+        stats.dump_stats(os.path.join(output_dir, f'{name}.pstats'))
+
+        summary = io.StringIO()
+        stats.stream = summary
+        for key in ['cumulative', 'tottime']:
+            print(f'Top {top} functions by {key} time:', file=summary)
+            stats.sort_stats(key).print_stats(top)
+
+        with open(os.path.join(output_dir, f'{name}.txt'), 'w+') as fp:
+            fp.write(summary.getvalue())
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import os
+import requests
+import sys
+import time
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+from .cache import index_load, index_save
+from .conda import conda
+from .meta import version_key, version_match
+from .utils import cache_dir, file_lock
+
+
+# Seconds a remote channel's index is used before checking for changes
+REPODATA_MAX_AGE = 60 * 60
+# Seconds to wait for a repodata server to respond
+REPODATA_TIMEOUT = 60
+
+
+def _config_url(value):
+    """ Convert a channel reported by `conda config --json` to a URL
+    :param value: str or dict: URL, or channel components
+    :returns: str
+    """
+    if isinstance(value, dict):
+        value = f"{value['scheme']}://{value['location']}/" \
+                f"{value.get('name') or ''}"
+    return value.rstrip('/')
+
+
+def channel_config():
+    """ Read the channel settings of the active conda installation
+    (which include any .condarc)
+
+    :returns: dict: default_channels (list of URLs) and channel_alias (URL),
+              or None when conda cannot report them
+    """
+    try:
+        proc = conda('config', '--show', 'default_channels', 'channel_alias',
+                     '--json')
+        if proc.returncode:
+            return None
+        data = json.loads(proc.stdout.decode())
+        return dict(default_channels=[_config_url(x)
+                                      for x in data['default_channels']],
+                    channel_alias=_config_url(data['channel_alias']))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def channel_urls(channel, config=None):
+    """ Expand a conda channel to base URLs
+
+    :param channel: str: URL, local path, name, or "defaults"
+    :param config: dict: data returned by `channel_config` (required to
+                   expand "defaults" and channel names)
+    :returns: list: base URLs (without subdir), or None when the channel
+              cannot be expanded without `config`
+    """
+    if '://' in channel:
+        return [channel.rstrip('/')]
+    if os.path.isabs(channel):
+        return ['file://' + channel.rstrip('/')]
+    if config is None:
+        return None
+    if channel == 'defaults':
+        return list(config['default_channels'])
+    return [f"{config['channel_alias']}/{channel}"]
+
+
+def repodata_versions(data):
+    """ Reduce the contents of a repodata.json to the versions of each
+    package
+
+    :param data: dict: repodata
+    :returns: dict: package name -> list of versions (ascending)
+    """
+    result = dict()
+    for key in ['packages', 'packages.conda']:
+        for record in data.get(key, dict()).values():
+            result.setdefault(record['name'], set()).add(record['version'])
+    return {name: sorted(versions, key=version_key)
+            for name, versions in result.items()}
+
+
+def repodata_fetch(url, cache_root=None, max_age=REPODATA_MAX_AGE,
+                   session=None):
+    """ Retrieve the index of a repodata.json. The index is persisted and
+    only rebuilt when the repodata changed: local (file://) repodata is
+    compared by modification time, and remote repodata is revalidated
+    (If-None-Match / If-Modified-Since) once the index is `max_age` old.
+
+    :param url: str: URL of repodata.json
+    :param cache_root: str: path to index cache
+                       (default: `utils.cache_dir('repodata')`)
+    :param max_age: float: seconds a remote index is used without checking
+    :param session: requests.Session: connection pool to use (optional)
+    :returns: dict: package name -> list of versions
+    :raises OSError: when the repodata cannot be read
+    :raises requests.HTTPError: via raise_for_status method
+    """
+    cache_root = cache_root or cache_dir('repodata')
+    os.makedirs(cache_root, exist_ok=True)
+    digest = hashlib.sha256(url.encode()).hexdigest()[:16]
+    filename = os.path.join(cache_root, f'{digest}.json')
+    parsed = urlparse(url)
+
+    with file_lock(filename + '.lock'):
+        cached = index_load(filename)
+        now = time.time()
+
+        if parsed.scheme == 'file':
+            path = url2pathname(parsed.path)
+            mtime = os.path.getmtime(path)
+            if cached.get('mtime') == mtime:
+                return cached['packages']
+            with open(path) as fp:
+                data = json.load(fp)
+            validators = dict(mtime=mtime)
+        else:
+            if cached and now - cached['checked'] < max_age:
+                return cached['packages']
+
+            headers = dict()
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+            response = (session or requests).get(url, headers=headers,
+                                                 timeout=REPODATA_TIMEOUT)
+            if cached and response.status_code == 304:
+                cached['checked'] = now
+                index_save(filename, cached)
+                return cached['packages']
+            response.raise_for_status()
+            data = response.json()
+            validators = dict(etag=response.headers.get('ETag'),
+                              last_modified=response.headers.get(
+                                  'Last-Modified'))
+
+        record = dict(validators, url=url, checked=now,
+                      packages=repodata_versions(data))
+        index_save(filename, record)
+    return record['packages']
+
+
+def repodata_index(channels, subdir, cache_root=None,
+                   max_age=REPODATA_MAX_AGE, session=None, config=None):
+    """ Combine the indexes of each channel's `subdir` and noarch repodata
+
+    :param channels: list: conda channels (see `channel_urls`)
+    :param subdir: str: platform subdirectory (i.e. `linux-64`)
+    :param cache_root: str: path to index cache
+    :param max_age: float: seconds a remote index is used without checking
+    :param session: requests.Session: connection pool to use (optional)
+    :param config: dict: data returned by `channel_config` (read from conda
+                   when needed and omitted)
+    :returns: tuple: (dict of package name -> set of versions, list of
+              repodata URLs (or channels) that could not be read)
+    """
+    if config is None and any([channel_urls(x) is None for x in channels]):
+        config = channel_config()
+
+    session = session or requests.Session()
+    result = dict()
+    missing = []
+    for channel in channels:
+        bases = channel_urls(channel, config)
+        if bases is None:
+            print(f"Channel unresolved: {channel}: conda did not report "
+                  "its channel configuration", file=sys.stderr)
+            missing.append(channel)
+            continue
+
+        for base in bases:
+            for platform in [subdir, 'noarch']:
+                url = f'{base}/{platform}/repodata.json'
+                try:
+                    packages = repodata_fetch(url, cache_root, max_age,
+                                              session)
+                except (OSError, ValueError) as e:
+                    print(f"Repodata unavailable: {url}: {e}",
+                          file=sys.stderr)
+                    missing.append(url)
+                    continue
+                for name, versions in packages.items():
+                    result.setdefault(name, set()).update(versions)
+    return result, missing
+
+
+def repodata_unsatisfiable(records, index):
+    """ Find `dmfile` records that no indexed package can satisfy.
+    Only the version of a record is evaluated (build strings are ignored).
+
+    :param records: list: data returned by `merge.dmfile` method
+    :param index: dict: package name -> versions (see `repodata_index`)
+    :returns: list: of (record, reason) tuples
+    """
+    result = []
+    for record in records:
+        versions = index.get(record['name'].lower())
+        if not versions:
+            result.append((record, 'not found in any channel'))
+            continue
+
+        version = (record['version'] or '').split()
+        if not version:
+            continue
+        if not any([version_match(x, record['operator'], version[0])
+                    for x in versions]):
+            available = sorted(versions, key=version_key)[-5:]
+            result.append((record, 'no matching version (latest: '
+                                   f'{", ".join(available)})'))
+    return result
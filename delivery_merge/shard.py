@@ -0,0 +1,133 @@
+import hashlib
+import os
+from .cache import index_load, index_save
+from .junit import junit_times
+from .utils import cache_dir
+
+
+# Seconds assumed for test modules without recorded durations
+SHARD_DEFAULT_DURATION = 1.0
+# pytest exit statuses of completed runs: all passed, some failed,
+# no tests collected
+PYTEST_OK = [0, 1, 5]
+
+
+def shard_modules(lines):
+    """ Extract test modules from the output of `pytest --collect-only -q`
+
+    :param lines: iterable: output lines (str)
+    :returns: list: module paths, in order of collection
+    """
+    result = []
+    for line in lines:
+        line = line.strip()
+        if '::' not in line:
+            continue
+        module = line.split('::', 1)[0]
+        if module not in result:
+            result.append(module)
+    return result
+
+
+def shard_collect(env, cwd, logfile=None):
+    """ Collect the test modules of a project with pytest. Modules that
+    fail to import are not listed by pytest, so nothing is returned when
+    collection reports an error.
+
+    :param env: CondaEnv: environment handle
+    :param cwd: str: path to project
+    :param logfile: str: write pytest's output to this file
+    :returns: list: module paths relative to `cwd`, or None when collection
+              failed
+    """
+    lines = []
+
+    def collect(name, line):
+        if name == 'stdout':
+            lines.append(line.decode(errors='replace'))
+
+    proc = env.sh_stream('python', '-m pytest --collect-only -q', cwd=cwd,
+                         echo=False, logfile=logfile, callback=collect)
+    if proc.returncode not in PYTEST_OK:
+        return None
+    return shard_modules(lines)
+
+
+def shard_history_file(repo, cache_root=None):
+    """ Path to the recorded test durations of a repository
+    :param repo: str: repository URL
+    :param cache_root: str: path to durations cache
+                       (default: `utils.cache_dir('durations')`)
+    :returns: str
+    """
+    cache_root = cache_root or cache_dir('durations')
+    digest = hashlib.sha256(repo.encode()).hexdigest()[:16]
+    return os.path.join(cache_root, f'{digest}.json')
+
+
+def shard_history_update(repo, result, cache_root=None):
+    """ Record the test durations found in a junit XML report
+
+    :param repo: str: repository URL
+    :param result: str: path to XML report
+    :param cache_root: str: path to durations cache
+    :returns: dict: class name -> seconds
+    """
+    filename = shard_history_file(repo, cache_root)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    data = index_load(filename)
+    data.update(junit_times(result))
+    index_save(filename, data)
+    return data
+
+
+def shard_durations(modules, history):
+    """ Estimate the duration of each test module. Recorded class names
+    (e.g. pkg.tests.test_mod.TestClass) are attributed to the module with the
+    longest matching dotted path (e.g. pkg/tests/test_mod.py).
+
+    :param modules: list: module paths
+    :param history: dict: class name -> seconds
+    :returns: dict: module path -> seconds
+    """
+    dotted = {os.path.splitext(x)[0].replace(os.path.sep, '.'): x
+              for x in modules}
+    result = {x: 0.0 for x in modules}
+    known = set()
+
+    for classname, seconds in history.items():
+        parts = classname.split('.')
+        for i in range(len(parts), 0, -1):
+            module = dotted.get('.'.join(parts[:i]))
+            if module is None:
+                continue
+            result[module] += seconds
+            known.add(module)
+            break
+
+    for module in modules:
+        if module not in known:
+            result[module] = SHARD_DEFAULT_DURATION
+    return result
+
+
+def shard_balance(modules, durations, shards):
+    """ Distribute test modules across shards so each shard's total duration
+    is about equal. The longest modules are placed first, each on the shard
+    with the least work assigned so far.
+
+    :param modules: list: module paths
+    :param durations: dict: module path -> seconds
+    :param shards: int: number of shards
+    :returns: list: of module lists (empty shards are omitted)
+    """
+    result = [[] for _ in range(max(1, shards))]
+    totals = [0.0] * len(result)
+
+    ordered = sorted(modules, key=lambda x: (-durations.get(x, 0.0), x))
+    for module in ordered:
+        i = totals.index(min(totals))
+        result[i].append(module)
+        totals[i] += durations.get(module, 0.0)
+
+    return [sorted(x) for x in result if x]
@@ -0,0 +1,126 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# Collectors receiving resource usage of subprocesses in the current context
+_COLLECTORS = ContextVar('delivery_merge_timing_collectors', default=())
+
+
+class Usage:
+    """ Resource usage accumulated by a unit of work (a pipeline stage or
+    a package's tests)
+    """
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.cpu_children = 0.0
+        self.max_rss_children = 0
+        self.commands = 0
+        self.commands_failed = 0
+        self.status = None
+
+    def add_child(self, rusage, returncode):
+        """ Account for a finished subprocess
+        :param rusage: resource.struct_rusage: as returned by `os.wait4`
+        :param returncode: int: exit status of subprocess
+        """
+        # ru_maxrss is reported in bytes on macOS and KiB elsewhere
+        max_rss = rusage.ru_maxrss
+        if sys.platform == 'darwin':
+            max_rss //= 1024
+
+        self.cpu_children += rusage.ru_utime + rusage.ru_stime
+        self.max_rss_children = max(self.max_rss_children, max_rss)
+        self.commands += 1
+        if returncode:
+            self.commands_failed += 1
+
+    def as_dict(self):
+        """ :returns: dict: JSON serializable usage data
+        """
+        return dict(status=self.status,
+                    wall=round(self.wall, 3),
+                    cpu=round(self.cpu, 3),
+                    cpu_children=round(self.cpu_children, 3),
+                    max_rss_children_kb=self.max_rss_children,
+                    commands=self.commands,
+                    commands_failed=self.commands_failed)
+
+
+def record_child(rusage, returncode):
+    """ Report a finished subprocess to every active collector
+    :param rusage: resource.struct_rusage: as returned by `os.wait4`
+    :param returncode: int: exit status of subprocess
+    """
+    for usage in _COLLECTORS.get():
+        usage.add_child(rusage, returncode)
+
+
+@contextmanager
+def usage_collect():
+    """ Measure wall time, CPU time of the calling thread, and resources
+    used by subprocesses started (via `utils.sh`) within the block.
+    Collectors nest. Outer collectors include the usage of inner ones.
+    Status is set to "ok" unless the block raises.
+
+    >>> with usage_collect() as usage:
+    >>>     sh('true')
+    >>> usage.as_dict()
+
+    :returns: Usage
+    """
+    usage = Usage()
+    token = _COLLECTORS.set(_COLLECTORS.get() + (usage,))
+    start = time.monotonic()
+    start_cpu = time.thread_time()
+    try:
+        yield usage
+        usage.status = 'ok'
+    except BaseException:
+        usage.status = 'failed'
+        raise
+    finally:
+        usage.wall = time.monotonic() - start
+        usage.cpu = time.thread_time() - start_cpu
+        _COLLECTORS.reset(token)
+
+
+def timings_table(rows):
+    """ Format timing data as a human readable table
+
+    :param rows: list: of (label, dict returned by `Usage.as_dict`) tuples
+    :returns: str
+    """
+    header = ['Name', 'Status', 'Wall(s)', 'CPU(s)', 'Child CPU(s)',
+              'Peak RSS(MB)', 'Commands']
+    lines = [header]
+    for label, data in rows:
+        lines.append([label,
+                      str(data.get('status')),
+                      f"{data.get('wall', 0):.2f}",
+                      f"{data.get('cpu', 0):.2f}",
+                      f"{data.get('cpu_children', 0):.2f}",
+                      f"{data.get('max_rss_children_kb', 0) / 1024:.1f}",
+                      f"{data.get('commands', 0)}"
+                      f"/{data.get('commands_failed', 0)} failed"])
+
+    widths = [max([len(x[i]) for x in lines]) for i in range(len(header))]
+    result = []
+    for line in lines:
+        cells = [line[0].ljust(widths[0]), line[1].ljust(widths[1])]
+        cells += [x.rjust(w) for x, w in zip(line[2:], widths[2:])]
+        result.append('  '.join(cells))
+    return '\n'.join(result)
+
+
+def timings_write(filename, data):
+    """ Write timing data as JSON
+    :param filename: str: path to output file
+    :param data: dict: timing data
+    """
+    with open(filename, 'w+') as fp:
+        json.dump(data, fp, indent=2)
+        fp.write('\n')
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+
+
+# Path to the JSONL trace file. Tracing is disabled when unset.
+TRACE_ENV = 'DELIVERY_MERGE_TRACE'
+
+_TRACE_LOCK = threading.Lock()
+
+
+def trace_file():
+    """ :returns: str: path to the active trace file, or None
+    """
+    return os.environ.get(TRACE_ENV) or None
+
+
+def trace_enable(filename):
+    """ Enable tracing for this process and any process it starts
+
+    :param filename: str: path to JSONL trace file (appended to)
+    """
+    os.environ[TRACE_ENV] = os.path.abspath(filename)
+
+
+def trace_record(argv, cwd, environ, start, end, returncode,
+                 stdout_size=0, stderr_size=0):
+    """ Append a subprocess invocation to the active trace file.
+    Does nothing unless tracing is enabled.
+
+    :param argv: list: command and arguments
+    :param cwd: str: working directory (None: current directory)
+    :param environ: dict: runtime environment of the command
+    :param start: float: start time (seconds since the epoch)
+    :param end: float: end time (seconds since the epoch)
+    :param returncode: int: exit status
+    :param stdout_size: int: bytes written to stdout
+    :param stderr_size: int: bytes written to stderr
+    """
+    filename = trace_file()
+    if filename is None:
+        return
+
+    record = dict(argv=list(argv),
+                  cwd=os.path.abspath(cwd or os.getcwd()),
+                  env=environ.get('CONDA_DEFAULT_ENV'),
+                  start=start,
+                  end=end,
+                  duration=round(end - start, 6),
+                  returncode=returncode,
+                  stdout_size=stdout_size,
+                  stderr_size=stderr_size,
+                  pid=os.getpid(),
+                  tid=threading.get_ident())
+
+    # One write per record on an O_APPEND descriptor keeps lines intact
+    # when several processes share the trace file
+    line = (json.dumps(record) + '\n').encode()
+    with _TRACE_LOCK:
+        fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+def trace_read(filename):
+    """ Read a JSONL trace file
+
+    :param filename: str: path to trace file
+    :returns: list: of dicts, one per subprocess invocation
+    """
+    result = []
+    with open(filename) as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                result.append(json.loads(line))
+    return result
+
+
+def trace_to_chrome(filename, output):
+    """ Convert a JSONL trace to the Chrome trace-event format
+    (viewable with chrome://tracing or https://ui.perfetto.dev)
+
+    :param filename: str: path to JSONL trace file
+    :param output: str: path to output file
+    :returns: int: number of events written
+    """
+    records = trace_read(filename)
+    origin = min([x['start'] for x in records], default=0)
+    events = []
+
+    for record in records:
+        events.append(dict(
+            name=os.path.basename(record['argv'][0]),
+            cat='subprocess',
+            ph='X',
+            ts=round((record['start'] - origin) * 1e6),
+            dur=round((record['end'] - record['start']) * 1e6),
+            pid=record['pid'],
+            tid=record['tid'],
+            args=dict(argv=' '.join(record['argv']),
+                      cwd=record['cwd'],
+                      env=record['env'],
+                      returncode=record['returncode'],
+                      stdout_size=record['stdout_size'],
+                      stderr_size=record['stderr_size'])))
+
+    with open(output, 'w+') as fp:
+        json.dump(dict(traceEvents=events, displayTimeUnit='ms'), fp)
+    return len(events)
@@ -1,6 +1,24 @@
+import fcntl
+import hashlib
 import os
+import requests
+import sys
+import threading
+import time
+from collections import deque
 from contextlib import contextmanager
-from subprocess import run
+from .limits import limits_current, limits_watch
+from .timing import record_child
+from .trace import trace_record
+from subprocess import PIPE, CompletedProcess, Popen
+
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+SH_TAIL_SIZE = 64 << 10
+
+
+class ChecksumMismatch(Exception):
+    pass
 
 
 def comment_find(s, delims=[';', '#']):
@@ -18,29 +36,199 @@ def comment_find(s, delims=[';', '#']):
     return index
 
 
-def sh(prog, *args):
+def runtime_env(env=None):
+    """ Resolve the runtime environment used to execute a program
+    :param env: dict, object with an `environ` attribute, or None
+                When None the current `os.environ` is used
+    :returns: dict-like: environment variables
+    """
+    if env is None:
+        return os.environ
+    return getattr(env, 'environ', env)
+
+
+class RingBuffer:
+    """ Retain the most recent `maxbytes` of a byte stream
+
+    :param maxbytes: int: maximum number of bytes retained (None: unlimited)
+    """
+    def __init__(self, maxbytes=SH_TAIL_SIZE):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.total = 0
+        self.data = deque()
+
+    def append(self, chunk):
+        """ Add data, discarding the oldest data when full
+        :param chunk: bytes
+        """
+        self.total += len(chunk)
+        if self.maxbytes is not None and len(chunk) > self.maxbytes:
+            chunk = chunk[-self.maxbytes:]
+
+        self.data.append(chunk)
+        self.size += len(chunk)
+        while self.maxbytes is not None and self.size > self.maxbytes:
+            oldest = self.data.popleft()
+            excess = self.size - self.maxbytes
+            if len(oldest) > excess:
+                self.data.appendleft(oldest[excess:])
+                self.size -= excess
+            else:
+                self.size -= len(oldest)
+
+    def getvalue(self):
+        """ :returns: bytes: retained data
+        """
+        return b''.join(self.data)
+
+
+def _command(prog, args):
+    """ Build an argument vector (see `sh`)
+    """
+    command = [prog]
+    for arg in args:
+        command += arg.split()
+    return command
+
+
+def _wait(proc):
+    """ Wait for a process to exit and report its resource usage to
+    `timing.record_child`
+
+    :param proc: subprocess.Popen
+    :returns: int: exit status (negative when killed by a signal)
+    """
+    _, status, rusage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    record_child(rusage, proc.returncode)
+    return proc.returncode
+
+
+def _execute(command, env=None, cwd=None, logfile=None, echo=False,
+             callback=None, tail=None):
+    """ Execute a command, reading its output line by line
+
+    See `sh_stream` for a description of the arguments.
+    :returns: subprocess.CompletedProcess
+    """
+    buffers = dict(stdout=RingBuffer(tail), stderr=RingBuffer(tail))
+    lock = threading.Lock()
+    log = None
+
+    if logfile:
+        os.makedirs(os.path.dirname(os.path.abspath(logfile)), exist_ok=True)
+        log = open(logfile, 'wb')
+
+    def reader(name, pipe):
+        for line in iter(pipe.readline, b''):
+            buffers[name].append(line)
+            if log is not None or echo:
+                with lock:
+                    if log is not None:
+                        log.write(line)
+                        log.flush()
+                    if echo:
+                        output = sys.stdout if name == 'stdout' \
+                            else sys.stderr
+                        print(line.decode(errors='replace'), end='',
+                              file=output)
+            if callback is not None:
+                callback(name, line)
+        pipe.close()
+
+    # Commands started within `limits.resource_limits` run in their own
+    # process group, so the group can be killed when a limit is exceeded
+    limits = limits_current()
+    if limits is not None:
+        limits.check()
+
+    environ = runtime_env(env)
+    start = time.time()
+    done = threading.Event()
+    try:
+        with Popen(command, stdout=PIPE, stderr=PIPE, env=environ,
+                   cwd=cwd, start_new_session=limits is not None) as proc:
+            if limits is not None:
+                limits_watch(proc.pid, limits, done)
+            readers = [threading.Thread(target=reader,
+                                        args=(x, getattr(proc, x)))
+                       for x in ['stdout', 'stderr']]
+            for thread in readers:
+                thread.start()
+            for thread in readers:
+                thread.join()
+            returncode = _wait(proc)
+    finally:
+        done.set()
+        if log is not None:
+            log.close()
+
+    trace_record(command, cwd, environ, start, time.time(), returncode,
+                 buffers['stdout'].total, buffers['stderr'].total)
+
+    if limits is not None:
+        limits.check()
+
+    return CompletedProcess(command, returncode,
+                            stdout=buffers['stdout'].getvalue(),
+                            stderr=buffers['stderr'].getvalue())
+
+
+def sh(prog, *args, env=None, cwd=None):
     """ Execute a program with arguments
     :param prog: str: path to program
     :param args: tuple: variadic arguments
                  Accepts any combination of strings passed as arguments
+    :param env: dict or environment handle (see `runtime_env`)
+    :param cwd: str: working directory of the program
     :returns: subprocess.CompletedProcess
+    :raises delivery_merge.limits.ResourceLimitExceeded: when a limit set by
+            `limits.resource_limits` is exceeded
     """
-    command = [prog]
-    tmp = []
-    for arg in args:
-        tmp += arg.split()
+    command = _command(prog, args)
+    print(f'Running: {" ".join(command)}')
+    return _execute(command, env=env, cwd=cwd)
+
 
-    command += tmp
+def sh_stream(prog, *args, env=None, cwd=None, logfile=None, echo=True,
+              callback=None, tail=SH_TAIL_SIZE):
+    """ Execute a program with arguments, processing its output line by line
+    as it is produced. Memory use is bounded by `tail` regardless of how
+    much output the program emits.
+
+    :param prog: str: path to program
+    :param args: tuple: variadic arguments (see `sh`)
+    :param env: dict or environment handle (see `runtime_env`)
+    :param cwd: str: working directory of the program
+    :param logfile: str: path to file receiving stdout and stderr (optional)
+    :param echo: bool: print output to the console
+    :param callback: callable: invoked with ('stdout' or 'stderr', bytes)
+                     for every line of output (optional)
+    :param tail: int: bytes of stdout and stderr to retain
+    :returns: subprocess.CompletedProcess: stdout and stderr hold the last
+              `tail` bytes of output
+    :raises delivery_merge.limits.ResourceLimitExceeded: when a limit set by
+            `limits.resource_limits` is exceeded
+    """
+    command = _command(prog, args)
     print(f'Running: {" ".join(command)}')
-    return run(command, capture_output=True, env=os.environ)
+    return _execute(command, env=env, cwd=cwd, logfile=logfile, echo=echo,
+                    callback=callback, tail=tail)
 
 
-def git(*args):
+def git(*args, env=None, cwd=None):
     """ Execute git commands
     :param args: tuple: variadic arguments to pass to git
+    :param env: dict or environment handle (see `runtime_env`)
+    :param cwd: str: working directory
     :returns: subprocess.CompletedProcess
     """
-    return sh('git', *args)
+    return sh('git', *args, env=env, cwd=cwd)
 
 
 def getenv(s):
@@ -70,3 +258,102 @@ def pushd(path):
         yield
     finally:
         os.chdir(last)
+
+
+def cache_dir(*parts):
+    """ Return a path inside the shared delivery_merge cache, creating it if
+    necessary. The cache root is taken from $DELIVERY_MERGE_CACHE, falling
+    back to $XDG_CACHE_HOME/delivery_merge or ~/.cache/delivery_merge.
+
+    :param parts: tuple: path components relative to the cache root
+    :returns: str: absolute path
+    """
+    root = os.environ.get('DELIVERY_MERGE_CACHE')
+    if not root:
+        xdg = os.environ.get('XDG_CACHE_HOME',
+                             os.path.join(os.path.expanduser('~'), '.cache'))
+        root = os.path.join(xdg, 'delivery_merge')
+
+    path = os.path.abspath(os.path.join(root, *parts))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def file_hash(filename, algo='sha256', chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """ Compute the digest of a file
+    :param filename: str: path to file
+    :param algo: str: hashlib algorithm name
+    :param chunk_size: int: bytes to read at a time
+    :returns: str: hex digest
+    """
+    digest = hashlib.new(algo)
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """ Hold an advisory lock for the duration of the block
+    :param path: str: path to lock file (created if necessary)
+    :param shared: bool: acquire a shared lock, which may be held by any
+                   number of holders at once (but never alongside an
+                   exclusive lock)
+    """
+    with open(path, 'a+') as fp:
+        fcntl.flock(fp, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def download(url, dest, digest=None, algo='sha256', session=None,
+             chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """ Download a file. Data is written to `dest`.part first, so an
+    interrupted transfer is resumed (via an HTTP Range request) by the next
+    call. The destination only appears once the transfer is complete and,
+    when `digest` is given, verified.
+
+    :param url: str: URL to retrieve
+    :param dest: str: path to output file
+    :param digest: str: expected hex digest of the file (optional)
+    :param algo: str: hashlib algorithm used by `digest`
+    :param session: requests.Session: connection pool to use (optional)
+    :param chunk_size: int: bytes to write at a time
+    :returns: str: path to output file
+    :raises delivery_merge.utils.ChecksumMismatch: when verification fails
+    :raises requests.HTTPError: via raise_for_status method
+    """
+    session = session or requests
+    partial = dest + '.part'
+    offset = 0
+    if os.path.exists(partial):
+        offset = os.path.getsize(partial)
+
+    headers = {}
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+
+    with session.get(url, stream=True, headers=headers) as data:
+        if offset and data.status_code == 416:
+            # The partial file is unusable. Start over.
+            os.remove(partial)
+            return download(url, dest, digest, algo, session, chunk_size)
+
+        data.raise_for_status()
+        mode = 'ab' if offset and data.status_code == 206 else 'wb'
+        with open(partial, mode) as fd:
+            for chunk in data.iter_content(chunk_size=chunk_size):
+                fd.write(chunk)
+
+    if digest is not None:
+        result = file_hash(partial, algo)
+        if result != digest:
+            os.remove(partial)
+            raise ChecksumMismatch(f'{url}: expected {algo} {digest}, '
+                                   f'got {result}')
+
+    os.replace(partial, dest)
+    return dest
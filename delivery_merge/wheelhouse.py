@@ -0,0 +1,128 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from .cache import index_load, lru_touch
+from .conda import conda_env_handle
+from .meta import conda_meta
+from .utils import cache_dir, file_lock
+
+
+# Installed once per environment, before any package is tested. The
+# environment's setuptools and wheel are provided by conda and left as-is.
+TEST_TOOLS = ['pip', 'pytest', 'ci-watson']
+
+
+def wheelhouse_key(requirements, conda_env, *inputs):
+    """ Compute the wheelhouse key of a set of requirements. Wheels depend
+    on the interpreter, so the environment's python version and platform
+    are included.
+
+    :param requirements: list: pip requirement specifiers
+    :param conda_env: str or CondaEnv: conda environment name or handle
+    :param inputs: additional values the requirements depend on
+                   (e.g. the commit of a local project)
+    :returns: str: hex digest
+    """
+    env = conda_env_handle(conda_env)
+    python = conda_meta(env.prefix).get('python', dict())
+    data = [python.get('version', ''), python.get('subdir', '')]
+    data += sorted(requirements) + [str(x) for x in inputs]
+    return hashlib.sha256('\n'.join(data).encode()).hexdigest()
+
+
+def wheelhouse_fetch(requirements, conda_env, key=None, cwd=None,
+                     logfile=None, cache_root=None):
+    """ Download `requirements`, and their dependencies, into the wheelhouse.
+    Nothing is downloaded when the same key was fetched before. Different
+    keys may be fetched concurrently.
+
+    :param requirements: list: pip requirement specifiers
+    :param conda_env: str or CondaEnv: conda environment name or handle
+    :param key: str: value returned by `wheelhouse_key` (computed when
+                omitted)
+    :param cwd: str: change directory (i.e. to resolve a local project)
+    :param logfile: str: write pip's output to this file
+    :param cache_root: str: path to wheelhouse
+                       (default: `utils.cache_dir('wheels')`)
+    :returns: bool: True when the wheelhouse was already up to date
+    :raises subprocess.CalledProcessError: via check_returncode method
+    """
+    env = conda_env_handle(conda_env)
+    wheels = cache_root or cache_dir('wheels')
+    os.makedirs(wheels, exist_ok=True)
+    index = os.path.join(wheels, 'index.json')
+    key = key or wheelhouse_key(requirements, env)
+
+    # Each key has a lock of its own, so different requirements download in
+    # parallel. The index is locked by each update (see `cache.lru_touch`).
+    with file_lock(os.path.join(wheels, f'.{key}.lock')):
+        if key in index_load(index):
+            lru_touch(index, key)
+            return True
+
+        # Wheels are moved into the wheelhouse once complete
+        dest = tempfile.mkdtemp(prefix='.download-', dir=wheels)
+        try:
+            proc = env.sh_stream('python', '-m pip download',
+                                 f'--dest {dest} --find-links {wheels}',
+                                 ' '.join(requirements),
+                                 cwd=cwd, echo=False, logfile=logfile)
+            proc.check_returncode()
+            for name in os.listdir(dest):
+                os.replace(os.path.join(dest, name),
+                           os.path.join(wheels, name))
+        finally:
+            shutil.rmtree(dest, ignore_errors=True)
+
+        lru_touch(index, key, requirements=list(requirements))
+    return False
+
+
+def wheelhouse_install(requirements, conda_env, key=None, cwd=None,
+                       logfile=None, cache_root=None, args=''):
+    """ Install `requirements` from the wheelhouse. The wheelhouse is
+    refreshed first when the requirements (i.e. their key) changed. When
+    the wheelhouse cannot satisfy the requirements (or cannot be refreshed)
+    the package index is used. `pip download` does not keep the build
+    requirements (PEP 517) of projects built from source, so installing
+    such a project still falls back to the index.
+
+    :param requirements: list: pip requirement specifiers
+    :param conda_env: str or CondaEnv: conda environment name or handle
+    :param key: str: value returned by `wheelhouse_key` (computed when
+                omitted)
+    :param cwd: str: change directory (i.e. to resolve a local project)
+    :param logfile: str: write pip's output to this file. The output of
+                    `wheelhouse_fetch` and of the install from the package
+                    index are written alongside it (*-download.log and
+                    *-index.log)
+    :param cache_root: str: path to wheelhouse
+                       (default: `utils.cache_dir('wheels')`)
+    :param args: str: additional arguments passed to `pip install`
+    :returns: subprocess.CompletedProcess
+    """
+    env = conda_env_handle(conda_env)
+    wheels = cache_root or cache_dir('wheels')
+    packages = ' '.join(requirements)
+    download_log = None
+    index_log = None
+    if logfile:
+        download_log = os.path.splitext(logfile)[0] + '-download.log'
+        index_log = os.path.splitext(logfile)[0] + '-index.log'
+
+    try:
+        wheelhouse_fetch(requirements, env, key=key, cwd=cwd,
+                         logfile=download_log, cache_root=cache_root)
+    except Exception as e:
+        print(f"Wheelhouse refresh failed: {e}")
+
+    proc = env.sh_stream('python', '-m pip install', args,
+                         f'--no-index --find-links {wheels}', packages,
+                         cwd=cwd, echo=False, logfile=logfile)
+    if not proc.returncode:
+        return proc
+
+    return env.sh_stream('python', '-m pip install', args,
+                         f'--find-links {wheels}', packages,
+                         cwd=cwd, echo=False, logfile=index_log)
@@ -7,6 +7,7 @@ setup(
     entry_points={
         'console_scripts': [
             'delivery_merge=delivery_merge.cli.merge:main',
+            'delivery_merge_batch=delivery_merge.cli.batch:main',
         ],
     },
     install_requires=[
@@ -0,0 +1,100 @@
+import os
+import pytest
+from argparse import Namespace
+from delivery_merge.cli import batch
+from delivery_merge.cli import merge as cli_merge
+
+
+MANIFEST = """jobs:
+  - env_name: delivery_py36
+    base_spec: specs/py36.txt
+    dmfile: release.dm
+  - env_name: delivery_py37
+    base_spec: /abs/py37.txt
+    dmfile: release.dm
+    channels: defaults
+"""
+
+
+class TestBatch:
+    def setup_class(self):
+        self.root = os.path.abspath('batch_manifest')
+        os.makedirs(self.root, exist_ok=True)
+        self.manifest = os.path.join(self.root, 'manifest.yml')
+        open(self.manifest, 'w+').write(MANIFEST)
+        self.args = Namespace(installer_version='4.5.12',
+                              installer_sha256=None,
+                              test_jobs=2,
+                              max_templates=3,
+                              run_tests=True,
+                              force_solve=False,
+                              validate=False,
+                              restart=False,
+                              test_cache=False,
+                              shards=4,
+                              test_timeout=3600.0,
+                              test_max_rss=None)
+
+    def test_manifest_read(self):
+        jobs = batch.manifest_read(self.manifest)
+        assert jobs == [
+            dict(env_name='delivery_py36',
+                 base_spec=os.path.join(self.root, 'specs', 'py36.txt'),
+                 dmfile=os.path.join(self.root, 'release.dm'),
+                 channels=[]),
+            dict(env_name='delivery_py37',
+                 base_spec='/abs/py37.txt',
+                 dmfile=os.path.join(self.root, 'release.dm'),
+                 channels=['defaults']),
+        ]
+
+    @pytest.mark.parametrize('data', [
+        '',
+        'jobs: []\n',
+        'jobs:\n  - env_name: a\n    dmfile: b\n',
+        'jobs:\n  - env_name: a\n    dmfile: b\n    base_spec: c\n'
+        '  - env_name: a\n    dmfile: b\n    base_spec: c\n',
+    ])
+    def test_manifest_read_invalid(self, data):
+        filename = os.path.join(self.root, 'invalid.yml')
+        open(filename, 'w+').write(data)
+        with pytest.raises(batch.InvalidManifest):
+            batch.manifest_read(filename)
+
+    def test_job_argv(self):
+        job = batch.manifest_read(self.manifest)[1]
+        argv = batch.job_argv(job, self.args, '/out/delivery_py37')
+        args = cli_merge.arg_parser().parse_args(argv)
+        assert args.env_name == 'delivery_py37'
+        assert args.output_dir == '/out/delivery_py37'
+        assert args.src_dir == '/out/delivery_py37/src'
+        assert args.base_spec == '/abs/py37.txt'
+        assert args.channels == ['defaults']
+        assert args.jobs == 2 and args.shards == 4 and args.run_tests and not args.force_solve
+        assert not args.trace and not args.test_cache and not args.validate
+        assert args.test_timeout == 3600.0 and args.test_max_rss is None
+
+    def test_batch_worker(self, monkeypatch):
+        def run(args):
+            print(f'building {args.env_name}')
+            return 0
+
+        logfile = os.path.join(self.root, 'ok.log')
+        monkeypatch.setattr(cli_merge, 'run', run)
+        argv = batch.job_argv(batch.manifest_read(self.manifest)[0],
+                              self.args, self.root)
+        returncode, error, elapsed = batch._batch_worker(argv, logfile)
+        assert (returncode, error) == (0, None) and elapsed >= 0
+        assert open(logfile).read() == 'building delivery_py36\n'
+
+    def test_batch_worker_error(self, monkeypatch):
+        def run(args):
+            raise RuntimeError('broken')
+
+        logfile = os.path.join(self.root, 'error.log')
+        monkeypatch.setattr(cli_merge, 'run', run)
+        argv = batch.job_argv(batch.manifest_read(self.manifest)[0],
+                              self.args, self.root)
+        returncode, error, _ = batch._batch_worker(argv, logfile)
+        assert (returncode, error) == (1, 'RuntimeError: broken')
+        assert 'Traceback' in open(logfile).read()
@@ -0,0 +1,37 @@
+import importlib.util
+import json
+import os
+
+
+BENCH = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                     'benchmarks', 'bench.py')
+
+
+def load_bench():
+    spec = importlib.util.spec_from_file_location('bench', BENCH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class TestBenchmarks:
+    def test_package_name(self):
+        bench = load_bench()
+        names = [bench.package_name(i) for i in range(1000)]
+        assert len(set(names)) == len(names)
+        assert not any(x.isdigit() for name in names for x in name)
+
+    def test_quick(self, capsys):
+        bench = load_bench()
+        output = os.path.abspath('bench.json')
+        bench.main(['--quick', '--repeat', '1', '--output', output])
+        result = json.load(open(output))
+        assert set(result['benchmarks']) == {
+            'dmfile', 'comment_find', 'getenv',
+            'testable_packages_cold', 'testable_packages_warm',
+            'force_yaml_channels',
+        }
+        assert all(x['repeat'] == 1 for x in result['benchmarks'].values())
+
+        bench.main(['--quick', '--repeat', '1', '--compare', output])
+        assert 'Baseline' in capsys.readouterr().out
@@ -0,0 +1,67 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from delivery_merge import cache
+
+
+class TestCache:
+    def setup_class(self):
+        self.index = os.path.abspath('cache_index.json')
+
+    def teardown_class(self):
+        pass
+
+    def setup_method(self):
+        if os.path.exists(self.index):
+            os.remove(self.index)
+
+    def test_index_missing(self):
+        assert cache.index_load(self.index) == dict()
+
+    def test_lru_touch(self):
+        record = cache.lru_touch(self.index, 'a', size=10)
+        assert record['size'] == 10
+        assert record['atime']
+        assert cache.index_load(self.index)['a'] == record
+
+    def test_lru_evict_entries(self):
+        for key in ['a', 'b', 'c']:
+            cache.lru_touch(self.index, key)
+            time.sleep(0.01)
+        cache.lru_touch(self.index, 'a')
+
+        evicted = cache.lru_evict(self.index, max_entries=2)
+        assert [x[0] for x in evicted] == ['b']
+        assert sorted(cache.index_load(self.index)) == ['a', 'c']
+
+    def test_lru_evict_protect(self):
+        for key in ['a', 'b']:
+            cache.lru_touch(self.index, key)
+            time.sleep(0.01)
+
+        evicted = cache.lru_evict(self.index, max_entries=1, protect=['a'])
+        assert [x[0] for x in evicted] == ['b']
+
+    def test_lru_evict_size(self):
+        for key in ['a', 'b', 'c']:
+            cache.lru_touch(self.index, key, size=100)
+            time.sleep(0.01)
+
+        evicted = cache.lru_evict(self.index, max_size=150)
+        assert [x[0] for x in evicted] == ['a', 'b']
+
+    def test_lru_evict_age(self):
+        cache.lru_touch(self.index, 'a')
+        data = cache.index_load(self.index)
+        data['a']['atime'] -= 3600
+        cache.index_save(self.index, data)
+        cache.lru_touch(self.index, 'b')
+
+        evicted = cache.lru_evict(self.index, max_age=60)
+        assert [x[0] for x in evicted] == ['a']
+
+    def test_lru_touch_concurrent(self):
+        keys = [f'key{i}' for i in range(64)]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda x: cache.lru_touch(self.index, x), keys))
+        assert sorted(cache.index_load(self.index)) == sorted(keys)
@@ -0,0 +1,167 @@
+import os
+import shutil
+from delivery_merge.checkpoint import Checkpoint, checkpoint_key
+from delivery_merge.cli import merge as cli_merge
+
+
+class TestCheckpoint:
+    def setup_class(self):
+        self.filename = os.path.abspath('checkpoint_test.json')
+
+    def test_checkpoint_key(self):
+        key = checkpoint_key('4.5.12', 'abc', ['defaults'])
+        assert key == checkpoint_key('4.5.12', 'abc', ['defaults'])
+        assert key != checkpoint_key('4.5.12', 'abd', ['defaults'])
+        assert key != checkpoint_key('4.5.12', 'abc', [])
+
+    def test_checkpoint(self):
+        checkpoint = Checkpoint(self.filename, reset=True)
+        assert not checkpoint.done('merge', 'a')
+        checkpoint.mark('merge', 'a', result='data')
+        assert checkpoint.done('merge', 'a')
+        assert not checkpoint.done('merge', 'b')
+        assert checkpoint.get('merge')['result'] == 'data'
+
+        # Each execution receives a new token
+        token = checkpoint.token('merge')
+        assert token is not None and checkpoint.token('create') is None
+        assert checkpoint.mark('merge', 'a') != token
+
+        # Records persist
+        assert Checkpoint(self.filename).done('merge', 'a')
+        assert not Checkpoint(self.filename, reset=True).done('merge', 'a')
+
+
+class TestResume:
+    def setup_class(self):
+        self.root = os.path.abspath('resume')
+        self.prefix = os.path.join(self.root, 'miniconda3')
+        self.output_dir = os.path.join(self.root, 'delivery')
+        self.base_spec = os.path.join(self.root, 'base_spec.txt')
+        self.dmfile = os.path.join(self.root, 'resume.dm')
+        os.makedirs(self.root, exist_ok=True)
+        open(self.base_spec, 'w+').write('@EXPLICIT\n')
+        open(self.dmfile, 'w+').write('relic\n')
+
+    def run(self, monkeypatch, *argv, returncode=0):
+        calls = []
+        env = os.path.join(self.prefix, 'envs', 'delivery')
+
+        def create(name, base_spec, **kwargs):
+            calls.append('create')
+            os.makedirs(env, exist_ok=True)
+
+        def combine(*args, **kwargs):
+            calls.append('merge')
+
+        def export(prefix, name, channels, yamlfile, specfile):
+            calls.append('export')
+            for filename in [yamlfile, specfile]:
+                open(filename, 'w+').write('')
+
+        def conda(*args, **kwargs):
+            calls.append(args[0])
+
+            class Proc:
+                def check_returncode(self):
+                    pass
+            return Proc()
+
+        monkeypatch.setattr(cli_merge, 'conda_installer',
+                            lambda *args, **kwargs: self.prefix)
+        monkeypatch.setattr(cli_merge, 'conda_init_path', lambda x: None)
+        monkeypatch.setattr(cli_merge, 'ei_touch', lambda: None)
+        monkeypatch.setattr(cli_merge, 'conda_env_create', create)
+        monkeypatch.setattr(cli_merge, 'env_combine_cached', combine)
+        monkeypatch.setattr(cli_merge, 'export', export)
+        monkeypatch.setattr(cli_merge, 'conda', conda)
+
+        args = cli_merge.arg_parser().parse_args([
+            '--installer-version', '4.5.12',
+            '--output-dir', self.output_dir,
+            '--dmfile', self.dmfile,
+            '--trace=',
+            *argv,
+            self.base_spec,
+        ])
+        assert cli_merge.run(args) == returncode
+        return calls
+
+    def test_resume(self, monkeypatch):
+        assert self.run(monkeypatch, '--restart') == [
+            'create', 'merge', 'export']
+
+        # Nothing changed
+        assert self.run(monkeypatch) == []
+
+        # Changing the dmfile resumes at the merge stage
+        open(self.dmfile, 'a').write('numpy\n')
+        assert self.run(monkeypatch) == ['merge', 'export']
+
+        # Changing base_spec replaces the existing environment
+        open(self.base_spec, 'a').write('# changed\n')
+        assert self.run(monkeypatch) == ['remove', 'create', 'merge',
+                                         'export']
+
+        assert self.run(monkeypatch, '--restart') == [
+            'remove', 'create', 'merge', 'export']
+
+    def test_resume_env_deleted(self, monkeypatch):
+        assert self.run(monkeypatch, '--restart') == [
+            'remove', 'create', 'merge', 'export']
+
+        # The environment is gone, but the checkpoint was kept. The new
+        # environment must receive the merged packages.
+        shutil.rmtree(os.path.join(self.prefix, 'envs', 'delivery'))
+        assert self.run(monkeypatch) == ['create', 'merge', 'export']
+        assert self.run(monkeypatch) == []
+
+    def test_resume_tests_serial_error(self, monkeypatch):
+        packages = [dict(repo=f'https://example/{x}.git', commit=x)
+                    for x in ['broken', 'relic']]
+        tested = []
+
+        def integration_test(package, *args, **kwargs):
+            tested.append(package['commit'])
+            if package['commit'] == 'broken':
+                raise RuntimeError('setup.py egg_info failed')
+            return os.path.join(self.output_dir, 'result.xml')
+
+        monkeypatch.setattr(cli_merge, 'testable_packages',
+                            lambda *args: iter(packages))
+        monkeypatch.setattr(cli_merge, 'prefetch_sources',
+                            lambda *args: [])
+        monkeypatch.setattr(cli_merge, 'integration_test_tools',
+                            lambda *args: None)
+        monkeypatch.setattr(cli_merge, 'integration_test', integration_test)
+
+        self.run(monkeypatch, '--run-tests', '--no-test-cache',
+                 returncode=1)
+        assert tested == ['broken', 'relic']
+
+        # Only the failed package is tested again
+        open(os.path.join(self.output_dir, 'result.xml'), 'w+').write('')
+        tested.clear()
+        self.run(monkeypatch, '--run-tests', '--no-test-cache',
+                 returncode=1)
+        assert tested == ['broken']
+
+    def test_resume_tests_prefetch_error(self, monkeypatch):
+        tested = []
+
+        def prefetch_sources(*args):
+            raise OSError('mirror cache unavailable')
+
+        monkeypatch.setattr(cli_merge, 'testable_packages',
+                            lambda *args: iter([dict(
+                                repo='https://example/relic.git',
+                                commit='prefetch')]))
+        monkeypatch.setattr(cli_merge, 'prefetch_sources', prefetch_sources)
+        monkeypatch.setattr(cli_merge, 'integration_test_tools',
+                            lambda *args: None)
+        monkeypatch.setattr(cli_merge, 'integration_test',
+                            lambda package, *args, **kwargs:
+                            tested.append(package['commit']) or '')
+
+        self.run(monkeypatch, '--run-tests', '--no-test-cache')
+        assert tested == ['prefetch']
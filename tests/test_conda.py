@@ -1,4 +1,10 @@
+import hashlib
+import json
 import os
+import pytest
+import shutil
+import subprocess
+from contextlib import contextmanager
 from delivery_merge import conda
 
 
@@ -23,3 +29,326 @@ class TestConda:
     def test_env_load(self):
         with conda.conda_env_load('base') as _:
             assert os.environ.get('CONDA_PREFIX', '')
+
+    def test_env_handle(self):
+        env = conda.CondaEnv('base')
+        assert env.prefix == self.prefix
+        assert env.environ is not os.environ
+        output = conda.conda('info', env=env).stdout.decode()
+        assert self.prefix in output
+        assert conda.conda_env_handle(env) is env
+
+    def test_env_create_template(self):
+        spec = 'template_spec.txt'
+        open(spec, 'w+').write('python\n')
+        template = conda.TEMPLATE_PREFIX + conda.template_key(spec)[:16]
+
+        for name in ['template_a', 'template_b']:
+            conda.conda_env_create(name, spec)
+            assert os.path.exists(os.path.join(self.prefix, 'envs', name))
+
+        assert os.path.exists(os.path.join(self.prefix, 'envs', template))
+
+
+class TestCondaEnvCache:
+    def setup_class(self):
+        self.root = os.path.abspath('fake_conda')
+        self.env_prefix = os.path.join(self.root, 'envs', 'fake_env')
+        self.bindir = os.path.join(self.root, 'bin')
+        self.environ = {'PATH': self.bindir}
+
+        for path in [self.bindir,
+                     os.path.join(self.root, 'conda-meta'),
+                     os.path.join(self.env_prefix, 'bin'),
+                     os.path.join(self.env_prefix, 'conda-meta')]:
+            os.makedirs(path, exist_ok=True)
+
+        for path in [os.path.join(self.bindir, 'conda'),
+                     os.path.join(self.env_prefix, 'bin', 'python')]:
+            open(path, 'w+').write('#!/bin/sh\n')
+            os.chmod(path, 0o755)
+
+        record = dict(name='python', version='3.7.3')
+        meta = os.path.join(self.env_prefix, 'conda-meta',
+                            'python-3.7.3-h0371630_0.json')
+        open(meta, 'w+').write(json.dumps(record))
+
+    def teardown_class(self):
+        conda.conda_env_cache_clear()
+
+    def test_conda_prefix(self):
+        assert conda.conda_prefix('base', self.environ) == self.root
+        assert conda.conda_prefix('fake_env', self.environ) == self.env_prefix
+        assert conda.conda_prefix(self.env_prefix) == self.env_prefix
+
+    def test_fingerprint_changes(self):
+        before = conda.conda_env_fingerprint(self.env_prefix)
+        assert before == conda.conda_env_fingerprint(self.env_prefix)
+
+        extra = os.path.join(self.env_prefix, 'conda-meta', 'extra.json')
+        open(extra, 'w+').write('{}')
+        try:
+            assert before != conda.conda_env_fingerprint(self.env_prefix)
+        finally:
+            os.remove(extra)
+
+    def test_site_packages(self):
+        environ = {'PATH': os.path.join(self.env_prefix, 'bin')}
+        result = conda.conda_site_packages(environ)
+        assert result == os.path.join(self.env_prefix, 'lib', 'python3.7',
+                                      'site-packages')
+
+    def test_activate_memoized(self, monkeypatch):
+        calls = []
+
+        def fake_activate(env_name, environ=None):
+            calls.append(env_name)
+            return dict(CONDA_PREFIX=self.env_prefix, CALLS=str(len(calls)))
+
+        conda.conda_env_cache_clear()
+        monkeypatch.setattr(conda, '_conda_activate_shell', fake_activate)
+
+        first = conda.conda_activate('fake_env', self.environ)
+        first['MODIFIED'] = '1'
+        second = conda.conda_activate('fake_env', self.environ)
+        assert len(calls) == 1
+        assert 'MODIFIED' not in second
+
+        history = os.path.join(self.env_prefix, 'conda-meta', 'history')
+        open(history, 'w+').write('# changed\n')
+        try:
+            third = conda.conda_activate('fake_env', self.environ)
+        finally:
+            os.remove(history)
+
+        assert len(calls) == 2
+        assert third['CALLS'] == '2'
+
+
+class TestInstallerCache:
+    def setup_class(self):
+        self.cache_root = os.path.abspath('installer_cache')
+        self.installer = 'Miniconda3-0.0.0-Linux-x86_64.sh'
+        self.data = b'#!/bin/sh\necho installer\n' * 1000
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+
+    def test_installer_fetch(self, http_server):
+        open(os.path.join(http_server.root, self.installer),
+             'wb').write(self.data)
+        url = f'{http_server.url}/{self.installer}'
+
+        result = conda.installer_fetch(url, self.sha256, self.cache_root)
+        assert result == os.path.join(self.cache_root, self.sha256,
+                                      self.installer)
+        assert open(result, 'rb').read() == self.data
+        assert os.access(result, os.X_OK)
+
+        # Without a digest the index resolves the verified copy
+        http_server.requests.clear()
+        assert conda.installer_fetch(url, cache_root=self.cache_root) == result
+        assert not http_server.requests
+
+    def test_installer_fetch_corrupt(self, http_server):
+        open(os.path.join(http_server.root, self.installer),
+             'wb').write(self.data)
+        url = f'{http_server.url}/{self.installer}'
+        result = conda.installer_fetch(url, self.sha256, self.cache_root)
+
+        open(result, 'ab').write(b'truncated or tampered')
+        http_server.requests.clear()
+        result = conda.installer_fetch(url, self.sha256, self.cache_root)
+        assert open(result, 'rb').read() == self.data
+        assert len(http_server.requests) == 1
+
+
+class TestPkgsPrefetch:
+    def setup_method(self):
+        self.pkgs_dir = os.path.abspath('prefetch_pkgs')
+        shutil.rmtree(self.pkgs_dir, ignore_errors=True)
+
+    def make_spec(self, server, packages):
+        """ Serve packages and list them in an @EXPLICIT spec file
+        :returns: str: path to spec file
+        """
+        spec = os.path.abspath('prefetch_spec.txt')
+        with open(spec, 'w') as fp:
+            fp.write('@EXPLICIT\n')
+            for filename, data, digest in packages:
+                open(os.path.join(server.root, filename), 'wb').write(data)
+                fp.write(f'{server.url}/{filename}')
+                fp.write(f'#{digest}\n' if digest else '\n')
+        return spec
+
+    def test_conda_pkgs_prefetch(self, http_server):
+        packages = [(f'pkg{x}-1.0-0.tar.bz2', os.urandom(10000), None)
+                    for x in 'abcd']
+        packages = [(x, y, hashlib.md5(y).hexdigest()) for x, y, _ in packages]
+        spec = self.make_spec(http_server, packages)
+
+        result = conda.conda_pkgs_prefetch(spec, self.pkgs_dir, jobs=2)
+        assert result == [x[0] for x in packages]
+        for filename, data, _ in packages:
+            assert open(os.path.join(self.pkgs_dir, filename),
+                        'rb').read() == data
+        urls = open(os.path.join(self.pkgs_dir, 'urls.txt')).read()
+        assert urls.splitlines() == [f'{http_server.url}/{x[0]}'
+                                     for x in packages]
+
+        # Cached (or already extracted) packages are not downloaded again
+        os.remove(os.path.join(self.pkgs_dir, packages[0][0]))
+        os.makedirs(os.path.join(self.pkgs_dir, 'pkga-1.0-0', 'info'))
+        open(os.path.join(self.pkgs_dir, 'pkga-1.0-0', 'info',
+                          'index.json'), 'w').write('{}')
+        http_server.requests.clear()
+        assert conda.conda_pkgs_prefetch(spec, self.pkgs_dir) == []
+        assert not http_server.requests
+
+    def test_conda_pkgs_prefetch_verify(self, http_server):
+        good = b'good' * 1000
+        spec = self.make_spec(http_server, [
+            ('good-1.0-0.tar.bz2', good, hashlib.md5(good).hexdigest()),
+            ('bad-1.0-0.tar.bz2', b'bad', '0' * 32),
+        ])
+        # A corrupt tarball in the cache is replaced
+        os.makedirs(self.pkgs_dir)
+        open(os.path.join(self.pkgs_dir, 'good-1.0-0.tar.bz2'),
+             'wb').write(b'corrupt')
+
+        result = conda.conda_pkgs_prefetch(spec, self.pkgs_dir)
+        assert result == ['good-1.0-0.tar.bz2']
+        assert open(os.path.join(self.pkgs_dir, 'good-1.0-0.tar.bz2'),
+                    'rb').read() == good
+        # Failed downloads are left to conda
+        assert not os.path.exists(os.path.join(self.pkgs_dir,
+                                               'bad-1.0-0.tar.bz2'))
+
+
+class TestTemplateKey:
+    def test_template_key(self):
+        spec = 'template_key_spec.txt'
+        open(spec, 'w+').write('@EXPLICIT\n')
+        key = conda.template_key(spec)
+        assert key == conda.template_key(spec, [])
+        assert key != conda.template_key(spec, ['defaults'])
+
+        open(spec, 'a').write('https://example/pkg-1.0-0.tar.bz2\n')
+        assert key != conda.template_key(spec)
+
+
+DRY_RUN = dict(actions=dict(
+    FETCH=[dict(name='numpy', version='1.16.3', build='py37_0',
+                fn='numpy-1.16.3-py37_0.tar.bz2', md5='a' * 32,
+                url='https://example/linux-64/numpy-1.16.3-py37_0.tar.bz2')],
+    LINK=[dict(name=name, version=version, build_string=build,
+               dist_name=f'{name}-{version}-{build}',
+               base_url='https://example', platform='linux-64')
+          for name, version, build in [('numpy', '1.16.3', 'py37_0'),
+                                       ('mkl', '2019.3', '199'),
+                                       ('blas', '1.0', 'mkl')]],
+    UNLINK=[dict(name='numpy'), dict(name='nomkl')]))
+
+
+class TestInstallSolved:
+    def setup_method(self):
+        self.calls = []
+        self.pkgs_dir = os.path.abspath('install_solved_pkgs')
+        info = os.path.join(self.pkgs_dir, 'mkl-2019.3-199', 'info')
+        os.makedirs(info, exist_ok=True)
+        json.dump(dict(url='https://cached/linux-64/mkl-2019.3-199.tar.bz2',
+                       md5='b' * 32),
+                  open(os.path.join(info, 'repodata_record.json'), 'w+'))
+
+    def fake(self, monkeypatch, stdout=b'', returncode=0):
+        @contextmanager
+        def fake_lock():
+            self.calls.append('lock')
+            yield
+            self.calls.append('unlock')
+
+        def fake_prefetch(spec, pkgs_dir=None):
+            self.calls.append(conda.explicit_read(spec))
+
+        def fake_conda(*args, env=None):
+            self.calls.append(args)
+            out = stdout if '--dry-run' in args else b''
+            return subprocess.CompletedProcess(args, returncode, out, b'')
+
+        monkeypatch.setattr(conda, 'conda_pkgs_lock', fake_lock)
+        monkeypatch.setattr(conda, 'conda_pkgs_prefetch', fake_prefetch)
+        monkeypatch.setattr(conda, 'conda', fake_conda)
+
+    def test_conda_install_solved(self, monkeypatch):
+        self.fake(monkeypatch, json.dumps(DRY_RUN).encode())
+        proc = conda.conda_install_solved('delivery', 'numpy',
+                                          pkgs_dir=self.pkgs_dir)
+        assert not proc.returncode
+
+        # Solved once, the packages are downloaded under the lock, and the
+        # explicit solution is linked without it
+        assert self.calls[0] == ('install', '-q', '--dry-run', '--json',
+                                 '-n', 'delivery', 'numpy')
+        assert self.calls[1:4] == ['lock', [
+            'https://example/linux-64/numpy-1.16.3-py37_0.tar.bz2#' + 'a' * 32,
+            'https://cached/linux-64/mkl-2019.3-199.tar.bz2#' + 'b' * 32,
+            'https://example/linux-64/blas-1.0-mkl.tar.bz2',
+        ], 'unlock']
+        assert self.calls[4] == ('remove', '-q', '-y', '--force', '--offline',
+                                 '-n', 'delivery', 'nomkl')
+        assert self.calls[5][:5] == ('install', '-q', '-y', '-n', 'delivery')
+        assert len(self.calls) == 6
+        assert not os.path.exists(self.calls[5][-1])
+
+    def test_conda_install_solved_nothing(self, monkeypatch):
+        self.fake(monkeypatch, b'{"success": true}')
+        proc = conda.conda_install_solved('delivery', 'numpy',
+                                          pkgs_dir=self.pkgs_dir)
+        assert not proc.returncode
+        assert len(self.calls) == 1
+
+    def test_conda_install_solved_failed(self, monkeypatch):
+        self.fake(monkeypatch, b'{"error": "PackagesNotFoundError"}', 1)
+        proc = conda.conda_install_solved('delivery', 'numpy',
+                                          pkgs_dir=self.pkgs_dir)
+        assert proc.returncode == 1
+        assert len(self.calls) == 1
+
+
+class TestTemplateReady:
+    def test_env_create_template_failed(self, monkeypatch):
+        root = os.path.abspath('template_ready_root')
+        envs = os.path.join(root, 'envs')
+        spec = os.path.abspath('template_ready_spec.txt')
+        open(spec, 'w+').write('@EXPLICIT\n')
+        template = conda.TEMPLATE_PREFIX + conda.template_key(spec)[:16]
+        calls = []
+        failing = [True]
+
+        @contextmanager
+        def fake_lock():
+            yield
+
+        def fake_conda(*args, env=None):
+            calls.append(args)
+            if '--file' in args:
+                # conda-meta is written before the packages are linked
+                os.makedirs(os.path.join(envs, template, 'conda-meta'),
+                            exist_ok=True)
+            returncode = 1 if '--file' in args and failing[0] else 0
+            return subprocess.CompletedProcess(args, returncode, b'', b'')
+
+        monkeypatch.setattr(conda, 'conda_prefix', lambda name: root)
+        monkeypatch.setattr(conda, 'conda_pkgs_lock', fake_lock)
+        monkeypatch.setattr(conda, 'conda_pkgs_prefetch',
+                            lambda *args, **kwargs: [])
+        monkeypatch.setattr(conda, 'conda', fake_conda)
+
+        with pytest.raises(subprocess.CalledProcessError):
+            conda.conda_env_create('delivery', spec)
+        assert not os.path.exists(os.path.join(envs, template))
+
+        # The half-built template is not cloned; it is created again
+        failing[0] = False
+        calls.clear()
+        conda.conda_env_create('delivery', spec)
+        assert [x[-1] for x in calls] == [spec, template]
+        assert os.path.exists(os.path.join(envs, f'.{template}.ready'))
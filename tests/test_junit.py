@@ -0,0 +1,113 @@
+import json
+import pytest
+from delivery_merge.junit import (
+    JunitReport,
+    junit_iter,
+    junit_merge,
+    junit_outcome,
+    junit_summary,
+    junit_times
+)
+
+
+JUNIT_SUITE = """<?xml version="1.0" encoding="utf-8"?>
+<testsuite errors="0" failures="1" name="pytest" skipped="2" tests="5" time="1.5">
+<testcase classname="test_a" name="test_one" time="0.5"/>
+</testsuite>"""
+JUNIT_SUITES = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites>
+<testsuite errors="1" failures="0" name="a" skipped="0" tests="2" time="0.25"/>
+<testsuite errors="0" failures="2" name="b" skipped="1" tests="4" time="0.5"/>
+</testsuites>"""
+JUNIT_CASES = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites><testsuite name="pytest" tests="4">
+<testcase classname="pkg.test_a" name="test_pass" time="0.5"/>
+<testcase classname="pkg.test_a" name="test_fail" time="2.0">
+<failure message="assert 0">trace</failure></testcase>
+<testcase classname="pkg.test_b" name="test_error" time="0.25">
+<error message="fixture">trace</error></testcase>
+<testcase classname="pkg.test_b" name="test_skip" time="0.0">
+<skipped message="no data"/></testcase>
+</testsuite></testsuites>"""
+
+
+class TestJunit:
+    @pytest.mark.parametrize('data,expected', [
+        (JUNIT_SUITE, dict(tests=5, failures=1, errors=0, skipped=2,
+                           time=1.5)),
+        (JUNIT_SUITES, dict(tests=6, failures=2, errors=1, skipped=1,
+                            time=0.75)),
+    ])
+    def test_junit_summary(self, data, expected):
+        open('summary.xml', 'w+').write(data)
+        assert junit_summary('summary.xml') == expected
+
+    def test_junit_times(self):
+        open('times.xml', 'w+').write(JUNIT_SUITE)
+        assert junit_times('times.xml') == {'test_a': 0.5}
+
+    def test_junit_merge(self):
+        open('merge_a.xml', 'w+').write(JUNIT_SUITE)
+        open('merge_b.xml', 'w+').write(JUNIT_SUITES)
+        totals = junit_merge(['merge_a.xml', 'merge_b.xml', 'missing.xml'],
+                             'merged.xml')
+        assert totals == dict(tests=11, failures=3, errors=1, skipped=3,
+                              time=2.25)
+        assert junit_summary('merged.xml') == totals
+        assert junit_times('merged.xml') == {'test_a': 0.5}
+
+    def test_junit_iter(self):
+        open('iter.xml', 'w+').write(JUNIT_CASES)
+        items = list(junit_iter('iter.xml'))
+        assert items[0] == ('testsuite', dict(name='pytest', tests='4'))
+        cases = [x for kind, x in items if kind == 'testcase']
+        assert [x.get('name') for x in cases] == [
+            'test_pass', 'test_fail', 'test_error', 'test_skip']
+        assert [junit_outcome(x) for x in cases] == [
+            'passed', 'failed', 'error', 'skipped']
+
+
+class TestJunitReport:
+    def test_add(self):
+        open('relic.xml', 'w+').write(JUNIT_CASES)
+        report = JunitReport('results.xml', 'summary.json', slowest=2)
+        totals = report.add('relic', 'relic.xml')
+        assert totals == dict(tests=4, passed=1, failures=1, errors=1,
+                              skipped=1, time=2.75, status='failed')
+
+        summary = json.load(open('summary.json'))
+        assert summary['packages']['relic'] == totals
+        assert summary['slowest'] == [
+            dict(package='relic', test='pkg.test_a::test_fail', time=2.0),
+            dict(package='relic', test='pkg.test_a::test_pass', time=0.5)]
+        assert junit_summary('results.xml') == dict(
+            tests=4, failures=1, errors=1, skipped=1, time=2.75)
+        assert junit_times('results.xml') == {'pkg.test_a': 2.5,
+                                              'pkg.test_b': 0.25}
+
+    def test_add_incremental(self):
+        open('relic.xml', 'w+').write(JUNIT_CASES)
+        report = JunitReport('results.xml', 'summary.json')
+        report.add('relic', 'relic.xml')
+        report.add('missing', 'missing.xml', status='timeout')
+        summary = json.load(open('summary.json'))
+        assert summary['packages']['missing']['status'] == 'timeout'
+        assert summary['totals']['packages'] == 2
+
+        # Replacing a package's results does not count its tests twice
+        report.add('relic', 'relic.xml', status='resumed')
+        summary = json.load(open('summary.json'))
+        assert summary['totals']['tests'] == 4
+        assert summary['packages']['relic']['status'] == 'resumed'
+        assert len(summary['slowest']) == 4
+        assert junit_summary('results.xml')['tests'] == 4
+
+    def test_add_truncated(self):
+        # e.g. pytest was killed while writing its report
+        open('truncated.xml', 'w+').write(JUNIT_CASES[:JUNIT_CASES.index(
+            '<testcase classname="pkg.test_b"')])
+        report = JunitReport('results.xml', 'summary.json')
+        totals = report.add('relic', 'truncated.xml')
+        assert (totals['tests'], totals['passed'], totals['failures']) \
+            == (2, 1, 1)
+        assert junit_summary('results.xml')['tests'] == 2
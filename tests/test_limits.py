@@ -0,0 +1,92 @@
+import os
+import pytest
+import sys
+import time
+from delivery_merge import limits
+from delivery_merge.limits import (
+    ResourceLimitExceeded,
+    limits_admit,
+    memory_available,
+    resource_limits
+)
+from delivery_merge.utils import sh, sh_stream
+
+
+SLEEPER = """sleep 30 &
+echo $! > {pidfile}
+sleep 30
+"""
+ALLOCATOR = """import time
+data = bytearray(256 << 20)
+time.sleep(30)
+"""
+
+
+def running(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as fp:
+            return fp.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+@pytest.fixture
+def fast_kill(monkeypatch):
+    monkeypatch.setattr(limits, 'LIMITS_INTERVAL', 0.1)
+    monkeypatch.setattr(limits, 'LIMITS_GRACE', 0.5)
+
+
+class TestLimits:
+    @pytest.mark.skipif(not sys.platform.startswith('linux'),
+                        reason='requires /proc')
+    def test_timeout(self, fast_kill):
+        pidfile = os.path.abspath('sleeper.pid')
+        script = os.path.abspath('sleeper.sh')
+        open(script, 'w+').write(SLEEPER.format(pidfile=pidfile))
+
+        start = time.monotonic()
+        with pytest.raises(ResourceLimitExceeded) as exc:
+            with resource_limits(timeout=1):
+                sh_stream('sh', script, echo=False)
+        assert exc.value.reason == 'timeout'
+        assert time.monotonic() - start < 10
+
+        # Children of the command were killed along with it
+        pid = int(open(pidfile).read())
+        assert not running(pid)
+
+    def test_timeout_prevents_commands(self):
+        with resource_limits(timeout=0.1):
+            time.sleep(0.2)
+            with pytest.raises(ResourceLimitExceeded):
+                sh('true')
+
+    @pytest.mark.skipif(not sys.platform.startswith('linux'),
+                        reason='requires /proc')
+    def test_memory(self, fast_kill):
+        script = os.path.abspath('allocator.py')
+        open(script, 'w+').write(ALLOCATOR)
+
+        with pytest.raises(ResourceLimitExceeded) as exc:
+            with resource_limits(max_rss=64 << 20) as lim:
+                sh_stream(sys.executable, script, echo=False)
+        assert exc.value.reason == 'memory'
+        assert lim.peak_rss > 64 << 20
+
+    def test_within_limits(self):
+        with resource_limits(timeout=30, max_rss=1 << 30) as lim:
+            assert not sh('true').returncode
+        assert lim.exceeded is None
+
+    def test_limits_admit(self, monkeypatch):
+        monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+        monkeypatch.setattr(limits, 'memory_available', lambda: 2 << 30)
+        assert limits_admit(0, cpus=8, memory=4 << 30)
+        assert limits_admit(1, cpus=2, memory=1 << 30)
+        assert not limits_admit(2, cpus=2, memory=1 << 30)
+        assert not limits_admit(1, cpus=1, memory=4 << 30)
+
+    @pytest.mark.skipif(not sys.platform.startswith('linux'),
+                        reason='requires /proc')
+    def test_memory_available(self):
+        assert memory_available() > 0
@@ -1,6 +1,11 @@
+import json
 import os
 import pytest
-from delivery_merge import conda, merge
+import shutil
+import subprocess
+from delivery_merge import conda, merge, mirror
+from .test_mirror import git_commit, git_init
+from .test_pkgs import make_package
 from ruamel.yaml import YAML
 
 
@@ -57,6 +62,10 @@ data # comment
 data# comment
 data#comment
 """
+JUNIT = """<?xml version="1.0" encoding="utf-8"?>
+<testsuites><testsuite errors="0" failures="1" name="pytest" skipped="0" tests="3" time="0.5">
+</testsuite></testsuites>"""
+JUNIT_PASSED = JUNIT.replace('failures="1"', 'failures="0"')
 DMFILE = """
 ; Example
 python  # dmfile
@@ -146,6 +155,35 @@ class TestMerge:
             contents = open(result).read()
             assert contents.startswith('<?xml') and contents.endswith('</testsuite>')
 
+    def test_integration_test_pool(self):
+        merge.env_combine(self.input_file, self.env_name, CHANNELS)
+        input_data = list(merge.testable_packages(self.input_file,
+                                                  self.prefix))
+        assert input_data
+
+        output_dir = 'test_results_pool'
+        results = merge.integration_test_pool(input_data, self.env_name,
+                                              output_dir, jobs=2)
+        assert len(results) == len(input_data)
+
+        for pkg, result, error, usage in results:
+            assert error is None
+            assert usage['status'] == 'ok' and usage['commands']
+            assert os.path.exists(result)
+            logfile = os.path.join(os.path.dirname(result), 'output.log')
+            assert os.path.exists(logfile)
+
+    def test_env_combine_cached(self):
+        cache_root = os.path.abspath('solution_cache')
+        args = (self.input_file, self.env_name, CHANNELS,
+                self.input_file_base_spec)
+        merge.env_combine_cached(*args, force_solve=True,
+                                 cache_root=cache_root)
+        key = merge.solution_key(self.input_file_base_spec,
+                                 self.input_file, CHANNELS)
+        assert os.path.exists(os.path.join(cache_root, key + '.txt'))
+        assert merge.env_combine_cached(*args, cache_root=cache_root)
+
     def test_force_xunit2_no_config(self):
         merge.force_xunit2()
         assert os.path.exists('pytest.ini')
@@ -175,3 +213,159 @@ class TestMerge:
         merge.force_yaml_channels('channels.yml', CHANNELS_YML)
         assert self.yaml.load(open(filename))['channels'] == CHANNELS_YML
 
+
+class TestMergeOffline:
+    def setup_class(self):
+        self.prefix = os.path.abspath('diff_env')
+        self.input_file = 'diff.dm'
+        os.makedirs(os.path.join(self.prefix, 'conda-meta'), exist_ok=True)
+        for name, version in [('python', '3.7.3'), ('setuptools', '41.0.1')]:
+            filename = os.path.join(self.prefix, 'conda-meta',
+                                    f'{name}-{version}-0.json')
+            json.dump(dict(name=name, version=version), open(filename, 'w+'))
+        open(self.input_file, 'w+').write("""
+python=3.7
+setuptools>=42
+relic
+numpy=1.16.3=py37_0
+""")
+
+    def teardown_class(self):
+        shutil.rmtree(self.prefix, ignore_errors=True)
+        os.remove(self.input_file)
+
+    def test_dmfile_operator(self):
+        data = merge.dmfile(self.input_file)
+        assert [x['operator'] for x in data] == ['=', '>=', None, '=']
+
+    def test_dmfile_diff(self):
+        records = merge.dmfile(self.input_file)
+        satisfied, unsatisfied = merge.dmfile_diff(records, self.prefix)
+        assert [(x['name'], v) for x, v in satisfied] == [('python', '3.7.3')]
+        assert [(x['name'], v) for x, v in unsatisfied] == [
+            ('setuptools', '41.0.1'),
+            ('relic', None),
+            ('numpy', None),
+        ]
+
+    def test_env_combine_full_spec(self, monkeypatch):
+        calls = []
+        monkeypatch.setattr(merge, 'ei_touch', lambda env: None)
+        monkeypatch.setattr(merge, 'conda_install_solved',
+                            lambda *args, env=None: calls.append(args)
+                            or subprocess.CompletedProcess(args, 0, b'', b''))
+        env = conda.CondaEnv('diff', environ=dict(CONDA_PREFIX=self.prefix))
+
+        merge.env_combine(self.input_file, env, validate=False)
+        assert len(calls) == 1
+        assert calls[0][-1] == ' '.join(
+            f"'{x['fullspec']}'" for x in merge.dmfile(self.input_file))
+
+        satisfied = 'diff_satisfied.dm'
+        open(satisfied, 'w+').write('python=3.7\nsetuptools\n')
+        merge.env_combine(satisfied, env, validate=False)
+        assert len(calls) == 1
+
+    def test_solution_key(self):
+        spec = 'solution_spec.txt'
+        open(spec, 'w+').write('@EXPLICIT\n')
+        key = merge.solution_key(spec, self.input_file, CHANNELS)
+        assert key == merge.solution_key(spec, self.input_file, CHANNELS)
+        assert key != merge.solution_key(spec, self.input_file,
+                                         CHANNELS[::-1])
+        assert key != merge.solution_key(self.input_file, spec, CHANNELS)
+
+    def test_dmfile_diff_missing_env(self):
+        records = merge.dmfile(self.input_file)
+        satisfied, unsatisfied = merge.dmfile_diff(records, 'does_not_exist')
+        assert not satisfied
+        assert len(unsatisfied) == len(records)
+
+    def test_testable_packages_offline(self):
+        prefix = os.path.abspath('testable_prefix')
+        pkgdir = os.path.join(prefix, 'pkgs')
+        make_package(pkgdir, 'relic', '1.1.0', 'py_0')
+        make_package(pkgdir, 'setuptools', '41.0.1', 'py37_0', git=False)
+        dmfile = 'testable.dm'
+        open(dmfile, 'w+').write('relic=1.1.0\nsetuptools\npython\n')
+
+        result = list(merge.testable_packages(dmfile, prefix))
+        assert result == [dict(repo='https://example/relic.git',
+                               commit='relic1.1.0')]
+
+    def test_prefetch_sources(self, monkeypatch):
+        origin = os.path.abspath('prefetch_origin')
+        git_init(origin)
+        git_commit(origin, 'data.txt', 'data')
+        url = f'file://{origin}'
+
+        monkeypatch.setattr(merge, 'testable_packages',
+                            lambda *_: iter([dict(repo=url, commit='x'),
+                                             dict(repo=url, commit='y'),
+                                             dict(repo='file:///missing',
+                                                  commit='z')]))
+        result = merge.prefetch_sources('unused.dm', 'unused_prefix')
+        assert result == [url]
+        assert os.path.exists(mirror.mirror_path(url))
+
+    def test_result_cache_key(self):
+        pkg = dict(repo='https://example/relic.git', commit='abc')
+        key = merge.result_cache_key(pkg, 'digest')
+        assert key == merge.result_cache_key(dict(pkg), 'digest')
+        assert key != merge.result_cache_key(pkg, 'other')
+        assert key != merge.result_cache_key(dict(pkg, commit='abd'),
+                                             'digest')
+
+    def test_result_cache(self):
+        cache_root = os.path.abspath('result_cache')
+        pkg = dict(repo='https://example/relic.git', commit='abc')
+        key = merge.result_cache_key(pkg, 'digest')
+        assert merge.result_cache_restore(key, pkg, 'cached_results',
+                                          cache_root) is None
+
+        root = merge.integration_test_root(pkg, 'tested_results')
+        os.makedirs(os.path.join(root, 'logs'))
+        result = os.path.join(root, 'result.xml')
+        open(result, 'w+').write(JUNIT_PASSED)
+        open(os.path.join(root, 'logs', 'pytest.log'), 'w+').write('log')
+
+        summary = merge.result_cache_store(key, pkg, result, cache_root)
+        assert summary == dict(tests=3, failures=0, errors=0, skipped=0,
+                               time=0.5)
+
+        restored, cached = merge.result_cache_restore(key, pkg,
+                                                      'cached_results',
+                                                      cache_root)
+        assert cached == summary
+        assert restored == os.path.join(
+            merge.integration_test_root(pkg, 'cached_results'), 'result.xml')
+        assert open(restored).read() == JUNIT_PASSED
+        assert open(os.path.join(os.path.dirname(restored), 'logs',
+                                 'pytest.log')).read() == 'log'
+
+    def test_result_cache_failed(self):
+        cache_root = os.path.abspath('result_cache_failed')
+        pkg = dict(repo='https://example/relic.git', commit='abc')
+        key = merge.result_cache_key(pkg, 'digest')
+        result = os.path.abspath('failed.xml')
+        open(result, 'w+').write(JUNIT)
+
+        summary = merge.result_cache_store(key, pkg, result, cache_root)
+        assert summary['failures'] == 1
+        assert merge.result_cache_restore(key, pkg, 'failed_results',
+                                          cache_root) is None
+
+    def test_result_cache_evict(self):
+        cache_root = os.path.abspath('result_cache_evict')
+        result = os.path.abspath('evict.xml')
+        open(result, 'w+').write(JUNIT_PASSED)
+
+        keys = []
+        for commit in ['a', 'b']:
+            pkg = dict(repo='https://example/relic.git', commit=commit)
+            keys.append(merge.result_cache_key(pkg, 'digest'))
+            merge.result_cache_store(keys[-1], pkg, result, cache_root,
+                                     max_size=len(JUNIT_PASSED))
+
+        assert not os.path.exists(os.path.join(cache_root, keys[0]))
+        assert os.path.exists(os.path.join(cache_root, keys[1]))
@@ -0,0 +1,184 @@
+import io
+import json
+import os
+import pytest
+import shutil
+from delivery_merge import meta
+from .test_merge import BASE_SPEC
+
+
+CHANNELS = ['http://ssb.stsci.edu/astroconda', 'defaults']
+# Environment file left by `conda env export -n meta_env --file` after
+# `merge.force_yaml_channels` replaced its channels with CHANNELS
+CONDA_ENV_EXPORT = """name: meta_env
+channels:
+  - http://ssb.stsci.edu/astroconda
+  - defaults
+dependencies:
+  - numpy=1.16.3=py37_0
+  - python=3.7.3=0
+  - pip:
+    - ci-watson==0.3
+prefix: {prefix}
+"""
+# Dependencies of the packages listed by BASE_SPEC (output of conda 4.5's
+# `conda list --explicit`)
+BASE_SPEC_DEPENDS = {
+    'libffi': ['libgcc-ng >=7.2.0', 'libstdcxx-ng >=7.2.0'],
+    'ncurses': ['libgcc-ng >=7.3.0', 'libstdcxx-ng >=7.3.0'],
+    'openssl': ['ca-certificates', 'libgcc-ng >=7.3.0'],
+    'xz': ['libgcc-ng >=7.3.0'],
+    'zlib': ['libgcc-ng >=7.3.0'],
+    'libedit': ['libgcc-ng >=7.3.0', 'ncurses >=6.1,<7.0a0'],
+    'readline': ['libgcc-ng >=7.3.0', 'ncurses >=6.1,<7.0a0'],
+    'tk': ['libgcc-ng >=7.3.0', 'libstdcxx-ng >=7.3.0',
+           'zlib >=1.2.11,<1.3.0a0'],
+    'sqlite': ['libedit >=3.1.20181209,<3.2.0a0', 'libgcc-ng >=7.3.0',
+               'readline >=7.0,<8.0a0', 'zlib >=1.2.11,<1.3.0a0'],
+    'python': ['libffi >=3.2.1,<4.0a0', 'libgcc-ng >=7.3.0',
+               'libstdcxx-ng >=7.3.0', 'ncurses >=6.1,<7.0a0',
+               'openssl >=1.1.1b,<1.1.2a', 'readline >=7.0,<8.0a0',
+               'sqlite >=3.27.2,<4.0a0', 'tk >=8.6.8,<8.7.0a0',
+               'xz >=5.2.4,<6.0a0', 'zlib >=1.2.11,<1.3.0a0'],
+    'certifi': ['python >=3.7,<3.8.0a0'],
+    'setuptools': ['certifi >=2016.09', 'python >=3.7,<3.8.0a0'],
+    'wheel': ['python >=3.7,<3.8.0a0', 'setuptools'],
+    'pip': ['python >=3.7,<3.8.0a0', 'setuptools', 'wheel'],
+}
+
+
+class TestMeta:
+    def setup_class(self):
+        self.prefix = os.path.abspath('meta_env')
+        os.makedirs(os.path.join(self.prefix, 'conda-meta'), exist_ok=True)
+        site_packages = os.path.join(self.prefix, 'lib', 'python3.7',
+                                     'site-packages')
+        for name, version, build in [('python', '3.7.3', '0'),
+                                     ('numpy', '1.16.3', 'py37_0')]:
+            dist_info = f'{name}-{version}.dist-info'
+            files = [f'lib/python3.7/site-packages/{dist_info}/METADATA']
+            fn = f'{name}-{version}-{build}.tar.bz2'
+            record = dict(name=name, version=version, build=build,
+                          subdir='linux-64', fn=fn,
+                          url=f'https://repo/linux-64/{fn}',
+                          files=files if name == 'numpy' else [],
+                          depends=['python >=3.7,<3.8.0a0']
+                          if name == 'numpy' else [])
+            filename = os.path.join(self.prefix, 'conda-meta',
+                                    f'{name}-{version}-{build}.json')
+            json.dump(record, open(filename, 'w+'))
+        open(os.path.join(self.prefix, 'conda-meta', 'history'), 'w+')
+
+        for name, version in [('numpy', '1.16.3'), ('ci-watson', '0.3')]:
+            dist_info = os.path.join(site_packages,
+                                     f'{name}-{version}.dist-info')
+            os.makedirs(dist_info, exist_ok=True)
+            open(os.path.join(dist_info, 'METADATA'), 'w+').write(
+                f'Metadata-Version: 2.1\nName: {name}\n'
+                f'Version: {version}\n\nDescription\n')
+
+    def teardown_class(self):
+        shutil.rmtree(self.prefix, ignore_errors=True)
+
+    def test_conda_meta(self):
+        result = meta.conda_meta(self.prefix)
+        assert sorted(result) == ['numpy', 'python']
+        assert result['python']['version'] == '3.7.3'
+
+    def test_explicit_read(self):
+        filename = 'explicit.txt'
+        open(filename, 'w+').write("""# platform: linux-64
+@EXPLICIT
+https://example/linux-64/zlib-1.2.11-h7b6447c_3.tar.bz2#abcdef
+
+https://example/noarch/relic-1.1.0-py_0.tar.bz2
+""")
+        result = meta.explicit_read(filename)
+        assert len(result) == 2
+        assert meta.explicit_filename(result[0]) == \
+            'zlib-1.2.11-h7b6447c_3.tar.bz2'
+        assert meta.explicit_filename(result[1]) == \
+            'relic-1.1.0-py_0.tar.bz2'
+
+    @pytest.mark.parametrize('a, b, expected', [
+        ('1.0', '1.0', 0),
+        ('1.0', '1.0.0', 0),
+        ('1.10', '1.9', 1),
+        ('1.0rc1', '1.0', -1),
+        ('1.0.post1', '1.0', 1),
+        ('1.0.post1', '1.1', -1),
+        ('1.1a1', '1.1.dev1', -1),
+        ('1.1.dev1', '1.1.0rc1', -1),
+        ('1!0.1', '2.0', 1),
+        ('2019.1.23', '2019.3.9', -1),
+    ])
+    def test_version_compare(self, a, b, expected):
+        assert meta.version_compare(a, b) == expected
+
+    def test_version_key(self):
+        versions = ['1.1', '1.0.post1', '1.0', '1.0rc1', '0.9']
+        assert sorted(versions, key=meta.version_key) == versions[::-1]
+
+    @pytest.mark.parametrize('installed, operator, version, expected', [
+        ('1.16.3', None, None, True),
+        ('1.16.3', '=', '1.16', True),
+        ('1.16.3', '=', '1.1', False),
+        ('1.16.3', '==', '1.16.3', True),
+        ('1.16.3', '==', '1.16', False),
+        ('1.16.3', '>=', '1.16.0', True),
+        ('1.16.3', '<', '1.16.3', False),
+        ('1.16.3', '!=', '1.15', True),
+        ('1.16.3', '=>', '1.0', False),
+        ('1.0.post1', '>=', '1.0', True),
+        ('1.0.post1', '=', '1.0', True),
+        ('1.0.post1', '<', '1.0.1', True),
+        ('1.0rc1', '=', '1.0', True),
+        ('1.0rc1', '>=', '1.0', False),
+        ('1.0rc1', '=', '1.0rc', True),
+        ('1.10', '=', '1.1', False),
+    ])
+    def test_version_match(self, installed, operator, version, expected):
+        assert meta.version_match(installed, operator, version) == expected
+
+    def test_pip_packages(self):
+        records = meta.conda_meta(self.prefix)
+        assert meta.pip_packages(self.prefix, records) == [('ci-watson', '0.3')]
+
+    def test_export(self):
+        yamlfile = 'meta_env.yml'
+        specfile = 'meta_env.txt'
+        meta.export(self.prefix, 'meta_env', CHANNELS, yamlfile, specfile)
+
+        assert open(yamlfile).read() == \
+            CONDA_ENV_EXPORT.format(prefix=self.prefix)
+
+        spec = open(specfile).read()
+        assert spec.startswith('# This file may be used')
+        assert '# platform: linux-64\n@EXPLICIT\n' in spec
+        assert spec.endswith('https://repo/linux-64/python-3.7.3-0.tar.bz2\n'
+                             'https://repo/linux-64/numpy-1.16.3-py37_0.tar.bz2\n')
+
+    def test_export_explicit_order(self):
+        open('base_spec_order.txt', 'w+').write(BASE_SPEC)
+        records = dict()
+        for url in meta.explicit_read('base_spec_order.txt'):
+            fn = meta.explicit_filename(url)
+            name, version, build = fn[:-len('.tar.bz2')].rsplit('-', 2)
+            records[name] = dict(name=name, version=version, build=build,
+                                 fn=fn, url=url, subdir='linux-64',
+                                 depends=BASE_SPEC_DEPENDS.get(name, []))
+
+        spec = io.StringIO()
+        meta.export_explicit(records, spec)
+        assert spec.getvalue() == BASE_SPEC
+
+    @pytest.mark.parametrize('depends, expected', [
+        # Cycles are broken at the package with the fewest dependencies
+        (dict(a=['b'], b=['a', 'c'], c=[]), ['c', 'a', 'b']),
+        # python <-> pip
+        (dict(python=['pip'], pip=['python']), ['python', 'pip']),
+        (dict(z=[], y=['x'], x=[]), ['z', 'x', 'y']),
+    ])
+    def test_dependency_order(self, depends, expected):
+        records = {x: dict(name=x, depends=y) for x, y in depends.items()}
+        assert meta.dependency_order(records) == expected
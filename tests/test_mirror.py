@@ -0,0 +1,81 @@
+import os
+from delivery_merge import mirror
+from subprocess import run
+
+
+GIT = ['git', '-c', 'user.name=test', '-c', 'user.email=test@localhost',
+       '-c', 'protocol.file.allow=always']
+
+
+def git_commit(path, filename, data):
+    open(os.path.join(path, filename), 'w+').write(data)
+    run(GIT + ['add', filename], cwd=path, check=True)
+    run(GIT + ['commit', '-q', '-m', f'update {filename}'], cwd=path,
+        check=True)
+    return run(['git', 'rev-parse', 'HEAD'], cwd=path, check=True,
+               capture_output=True).stdout.decode().strip()
+
+
+def git_init(path):
+    os.makedirs(path, exist_ok=True)
+    run(GIT + ['init', '-q'], cwd=path, check=True)
+
+
+class TestMirror:
+    def setup_class(self):
+        self.cache_root = os.path.abspath('mirror_cache')
+        self.origin = os.path.abspath('mirror_origin')
+        self.library = os.path.abspath('mirror_library')
+        self.url = f'file://{self.origin}'
+
+        git_init(self.library)
+        git_commit(self.library, 'library.txt', 'library')
+
+        git_init(self.origin)
+        self.first = git_commit(self.origin, 'data.txt', 'first')
+        run(GIT + ['submodule', '-q', 'add', f'file://{self.library}',
+                   'library'], cwd=self.origin, check=True)
+        self.second = git_commit(self.origin, 'data.txt', 'second')
+
+    def teardown_class(self):
+        pass
+
+    def test_mirror_path(self):
+        a = mirror.mirror_path('https://example/a/repo.git', self.cache_root)
+        b = mirror.mirror_path('https://example/b/repo', self.cache_root)
+        assert a != b
+        assert a.endswith('-repo.git') and b.endswith('-repo.git')
+
+    def test_resolve_url(self):
+        base = 'https://example/org/repo.git'
+        assert mirror._resolve_url(base, '../other.git') == \
+            'https://example/org/other.git'
+        assert mirror._resolve_url(base, 'https://x/y.git') == \
+            'https://x/y.git'
+
+    def test_mirror_checkout(self):
+        dest = os.path.abspath('mirror_checkout')
+        mirror.mirror_checkout(self.url, self.first, dest, self.cache_root)
+        assert open(os.path.join(dest, 'data.txt')).read() == 'first'
+        assert not os.path.exists(os.path.join(dest, 'library.txt'))
+
+        # Leftovers of a previous run are discarded
+        open(os.path.join(dest, 'data.txt'), 'w').write('modified')
+        open(os.path.join(dest, 'untracked.txt'), 'w').write('untracked')
+        mirror.mirror_checkout(self.url, self.second, dest, self.cache_root)
+        assert open(os.path.join(dest, 'data.txt')).read() == 'second'
+        assert not os.path.exists(os.path.join(dest, 'untracked.txt'))
+        assert open(os.path.join(dest, 'library', 'library.txt')).read() \
+            == 'library'
+
+    def test_mirror_fetch_incremental(self):
+        mirror_dir = mirror.mirror_update(self.url, cache_root=self.cache_root)
+        third = git_commit(self.origin, 'data.txt', 'third')
+        assert not mirror.mirror_has_commit(mirror_dir, third)
+
+        dest = os.path.abspath('mirror_checkout_third')
+        mirror.mirror_checkout(self.url, third, dest, self.cache_root)
+        assert mirror.mirror_has_commit(mirror_dir, third)
+        assert open(os.path.join(dest, 'data.txt')).read() == 'third'
+        # Work trees share the mirror's object store
+        assert os.path.isfile(os.path.join(dest, '.git'))
@@ -0,0 +1,44 @@
+import pytest
+import time
+from delivery_merge import pipeline
+
+
+class TestPipeline:
+    def test_dependencies(self):
+        order = []
+        p = pipeline.Pipeline()
+        p.add('a', lambda: order.append('a') or 1)
+        p.add('b', lambda a: order.append('b') or a + 1, deps=['a'])
+        p.add('c', lambda a, b: order.append('c') or a + b, deps=['a', 'b'])
+        result = p.run()
+        assert result == dict(a=1, b=2, c=3)
+        assert order == ['a', 'b', 'c']
+
+    def test_overlap(self):
+        p = pipeline.Pipeline()
+        p.add('root', lambda: None)
+        p.add('slow_a', lambda _: time.sleep(0.2), deps=['root'])
+        p.add('slow_b', lambda _: time.sleep(0.2), deps=['root'])
+        p.run()
+        report = p.report()
+        assert report['wall'] < 0.35
+        assert report['serial'] >= 0.4
+        assert report['saved'] > 0.1
+
+    def test_failure_skips_dependents(self):
+        def fail():
+            raise ValueError('boom')
+
+        p = pipeline.Pipeline()
+        p.add('bad', fail)
+        p.add('child', lambda _: 'never', deps=['bad'])
+        p.add('independent', lambda: 'ok')
+        with pytest.raises(ValueError):
+            p.run()
+        assert p.stages['child'].skipped
+        assert p.stages['independent'].result == 'ok'
+
+    def test_unknown_dependency(self):
+        p = pipeline.Pipeline()
+        with pytest.raises(pipeline.StageError):
+            p.add('a', lambda: None, deps=['missing'])
@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import time
+from delivery_merge import pkgs
+
+
+PACKAGES = [
+    ('relic', '1.1.0', 'py_0'),
+    ('relic', '1.1.2', 'py_0'),
+    ('relic', '1.10.0', 'py_0'),
+    ('numpy', '1.16.3', 'py37_0'),
+]
+META_YAML = """package:
+  name: {name}
+  version: {version}
+source:
+  git_url: https://example/{name}.git
+"""
+GIT_LOG = """==> git log -n1 <==
+commit {commit}
+Author: nobody
+"""
+
+
+def make_package(pkgdir, name, version, build, git=True):
+    root = os.path.join(pkgdir, f'{name}-{version}-{build}')
+    recipe = os.path.join(root, 'info', 'recipe')
+    os.makedirs(recipe, exist_ok=True)
+    json.dump(dict(name=name, version=version, build=build),
+              open(os.path.join(root, 'info', 'index.json'), 'w+'))
+    if git:
+        open(os.path.join(recipe, 'meta.yaml'), 'w+').write(
+            META_YAML.format(name=name, version=version))
+        open(os.path.join(root, 'info', 'git'), 'w+').write(
+            GIT_LOG.format(commit=f'{name}{version}'))
+    return root
+
+
+class TestPkgs:
+    def setup_class(self):
+        self.pkgdir = os.path.abspath('pkgs_test')
+        self.cache_file = os.path.abspath('pkgs_test.json')
+        for name, version, build in PACKAGES:
+            make_package(self.pkgdir, name, version, build,
+                         git=name == 'relic')
+        os.makedirs(os.path.join(self.pkgdir, 'cache'), exist_ok=True)
+        open(os.path.join(self.pkgdir, 'urls.txt'), 'w+')
+
+    def teardown_class(self):
+        pass
+
+    def test_pkgs_index(self):
+        index = pkgs.pkgs_index(self.pkgdir, self.cache_file)
+        assert sorted(index['packages']) == ['numpy', 'relic']
+        assert sorted(index['packages']['relic']) == ['1.1.0', '1.1.2',
+                                                      '1.10.0']
+        assert os.path.exists(self.cache_file)
+
+    def test_pkgs_index_reuses_cache(self):
+        pkgs.pkgs_index(self.pkgdir, self.cache_file)
+        index_json = os.path.join(self.pkgdir, 'numpy-1.16.3-py37_0',
+                                  'info', 'index.json')
+        data = open(index_json).read()
+        stat = os.stat(index_json)
+        open(index_json, 'w').write('{}')
+        os.utime(index_json, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        try:
+            index = pkgs.pkgs_index(self.pkgdir, self.cache_file)
+        finally:
+            open(index_json, 'w').write(data)
+        assert 'numpy' in index['packages']
+
+    def test_pkgs_index_extracting(self):
+        pkgs.pkgs_index(self.pkgdir, self.cache_file)
+        path = os.path.join(self.pkgdir, 'astropy-3.2-py37_0')
+        os.makedirs(os.path.join(path, 'info'))
+        try:
+            # Scanned while conda is extracting the package
+            index = pkgs.pkgs_index(self.pkgdir, self.cache_file)
+            assert 'astropy-3.2-py37_0' not in index['records']
+
+            make_package(self.pkgdir, 'astropy', '3.2', 'py37_0')
+            index = pkgs.pkgs_index(self.pkgdir, self.cache_file)
+            assert 'astropy' in index['packages']
+        finally:
+            shutil.rmtree(path)
+
+    def test_pkgs_index_detects_changes(self):
+        pkgs.pkgs_index(self.pkgdir, self.cache_file)
+        time.sleep(0.01)
+        path = make_package(self.pkgdir, 'astropy', '3.1', 'py37_0')
+        try:
+            index = pkgs.pkgs_index(self.pkgdir, self.cache_file)
+            assert 'astropy' in index['packages']
+        finally:
+            shutil.rmtree(path)
+
+    def test_pkgs_lookup(self):
+        index = pkgs.pkgs_index(self.pkgdir, self.cache_file)
+        result = pkgs.pkgs_lookup(index, 'relic', '=', '1.1.0')
+        assert os.path.basename(result) == 'relic-1.1.0-py_0'
+        # A prefix glob would have matched 1.10.0 as well
+        result = pkgs.pkgs_lookup(index, 'relic', '=', '1.1')
+        assert os.path.basename(result) == 'relic-1.1.2-py_0'
+        result = pkgs.pkgs_lookup(index, 'relic')
+        assert os.path.basename(result) == 'relic-1.10.0-py_0'
+        assert pkgs.pkgs_lookup(index, 'relic', '=', '2.0') is None
+        assert pkgs.pkgs_lookup(index, 'missing') is None
+
+    def test_pkg_git_info(self):
+        index = pkgs.pkgs_index(self.pkgdir, self.cache_file)
+        path = pkgs.pkgs_lookup(index, 'relic', '=', '1.1.0')
+        result = pkgs.pkg_git_info(index, path)
+        assert result == dict(repo='https://example/relic.git',
+                              commit='relic1.1.0')
+
+        path = pkgs.pkgs_lookup(index, 'numpy')
+        assert pkgs.pkg_git_info(index, path) is None
+
+        pkgs.pkgs_index_save(index)
+        index = pkgs.pkgs_index(self.pkgdir, self.cache_file)
+        assert index['records']['relic-1.1.0-py_0']['git']['commit'] == \
+            'relic1.1.0'
@@ -0,0 +1,43 @@
+import os
+import pstats
+import pytest
+from delivery_merge import pipeline, profiling
+
+
+def busy_work():
+    return sum([x * x for x in range(10000)])
+
+
+class TestProfiling:
+    def test_profile_call(self):
+        output_dir = os.path.abspath('profile_output')
+        result = profiling.profile_call(busy_work, output_dir, top=5)
+        assert result == busy_work()
+
+        stats = pstats.Stats(os.path.join(output_dir, 'profile.pstats'))
+        assert any([x[2] == 'busy_work' for x in stats.stats])
+
+        summary = open(os.path.join(output_dir, 'profile.txt')).read()
+        assert 'by cumulative time' in summary
+        assert 'busy_work' in summary
+
+    def test_profile_threads(self):
+        def run():
+            p = pipeline.Pipeline()
+            p.add('work', busy_work)
+            return p.run()['work']
+
+        output_dir = os.path.abspath('profile_threads')
+        assert profiling.profile_call(run, output_dir) == busy_work()
+
+        stats = pstats.Stats(os.path.join(output_dir, 'profile.pstats'))
+        assert any([x[2] == 'busy_work' for x in stats.stats])
+
+    def test_profile_call_raises(self):
+        def fail():
+            raise ValueError('boom')
+
+        output_dir = os.path.abspath('profile_raises')
+        with pytest.raises(ValueError):
+            profiling.profile_call(fail, output_dir)
+        assert os.path.exists(os.path.join(output_dir, 'profile.pstats'))
@@ -0,0 +1,147 @@
+import json
+import os
+import pytest
+from delivery_merge import merge, repodata
+
+
+def make_channel(root, packages, subdir='linux-64'):
+    """ Write a minimal conda channel (file:// stand-in)
+
+    :param root: str: path to channel
+    :param packages: list: of (name, version) tuples
+    :returns: str: channel URL
+    """
+    data = dict(packages={f'{name}-{version}-0.tar.bz2':
+                          dict(name=name, version=version, build='0')
+                          for name, version in packages})
+    for platform, records in [(subdir, data), ('noarch', dict())]:
+        os.makedirs(os.path.join(root, platform), exist_ok=True)
+        with open(os.path.join(root, platform, 'repodata.json'), 'w') as fp:
+            json.dump(records, fp)
+    return 'file://' + os.path.abspath(root)
+
+
+class TestRepodata:
+    def setup_class(self):
+        self.channel = make_channel('repodata_channel', [
+            ('python', '3.6.8'), ('python', '3.7.3'), ('numpy', '1.16.3'),
+            ('setuptools', '41.0.1')])
+        self.cache_root = os.path.abspath('repodata_cache')
+        self.dmfile = os.path.abspath('repodata.dm')
+        open(self.dmfile, 'w+').write("""
+python=3.7
+numpy=1.16.3=py37_0
+setuptools>=42
+relic
+""")
+
+    @pytest.mark.parametrize('channel,expected', [
+        ('defaults', ['https://mirror/main', 'https://mirror/free']),
+        ('http://example.com/channel/', ['http://example.com/channel']),
+        ('/srv/channel', ['file:///srv/channel']),
+        ('conda-forge', ['https://alias/conda-forge']),
+    ])
+    def test_channel_urls(self, channel, expected):
+        config = dict(default_channels=['https://mirror/main',
+                                        'https://mirror/free'],
+                      channel_alias='https://alias')
+        assert repodata.channel_urls(channel, config) == expected
+
+    def test_channel_urls_unresolved(self):
+        assert repodata.channel_urls('defaults') is None
+        assert repodata.channel_urls('conda-forge') is None
+
+    def test_channel_config(self, monkeypatch):
+        class Proc:
+            returncode = 0
+            stdout = json.dumps(dict(
+                channel_alias=dict(scheme='https', location='alias',
+                                   name=''),
+                default_channels=['https://mirror/main/',
+                                  dict(scheme='https', location='mirror',
+                                       name='pkgs/free')])).encode()
+
+        monkeypatch.setattr(repodata, 'conda', lambda *args: Proc())
+        assert repodata.channel_config() == dict(
+            default_channels=['https://mirror/main',
+                              'https://mirror/pkgs/free'],
+            channel_alias='https://alias')
+
+        Proc.returncode = 1
+        assert repodata.channel_config() is None
+
+    def test_repodata_fetch(self):
+        url = f'{self.channel}/linux-64/repodata.json'
+        packages = repodata.repodata_fetch(url, self.cache_root)
+        assert packages['python'] == ['3.6.8', '3.7.3']
+
+        # The index is rebuilt only when the repodata changes
+        filename = os.path.join(self.channel[7:], 'linux-64', 'repodata.json')
+        data = json.load(open(filename))
+        data['packages']['python-3.8.0-0.tar.bz2'] = dict(name='python',
+                                                          version='3.8.0')
+        json.dump(data, open(filename, 'w'))
+        os.utime(filename, (0, 0))
+        packages = repodata.repodata_fetch(url, self.cache_root)
+        assert packages['python'] == ['3.6.8', '3.7.3', '3.8.0']
+
+    def test_repodata_fetch_remote(self, http_server):
+        os.makedirs(os.path.join(http_server.root, 'noarch'))
+        open(os.path.join(http_server.root, 'noarch', 'repodata.json'),
+             'w').write(json.dumps(dict(packages={'a-1.0-0.tar.bz2':
+                                                  dict(name='a',
+                                                       version='1.0')})))
+        url = f'{http_server.url}/noarch/repodata.json'
+        for _ in range(2):
+            assert repodata.repodata_fetch(url, self.cache_root) \
+                == dict(a=['1.0'])
+        assert len(http_server.requests) == 1
+
+    def test_repodata_index_missing(self):
+        index, missing = repodata.repodata_index(
+            [self.channel, 'file:///nonexistent'], 'linux-64',
+            cache_root=self.cache_root)
+        assert 'numpy' in index
+        assert missing == ['file:///nonexistent/linux-64/repodata.json',
+                           'file:///nonexistent/noarch/repodata.json']
+
+    def test_repodata_unsatisfiable(self):
+        index, _ = repodata.repodata_index([self.channel], 'linux-64',
+                                           cache_root=self.cache_root)
+        records = merge.dmfile(self.dmfile)
+        result = repodata.repodata_unsatisfiable(records, index)
+        assert [(x['name'], y.split(' (')[0]) for x, y in result] == [
+            ('setuptools', 'no matching version'),
+            ('relic', 'not found in any channel')]
+
+    def test_repodata_unsatisfiable_releases(self):
+        dmfile = os.path.abspath('releases.dm')
+        open(dmfile, 'w+').write('foo>=1.0\nbar=2.0\n')
+        records = merge.dmfile(dmfile)
+        index = dict(foo=['1.0.post1'], bar=['2.0rc1'])
+        assert repodata.repodata_unsatisfiable(records, index) == []
+
+    def test_dmfile_validate(self):
+        records = merge.dmfile(self.dmfile)
+        with pytest.raises(merge.UnsatisfiablePackageSpec) as e:
+            merge.dmfile_validate(records, [self.channel], 'linux-64',
+                                  cache_root=self.cache_root)
+        assert str(e.value).splitlines() == [
+            "'setuptools>=42': no matching version (latest: 41.0.1)",
+            "'relic': not found in any channel"]
+
+        assert merge.dmfile_validate(records[:2], [self.channel], 'linux-64',
+                                     cache_root=self.cache_root)
+        # Another channel might provide the packages
+        assert not merge.dmfile_validate(records, [self.channel,
+                                                   'file:///nonexistent'],
+                                         'linux-64',
+                                         cache_root=self.cache_root)
+
+    def test_dmfile_validate_unresolved(self, monkeypatch):
+        # Without conda's channel configuration "defaults" is unknown
+        monkeypatch.setattr(repodata, 'channel_config', lambda: None)
+        records = merge.dmfile(self.dmfile)
+        assert not merge.dmfile_validate(records, [self.channel, 'defaults'],
+                                         'linux-64',
+                                         cache_root=self.cache_root)
@@ -0,0 +1,124 @@
+import os
+import pytest
+import subprocess
+from delivery_merge import merge
+from delivery_merge.conda import CondaEnv
+from delivery_merge.junit import junit_summary
+from delivery_merge.shard import (
+    SHARD_DEFAULT_DURATION,
+    shard_balance,
+    shard_durations,
+    shard_history_file,
+    shard_history_update,
+    shard_modules
+)
+from .test_junit import JUNIT_SUITE
+
+
+COLLECTED = """pkg/tests/test_a.py::test_one
+pkg/tests/test_a.py::TestA::test_two[1]
+pkg/tests/test_b.py::test_three
+tests/test_c.py::test_four
+
+4 tests collected in 0.01s
+"""
+TEST_MODULE = """import pytest
+
+
+@pytest.mark.parametrize('value', range({count}))
+def test_value(value):
+    assert value >= 0
+"""
+
+
+class TestShard:
+    def test_shard_modules(self):
+        assert shard_modules(COLLECTED.splitlines()) == [
+            'pkg/tests/test_a.py',
+            'pkg/tests/test_b.py',
+            'tests/test_c.py',
+        ]
+
+    def test_shard_durations(self):
+        modules = ['pkg/tests/test_a.py', 'pkg/tests/test_b.py',
+                   'tests/test_c.py']
+        history = {
+            'pkg.tests.test_a': 2.0,
+            'pkg.tests.test_a.TestA': 3.0,
+            'pkg.tests.test_b': 1.5,
+            'pkg.tests.test_removed': 100.0,
+        }
+        assert shard_durations(modules, history) == {
+            'pkg/tests/test_a.py': 5.0,
+            'pkg/tests/test_b.py': 1.5,
+            'tests/test_c.py': SHARD_DEFAULT_DURATION,
+        }
+
+    def test_shard_balance(self):
+        durations = dict(a=10.0, b=6.0, c=5.0, d=4.0, e=1.0)
+        shards = shard_balance(list(durations), durations, 2)
+        assert sorted(shards) == [['a', 'd'], ['b', 'c', 'e']]
+        assert shard_balance(['a'], durations, 4) == [['a']]
+        assert shard_balance([], durations, 4) == []
+
+    def test_shard_history_update(self):
+        result = os.path.abspath('history.xml')
+        open(result, 'w+').write(JUNIT_SUITE)
+        cache_root = os.path.abspath('durations')
+        data = shard_history_update('https://example/relic.git', result,
+                                    cache_root)
+        assert data == {'test_a': 0.5}
+        assert os.path.exists(shard_history_file('https://example/relic.git',
+                                                 cache_root))
+
+    def test_integration_test_shards(self):
+        project = os.path.abspath('sharded_project')
+        os.makedirs(os.path.join(project, 'tests'), exist_ok=True)
+        for i, count in enumerate([3, 2, 1]):
+            filename = os.path.join(project, 'tests', f'test_mod{i}.py')
+            open(filename, 'w+').write(TEST_MODULE.format(count=count))
+
+        env = CondaEnv('sharded', environ=dict(os.environ))
+        logs = os.path.join(project, 'logs')
+        results = os.path.join(project, 'result.xml')
+        procs = merge.integration_test_shards(env, 'https://example/sharded',
+                                              project, results, 2, logs)
+        assert len(procs) == 2
+        assert not any([x.returncode for x in procs])
+        assert junit_summary(results)['tests'] == 6
+        assert os.path.exists(os.path.join(logs, 'pytest.log'))
+
+    def test_integration_test_shards_collect_error(self):
+        project = os.path.abspath('sharded_project_broken')
+        os.makedirs(os.path.join(project, 'tests'), exist_ok=True)
+        open(os.path.join(project, 'tests', 'test_ok.py'),
+             'w+').write(TEST_MODULE.format(count=2))
+        open(os.path.join(project, 'tests', 'test_broken.py'),
+             'w+').write('import no_such_module\n')
+
+        # Sharding only the importable modules would hide the error
+        env = CondaEnv('sharded', environ=dict(os.environ))
+        assert merge.integration_test_shards(
+            env, 'https://example/broken', project,
+            os.path.join(project, 'result.xml'), 2,
+            os.path.join(project, 'logs')) is None
+
+    def test_integration_test_shards_failure(self):
+        project = os.path.abspath('sharded_project_failure')
+        os.makedirs(os.path.join(project, 'tests'), exist_ok=True)
+        for i in range(2):
+            open(os.path.join(project, 'tests', f'test_mod{i}.py'),
+                 'w+').write(TEST_MODULE.format(count=1))
+        # Usage errors (exit status 4) abort the shard without a report
+        open(os.path.join(project, 'conftest.py'), 'w+').write(
+            'import pytest\n\n\n'
+            'def pytest_configure(config):\n'
+            '    if "shard1" in str(config.option.xmlpath):\n'
+            '        raise pytest.UsageError("broken")\n')
+
+        env = CondaEnv('sharded', environ=dict(os.environ))
+        with pytest.raises(subprocess.CalledProcessError):
+            merge.integration_test_shards(
+                env, 'https://example/failure', project,
+                os.path.join(project, 'result.xml'), 2,
+                os.path.join(project, 'logs'))
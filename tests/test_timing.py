@@ -0,0 +1,55 @@
+import json
+import os
+import pytest
+from delivery_merge import pipeline, timing, utils
+
+
+class TestTiming:
+    def test_usage_collect(self):
+        with timing.usage_collect() as outer:
+            utils.sh('true')
+            with timing.usage_collect() as inner:
+                utils.sh('false')
+                utils.sh_stream('true', echo=False)
+
+        assert outer.status == 'ok'
+        assert outer.commands == 3 and outer.commands_failed == 1
+        assert inner.commands == 2 and inner.commands_failed == 1
+        assert outer.wall >= inner.wall > 0
+        assert outer.max_rss_children > 0
+
+    def test_usage_collect_failure(self):
+        with pytest.raises(RuntimeError):
+            with timing.usage_collect() as usage:
+                raise RuntimeError('boom')
+        assert usage.status == 'failed'
+        assert usage.as_dict()['status'] == 'failed'
+
+    def test_usage_outside_collector(self):
+        # No collector active: nothing is recorded and nothing breaks
+        assert utils.sh('true').returncode == 0
+
+    def test_pipeline_usage(self):
+        p = pipeline.Pipeline()
+        p.add('a', lambda: utils.sh('true'))
+        p.add('b', lambda _: None, deps=['a'])
+        p.run()
+        report = p.report()
+        assert report['usage']['a']['commands'] == 1
+        assert report['usage']['a']['status'] == 'ok'
+        assert report['usage']['b']['commands'] == 0
+
+    def test_timings_output(self):
+        data = timing.Usage()
+        data.status = 'ok'
+        rows = [('installer', data.as_dict()),
+                ('tests: relic', dict(status='failed', wall=1.5))]
+        table = timing.timings_table(rows).splitlines()
+        assert len(table) == 3
+        assert table[0].startswith('Name')
+        assert 'failed' in table[2] and '1.50' in table[2]
+
+        filename = os.path.abspath('timings.json')
+        timing.timings_write(filename, dict(stages=dict(rows)))
+        assert json.load(open(filename))['stages']['installer']['status'] \
+            == 'ok'
@@ -0,0 +1,55 @@
+import json
+import os
+from delivery_merge import trace, utils
+
+
+class TestTrace:
+    def setup_class(self):
+        self.filename = os.path.abspath('trace.jsonl')
+
+    def teardown_class(self):
+        pass
+
+    def setup_method(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def test_trace_disabled(self, monkeypatch):
+        monkeypatch.delenv(trace.TRACE_ENV, raising=False)
+        utils.sh('true')
+        assert not os.path.exists(self.filename)
+
+    def test_trace_record(self, monkeypatch):
+        monkeypatch.setenv(trace.TRACE_ENV, self.filename)
+        env = dict(os.environ, CONDA_DEFAULT_ENV='delivery')
+        utils.sh('echo', 'testing', env=env)
+        utils.sh_stream('false', echo=False)
+
+        records = trace.trace_read(self.filename)
+        assert len(records) == 2
+        assert records[0]['argv'] == ['echo', 'testing']
+        assert records[0]['env'] == 'delivery'
+        assert records[0]['cwd'] == os.path.abspath('.')
+        assert records[0]['stdout_size'] == len('testing\n')
+        assert records[0]['end'] >= records[0]['start']
+        assert records[1]['returncode'] == 1
+
+    def test_trace_enable(self, monkeypatch):
+        # Registered with monkeypatch so the variable is restored afterward
+        monkeypatch.setenv(trace.TRACE_ENV, '')
+        assert trace.trace_file() is None
+        trace.trace_enable('trace.jsonl')
+        assert trace.trace_file() == self.filename
+
+    def test_trace_to_chrome(self, monkeypatch):
+        monkeypatch.setenv(trace.TRACE_ENV, self.filename)
+        utils.sh('true')
+        utils.git('--version')
+
+        output = os.path.abspath('trace.json')
+        assert trace.trace_to_chrome(self.filename, output) == 2
+        data = json.load(open(output))
+        events = data['traceEvents']
+        assert [x['name'] for x in events] == ['true', 'git']
+        assert all([x['ph'] == 'X' and x['dur'] >= 0 for x in events])
+        assert events[0]['ts'] == 0
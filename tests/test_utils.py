@@ -1,4 +1,7 @@
+import fcntl
+import hashlib
 import os
+import pytest
 from delivery_merge import utils
 
 
@@ -28,6 +31,56 @@ class TestUtils:
                           'testing', '1', '2', '3').stdout.decode().strip()
         assert result == 'testing 1 2 3'
 
+    def test_sh_env(self):
+        env = dict(os.environ, DM_TEST_VALUE='testing')
+        result = utils.sh('printenv', 'DM_TEST_VALUE', env=env)
+        assert result.stdout.decode().strip() == 'testing'
+        assert 'DM_TEST_VALUE' not in os.environ
+
+    def test_sh_cwd(self):
+        d = os.path.abspath('sh_cwd_test')
+        os.makedirs(d, exist_ok=True)
+        result = utils.sh('pwd', cwd=d).stdout.decode().strip()
+        assert result == d
+
+    def test_runtime_env(self):
+        class Handle:
+            environ = {'FOO': 'BAR'}
+
+        assert utils.runtime_env() is os.environ
+        assert utils.runtime_env({'FOO': 'BAR'}) == {'FOO': 'BAR'}
+        assert utils.runtime_env(Handle()) is Handle.environ
+
+    def test_sh_stream(self):
+        lines = []
+        logfile = os.path.abspath('sh_stream_test.log')
+        result = utils.sh_stream('printf', r'one\ntwo\n', logfile=logfile,
+                                 callback=lambda x, y: lines.append((x, y)))
+        assert result.returncode == 0
+        assert result.stdout == b'one\ntwo\n'
+        assert lines == [('stdout', b'one\n'), ('stdout', b'two\n')]
+        assert open(logfile, 'rb').read() == b'one\ntwo\n'
+
+    def test_sh_stream_bounded(self):
+        logfile = os.path.abspath('sh_stream_bounded.log')
+        result = utils.sh_stream('seq', '1 100000', logfile=logfile,
+                                 echo=False, tail=1024)
+        assert len(result.stdout) == 1024
+        assert result.stdout.endswith(b'99999\n100000\n')
+        assert os.path.getsize(logfile) > 1024
+
+    def test_sh_stream_returncode(self):
+        result = utils.sh_stream('false')
+        assert result.returncode
+
+    def test_ring_buffer(self):
+        ring = utils.RingBuffer(8)
+        for chunk in [b'abc', b'defg', b'hij']:
+            ring.append(chunk)
+        assert ring.getvalue() == b'cdefghij'
+        ring.append(b'0123456789')
+        assert ring.getvalue() == b'23456789'
+
     def test_git_alive(self):
         assert utils.git('--version').stdout.decode().strip()
 
@@ -57,3 +110,60 @@ class TestUtils:
             assert new_path == os.path.join(orig_path, d)
 
         assert os.path.abspath('.') == orig_path
+
+    def test_cache_dir(self, monkeypatch):
+        root = os.path.abspath('cache_dir_test')
+        monkeypatch.setenv('DELIVERY_MERGE_CACHE', root)
+        path = utils.cache_dir('a', 'b')
+        assert path == os.path.join(root, 'a', 'b')
+        assert os.path.isdir(path)
+
+    def test_file_hash(self):
+        filename = 'file_hash_test'
+        open(filename, 'wb').write(b'testing')
+        expected = hashlib.sha256(b'testing').hexdigest()
+        assert utils.file_hash(filename) == expected
+
+    def test_download(self, http_server):
+        data = os.urandom(100000)
+        open(os.path.join(http_server.root, 'blob'), 'wb').write(data)
+        digest = hashlib.sha256(data).hexdigest()
+
+        dest = os.path.abspath('download_test')
+        utils.download(f'{http_server.url}/blob', dest, digest=digest)
+        assert open(dest, 'rb').read() == data
+        assert not os.path.exists(dest + '.part')
+
+    def test_download_resume(self, http_server):
+        data = os.urandom(100000)
+        open(os.path.join(http_server.root, 'blob'), 'wb').write(data)
+
+        dest = os.path.abspath('download_resume_test')
+        open(dest + '.part', 'wb').write(data[:40000])
+        utils.download(f'{http_server.url}/blob', dest, chunk_size=4096)
+        assert open(dest, 'rb').read() == data
+        assert http_server.requests == [('/blob', 'bytes=40000-')]
+
+    def test_download_checksum_mismatch(self, http_server):
+        open(os.path.join(http_server.root, 'blob'), 'wb').write(b'bad')
+
+        dest = os.path.abspath('download_mismatch_test')
+        with pytest.raises(utils.ChecksumMismatch):
+            utils.download(f'{http_server.url}/blob', dest, digest='0' * 64)
+        assert not os.path.exists(dest)
+        assert not os.path.exists(dest + '.part')
+
+    def test_file_lock_shared(self):
+        path = os.path.abspath('file_lock_shared_test.lock')
+        with utils.file_lock(path, shared=True):
+            with open(path) as fp:
+                fcntl.flock(fp, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                fcntl.flock(fp, fcntl.LOCK_UN)
+            with open(path) as fp:
+                with pytest.raises(BlockingIOError):
+                    fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        with utils.file_lock(path):
+            with open(path) as fp:
+                with pytest.raises(BlockingIOError):
+                    fcntl.flock(fp, fcntl.LOCK_SH | fcntl.LOCK_NB)
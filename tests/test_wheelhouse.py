@@ -0,0 +1,96 @@
+import json
+import os
+import zipfile
+from delivery_merge.cache import index_load, lru_touch
+from delivery_merge.conda import CondaEnv
+from delivery_merge.wheelhouse import (
+    wheelhouse_fetch,
+    wheelhouse_install,
+    wheelhouse_key
+)
+
+
+def make_env(prefix, python='3.7.3'):
+    os.makedirs(os.path.join(prefix, 'conda-meta'), exist_ok=True)
+    json.dump(dict(name='python', version=python, subdir='linux-64'),
+              open(os.path.join(prefix, 'conda-meta', 'python.json'), 'w+'))
+    return CondaEnv(os.path.basename(prefix),
+                    environ=dict(os.environ, CONDA_PREFIX=prefix))
+
+
+def make_wheel(dest, name, version):
+    filename = os.path.join(dest, f'{name}-{version}-py3-none-any.whl')
+    dist_info = f'{name}-{version}.dist-info'
+    with zipfile.ZipFile(filename, 'w') as whl:
+        whl.writestr(f'{name}.py', '')
+        whl.writestr(f'{dist_info}/METADATA',
+                     f'Metadata-Version: 2.1\nName: {name}\n'
+                     f'Version: {version}\n')
+        whl.writestr(f'{dist_info}/WHEEL',
+                     'Wheel-Version: 1.0\nRoot-Is-Purelib: true\n'
+                     'Tag: py3-none-any\n')
+        whl.writestr(f'{dist_info}/RECORD', '')
+    return filename
+
+
+class TestWheelhouse:
+    def setup_class(self):
+        self.env = make_env(os.path.abspath('wheelhouse_env'))
+        self.wheels = os.path.abspath('wheelhouse')
+        os.makedirs(self.wheels, exist_ok=True)
+        make_wheel(self.wheels, 'dmdemo', '1.0')
+
+    def test_wheelhouse_key(self):
+        key = wheelhouse_key(['pytest', 'pip'], self.env)
+        assert key == wheelhouse_key(['pip', 'pytest'], self.env)
+        assert key != wheelhouse_key(['pip'], self.env)
+        assert key != wheelhouse_key(['pytest', 'pip'], self.env, 'commit')
+
+        other = make_env(os.path.abspath('wheelhouse_env_other'), '3.6.8')
+        assert key != wheelhouse_key(['pytest', 'pip'], other)
+
+    def test_wheelhouse_fetch_warm(self):
+        key = wheelhouse_key(['dmdemo'], self.env)
+        lru_touch(os.path.join(self.wheels, 'index.json'), key)
+        assert wheelhouse_fetch(['dmdemo'], self.env,
+                                cache_root=self.wheels)
+
+    def test_wheelhouse_fetch(self):
+        env = CondaEnv(self.env.name,
+                       environ=dict(self.env.environ, PIP_NO_INDEX='1'))
+        key = wheelhouse_key(['dmdemo'], env, 'fetch')
+        assert not wheelhouse_fetch(['dmdemo'], env, key=key,
+                                    cache_root=self.wheels)
+        assert key in index_load(os.path.join(self.wheels, 'index.json'))
+        assert os.path.exists(os.path.join(self.wheels,
+                                           'dmdemo-1.0-py3-none-any.whl'))
+        assert not [x for x in os.listdir(self.wheels)
+                    if x.startswith('.download-')]
+
+    def test_wheelhouse_install_offline(self):
+        target = os.path.abspath('wheelhouse_target')
+        key = wheelhouse_key(['dmdemo'], self.env)
+        lru_touch(os.path.join(self.wheels, 'index.json'), key)
+
+        proc = wheelhouse_install(['dmdemo'], self.env,
+                                  cache_root=self.wheels,
+                                  args=f'--target {target}')
+        assert not proc.returncode
+        assert os.path.exists(os.path.join(target, 'dmdemo.py'))
+
+    def test_wheelhouse_install_fallback_log(self):
+        index = os.path.abspath('wheelhouse_empty_index')
+        os.makedirs(index, exist_ok=True)
+        env = CondaEnv(self.env.name,
+                       environ=dict(self.env.environ,
+                                    PIP_INDEX_URL=f'file://{index}'))
+        key = wheelhouse_key(['dmdemo_missing'], env)
+        lru_touch(os.path.join(self.wheels, 'index.json'), key)
+
+        logfile = os.path.abspath('wheelhouse_fallback.log')
+        proc = wheelhouse_install(['dmdemo_missing'], env,
+                                  cache_root=self.wheels, logfile=logfile)
+        assert proc.returncode
+        assert 'Looking in indexes' not in open(logfile).read()
+        assert 'Looking in indexes' in open(
+            os.path.abspath('wheelhouse_fallback-index.log')).read()